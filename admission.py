@@ -0,0 +1,170 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from ratelimit import Overloaded
+from settings import (DOWNLOAD_CONCURRENCY, LOOKUP_CONCURRENCY, MUX_CONCURRENCY, ENCODE_CONCURRENCY,
+                      ADMISSION_QUEUE_LIMITS, ADMISSION_MAX_WAIT)
+
+logger = logging.getLogger(__name__)
+
+# Priorities, lower goes first. A client is waiting on a quick answer for
+# INTERACTIVE work (metadata, search), on a file for DOWNLOAD work, and on
+# nothing but a job status for BACKGROUND work.
+INTERACTIVE = 0
+DOWNLOAD = 1
+BACKGROUND = 2
+
+# Priority of work started by the current request or job
+_priority = contextvars.ContextVar('admission_priority', default=DOWNLOAD)
+# Weight of the latest hold time in the average used for Retry-After
+_HOLD_SMOOTHING = 0.2
+
+
+class QueueFull(Overloaded):
+    """A capacity pool has no room left in its queue, or its queue did not move in time"""
+
+
+class Pool:
+    """
+    A fixed number of slots for one kind of work in this worker.
+
+    Callers get a free slot right away, otherwise they queue by priority
+    (then arrival) for up to max_wait seconds. Once max_queue callers are
+    waiting, new ones are turned away at once with QueueFull, whose
+    retry_after estimates when the queue will have drained.
+    """
+
+    def __init__(self, name, capacity, max_queue, max_wait=ADMISSION_MAX_WAIT):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters = []  # heap of [priority, arrival, future]
+        self._arrivals = itertools.count()
+        self._hold = None  # smoothed seconds a slot is held
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def retry_after(self):
+        """Seconds until a caller arriving now could expect a slot"""
+        hold = self._hold or 1
+        return hold * (len(self._waiters) + 1) / self.capacity
+
+    async def acquire(self, priority=None):
+        """Take a slot, waiting behind higher priority and earlier callers"""
+        if priority is None:
+            priority = _priority.get()
+        acquired = self.try_acquire()
+        if acquired is not None:
+            return acquired
+        if len(self._waiters) >= self.max_queue:
+            self.counters['rejected'] += 1
+            raise QueueFull(f"Too much {self.name} work queued right now, please try again shortly.", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._arrivals), future]
+        heapq.heappush(self._waiters, entry)
+        self.counters['queued'] += 1
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(self.max_wait):
+                await future
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up, pass it on
+                self.release()
+            else:
+                future.cancel()
+                # A release may have popped it already, once cancelling the task cancelled the future
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+            if isinstance(e, TimeoutError):
+                self.counters['timed_out'] += 1
+                raise QueueFull(f"Waited too long for {self.name} capacity, please try again shortly.", self.retry_after()) from None
+            raise
+        now = time.monotonic()
+        self._admitted(now - started)
+        return now
+
+    def try_acquire(self):
+        """Take a slot only if one is free right now, without queueing; None when there is none"""
+        if self.active < self.capacity and not self._waiters:
+            self.active += 1
+            self._admitted(0)
+            return time.monotonic()
+        return None
+
+    def release(self, acquired=None):
+        """Give a slot back; acquired is what acquire returned, to learn how long slots are held"""
+        if acquired is not None:
+            held = time.monotonic() - acquired
+            self._hold = held if self._hold is None else self._hold + _HOLD_SMOOTHING * (held - self._hold)
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Hand the slot straight to the next caller, active stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=None):
+        acquired = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+    def _admitted(self, waited):
+        self.counters['admitted'] += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    def stats(self):
+        queued = {}
+        for priority, _, _ in self._waiters:
+            queued[priority] = queued.get(priority, 0) + 1
+        admitted = self.counters['admitted']
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "queue_depth_by_priority": queued,
+            "max_queue": self.max_queue,
+            "wait_avg": round(self._wait_total / admitted, 3) if admitted else 0,
+            "wait_max": round(self._wait_max, 3),
+            "hold_avg": self._hold and round(self._hold, 3),
+            **self.counters
+        }
+
+
+# Stream downloads from googlevideo, each holding its slot for a whole transfer
+fetch_pool = Pool('fetch', DOWNLOAD_CONCURRENCY, ADMISSION_QUEUE_LIMITS['fetch'])
+# Metadata lookups and searches; a pool of their own, since priority only orders
+# a queue and downloads would otherwise hold every slot for minutes
+lookup_pool = Pool('lookup', LOOKUP_CONCURRENCY, ADMISSION_QUEUE_LIMITS['lookup'])
+# ffmpeg runs that only copy streams, cheap on CPU
+mux_pool = Pool('mux', MUX_CONCURRENCY, ADMISSION_QUEUE_LIMITS['mux'])
+# ffmpeg runs that re-encode video, e.g. burning in subtitles
+encode_pool = Pool('encode', ENCODE_CONCURRENCY, ADMISSION_QUEUE_LIMITS['encode'])
+
+
+@contextmanager
+def priority(level):
+    """Run the work started inside the block at priority level"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def stats():
+    return {pool.name: pool.stats() for pool in (fetch_pool, lookup_pool, mux_pool, encode_pool)}
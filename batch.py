@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import logging
+from urllib.parse import urlparse, parse_qs
+from pytubefix import Playlist, Channel
+from admission import lookup_pool, INTERACTIVE
+from jobs import run_job, JobError
+from ratelimit import Overloaded
+from utils import acquire_budget, canonical_video_id, is_valid_youtube_url, TerminalVideoError
+from settings import BATCH_CONCURRENCY, BATCH_MAX_ITEMS
+
+logger = logging.getLogger(__name__)
+
+# Times an item turned away by our own limits is tried again before it counts as failed
+_OVERLOAD_RETRIES = 3
+_CHANNEL_PREFIXES = ('/channel/', '/c/', '/user/', '/@')
+
+
+def collection_kind(url):
+    """'playlist' or 'channel' when url lists many videos, else None"""
+    parsed = urlparse(url if '://' in url else f'https://{url}')
+    if not (parsed.hostname or '').endswith('youtube.com'):
+        return None
+    if parsed.path == '/playlist' and parse_qs(parsed.query).get('list'):
+        return 'playlist'
+    if parsed.path.startswith(_CHANNEL_PREFIXES):
+        return 'channel'
+    return None
+
+
+def _collection_urls(url, kind, limit):
+    collection = Playlist(url) if kind == 'playlist' else Channel(url)
+    return list(itertools.islice(collection.video_urls, limit))
+
+
+async def expand(sources, limit=BATCH_MAX_ITEMS, seen=None):
+    """
+    Video urls for sources, which are video, playlist or channel urls. At
+    most limit urls are returned, each video only once. seen holds the ids
+    of videos already taken by earlier calls and gets the new ones added.
+    """
+    seen = set() if seen is None else seen
+    urls = []
+    for source in sources:
+        if len(urls) >= limit:
+            break
+        kind = collection_kind(source)
+        if kind:
+            await acquire_budget()
+            async with lookup_pool.slot(INTERACTIVE):
+                found = await asyncio.to_thread(_collection_urls, source, kind, limit - len(urls))
+            logger.info(f"Expanded {kind} {source} into {len(found)} videos")
+        elif is_valid_youtube_url(source):
+            found = [source]
+        else:
+            raise ValueError(f"Not a YouTube video, playlist or channel url: {source}")
+        for url in found:
+            # The same video may come as a watch, youtu.be or embed url
+            vid = canonical_video_id(url) or url
+            if vid not in seen and len(urls) < limit:
+                seen.add(vid)
+                urls.append(url)
+    return urls
+
+
+async def _run_item(index, params):
+    for attempt in range(_OVERLOAD_RETRIES + 1):
+        try:
+            return {"index": index, "url": params['url'], "status": "done", "result": await run_job(params)}
+        except Overloaded as e:
+            if attempt == _OVERLOAD_RETRIES:
+                return {"index": index, "url": params['url'], "status": "failed", "error": e.message, "retry_after": e.retry_after}
+            logger.info(f"Batch item {params['url']} postponed for {e.retry_after}s: {e.message}")
+            await asyncio.sleep(e.retry_after)
+        except TerminalVideoError as e:
+            return {"index": index, "url": params['url'], "status": "failed", **e.to_dict()}
+        except JobError as e:
+            return {"index": index, "url": params['url'], "status": "failed", "error": str(e)}
+        except Exception as e:
+            logger.error(f"Batch item {params['url']} failed: {repr(e)}", exc_info=True)
+            return {"index": index, "url": params['url'], "status": "failed", "error": f"Server error : {repr(e)}"}
+
+
+async def run_batch(items, concurrency=BATCH_CONCURRENCY):
+    """
+    Run the download of every job params dict in items, at most concurrency
+    at a time. Yields a 'running' event when an item starts and its outcome
+    as soon as it is known; one failing item never stops the others. Closing
+    the generator cancels whatever is still running.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    events = asyncio.Queue()
+
+    async def run(index, params):
+        async with slots:
+            events.put_nowait({"index": index, "url": params['url'], "status": "running"})
+            # Each task has its own context, so every item keeps the egress its metadata came through
+            events.put_nowait(await _run_item(index, params))
+
+    tasks = [asyncio.ensure_future(run(index, params)) for index, params in enumerate(items)]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            event = await events.get()
+            if event['status'] != 'running':
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark burning subtitles in with a single ffmpeg run against the
+parallel mode that burns pieces split at keyframes.
+
+Usage: python benchmark_burn.py [VIDEO SUBTITLES.srt] [--pieces N] [--duration SECONDS]
+
+Without a video a 1080p test pattern of --duration seconds is generated,
+with a subtitle every few seconds.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def srt_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d},000"
+
+
+def generate_input(directory, duration):
+    video = os.path.join(directory, 'input.mp4')
+    subprocess.run([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1920x1080:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', '60', '-c:a', 'aac', '-shortest', video
+    ], check=True)
+    subtitles = os.path.join(directory, 'input.srt')
+    with open(subtitles, 'w') as file:
+        for index, start in enumerate(range(0, duration, 4), 1):
+            file.write(f"{index}\n{srt_time(start)} --> {srt_time(start + 3)}\nSubtitle number {index}\n\n")
+    return video, subtitles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', nargs='?')
+    parser.add_argument('subtitles', nargs='?')
+    parser.add_argument('--pieces', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--duration', type=int, default=120)
+    args = parser.parse_args()
+
+    # The encode pool is sized from the environment when pipeline is imported
+    os.environ['ENCODE_CONCURRENCY'] = str(args.pieces)
+    os.environ['PARALLEL_BURN_SEGMENTS'] = str(args.pieces)
+    os.environ['PARALLEL_BURN_MIN_SEGMENT'] = '1'
+    import asyncio
+    from editor import render_video
+    from pipeline import burn_in_parallel
+    from planner import plan, probe
+
+    workdir = tempfile.mkdtemp(prefix='burn-benchmark-')
+    try:
+        if args.video:
+            video, subtitles = args.video, args.subtitles
+        else:
+            print(f"Generating a {args.duration}s 1080p test video...")
+            video, subtitles = generate_input(workdir, args.duration)
+        duration = float(subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', video],
+            capture_output=True, text=True, check=True
+        ).stdout)
+        codecs = probe(video)
+        render = plan(codecs['video'], codecs['audio'], ['mp4'], subtitles=True, reencode=True)
+        extension = os.path.splitext(video)[1]
+
+        single_input = os.path.join(workdir, f'single{extension}')
+        shutil.copy(video, single_input)
+        started = time.monotonic()
+        asyncio.run(render_video(single_input, os.path.join(workdir, 'single_out.mp4'), None, subtitles, True, 'en', render))
+        single = time.monotonic() - started
+        print(f"Single ffmpeg run:        {single:.1f}s")
+
+        parallel_dir = os.path.join(workdir, 'parallel')
+        os.makedirs(parallel_dir)
+        parallel_input = os.path.join(parallel_dir, f'parallel{extension}')
+        shutil.copy(video, parallel_input)
+        started = time.monotonic()
+        asyncio.run(burn_in_parallel(
+            parallel_input, os.path.join(parallel_dir, 'parallel_out.mp4'), None, subtitles, render, duration, args.pieces
+        ))
+        parallel = time.monotonic() - started
+        print(f"{args.pieces} pieces in parallel: {parallel:.1f}s ({single / parallel:.2f}x)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
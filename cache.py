@@ -0,0 +1,428 @@
+import copy
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from settings import CACHE_DIR, METADATA_CACHE_TTL, METADATA_CACHE_SIZE, NEGATIVE_CACHE_TTL, MEDIA_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Entries read from sqlite are kept decoded in process memory so hot videos
+# skip both the database and json parsing of the (large) player response
+_MEMORY_ENTRIES = 256
+# last_access is only rewritten when it is older than this, so reads stay reads
+_TOUCH_INTERVAL = 60
+
+
+def connect(name):
+    """Open a sqlite database in CACHE_DIR that can be shared by every hypercorn worker"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(
+        os.path.join(CACHE_DIR, name),
+        timeout=30,
+        isolation_level=None,
+        check_same_thread=False
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SqliteStore:
+    """Lazily opened, per process sqlite connection guarded by a lock"""
+
+    schema = ()
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+
+    def db(self):
+        # Workers may be forked after import, never share a connection across processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect(self.name)
+            self._pid = os.getpid()
+            for statement in self.schema:
+                self._conn.execute(statement)
+        return self._conn
+
+
+class MetadataCache(SqliteStore):
+    """
+    TTL bounded LRU cache of video metadata keyed by canonical video id.
+
+    Each entry is a json document holding the `yt.dict()` payload, the raw
+    player response (which carries the stream manifest) and the caption tracks.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS metadata (
+            video_id TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS metadata_last_access ON metadata (last_access)',
+    )
+
+    def __init__(self, name='metadata.sqlite3', ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_SIZE):
+        super().__init__(name)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+
+    def get(self, video_id):
+        """
+        Return a copy of the cached entry for video_id, or None if it is
+        missing or expired. pytubefix decodes stream urls in vid_info in
+        place, which must not reach the entry kept in memory.
+        """
+        hit = self._lookup(video_id)
+        return copy.deepcopy(hit[1]) if hit else None
+
+    def set(self, video_id, entry, expires_at=None):
+        """Store entry for video_id and evict the least recently used entries over the size limit"""
+        if not video_id or self.ttl <= 0:
+            return
+        now = time.time()
+        expires_at = expires_at or now + self.ttl
+        payload = json.dumps(entry, default=str)
+        with self._lock:
+            try:
+                db = self.db()
+                db.execute(
+                    'INSERT OR REPLACE INTO metadata (video_id, payload, expires_at, last_access) VALUES (?, ?, ?, ?)',
+                    (video_id, payload, expires_at, now)
+                )
+                db.execute('DELETE FROM metadata WHERE expires_at <= ?', (now,))
+                db.execute(
+                    'DELETE FROM metadata WHERE video_id IN '
+                    '(SELECT video_id FROM metadata ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Metadata cache write failed for {video_id}: {repr(e)}")
+                return
+            self._remember(video_id, json.loads(payload), expires_at, now)
+
+    def update(self, video_id, **fields):
+        """Merge fields into an existing, still fresh entry without extending its lifetime"""
+        hit = self._lookup(video_id)
+        if hit:
+            self.set(video_id, dict(hit[1], **fields), expires_at=hit[0])
+
+    def _lookup(self, video_id):
+        if not video_id or self.ttl <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            hit = self._memory.get(video_id)
+            if hit and hit[0] > now:
+                expires_at, entry, touched = hit
+            else:
+                self._memory.pop(video_id, None)
+                try:
+                    row = self.db().execute(
+                        'SELECT payload, expires_at, last_access FROM metadata WHERE video_id = ?',
+                        (video_id,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logger.warning(f"Metadata cache read failed for {video_id}: {repr(e)}")
+                    return None
+                if not row or row[1] <= now:
+                    return None
+                expires_at, entry, touched = row[1], json.loads(row[0]), row[2]
+            if now - touched >= _TOUCH_INTERVAL:
+                try:
+                    self.db().execute('UPDATE metadata SET last_access = ? WHERE video_id = ?', (now, video_id))
+                    touched = now
+                except sqlite3.Error as e:
+                    logger.debug(f"Could not touch metadata cache entry {video_id}: {repr(e)}")
+            self._remember(video_id, entry, expires_at, touched)
+            return expires_at, entry
+
+    def _remember(self, video_id, entry, expires_at, touched):
+        self._memory[video_id] = (expires_at, entry, touched)
+        self._memory.move_to_end(video_id)
+        while len(self._memory) > _MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+
+class NegativeCache(SqliteStore):
+    """Short lived record of videos that failed with a terminal error, keyed by video id"""
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS negative (
+            video_id TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            message TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, name='metadata.sqlite3', ttl=NEGATIVE_CACHE_TTL):
+        super().__init__(name)
+        self.ttl = ttl
+
+    def get(self, video_id):
+        """Return (code, message) of the remembered failure for video_id, or None"""
+        if not video_id or self.ttl <= 0:
+            return None
+        with self._lock:
+            try:
+                row = self.db().execute(
+                    'SELECT code, message FROM negative WHERE video_id = ? AND expires_at > ?',
+                    (video_id, time.time())
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Negative cache read failed for {video_id}: {repr(e)}")
+                return None
+        return tuple(row) if row else None
+
+    def set(self, video_id, code, message):
+        if not video_id or self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                db = self.db()
+                db.execute(
+                    'INSERT OR REPLACE INTO negative (video_id, code, message, expires_at) VALUES (?, ?, ?, ?)',
+                    (video_id, code, message, now + self.ttl)
+                )
+                db.execute('DELETE FROM negative WHERE expires_at <= ?', (now,))
+            except sqlite3.Error as e:
+                logger.warning(f"Negative cache write failed for {video_id}: {repr(e)}")
+
+
+class MediaCache(SqliteStore):
+    """
+    Finished media files kept on disk, addressed by what they were made from.
+
+    The key is a hash of the video id, the itags of the source streams and
+    the processing recipe (mux, subtitles, ...), so the same request made
+    again is answered from disk. Files live in CACHE_DIR/media/<key>/ under
+    their download name; total size is bounded by max_bytes and the least
+    recently used files go first.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS media (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS media_last_access ON media (last_access)',
+    )
+
+    def __init__(self, name='media.sqlite3', max_bytes=MEDIA_CACHE_SIZE):
+        super().__init__(name)
+        self.directory = os.path.join(CACHE_DIR, 'media')
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(video_id, itags, recipe=None):
+        """Content address for the file made from video_id's streams itags with recipe"""
+        material = json.dumps([video_id, [itag for itag in itags if itag is not None], recipe or {}], sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key):
+        """Path of the cached file for key, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                db = self.db()
+                row = db.execute('SELECT path FROM media WHERE key = ?', (key,)).fetchone()
+                if not row:
+                    return None
+                if not os.path.isfile(row[0]):
+                    # Removed behind our back, forget it
+                    db.execute('DELETE FROM media WHERE key = ?', (key,))
+                    return None
+                db.execute('UPDATE media SET last_access = ? WHERE key = ?', (time.time(), key))
+            except sqlite3.Error as e:
+                logger.warning(f"Media cache read failed for {key}: {repr(e)}")
+                return None
+        return row[0]
+
+    def put(self, key, source):
+        """Move the finished file source into the cache under key, returns its new path"""
+        if not self.enabled:
+            return source
+        size = os.path.getsize(source)
+        if size > self.max_bytes:
+            logger.info(f"{source} is larger than the whole media cache, not caching it")
+            return source
+        target_dir = os.path.join(self.directory, key)
+        os.makedirs(target_dir, exist_ok=True)
+        path = os.path.join(target_dir, os.path.basename(source))
+        shutil.move(source, path)
+        now = time.time()
+        with self._lock:
+            try:
+                self.db().execute(
+                    'INSERT OR REPLACE INTO media (key, path, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, path, size, now, now)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Media cache write failed for {key}: {repr(e)}")
+                return path
+        self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used files until the cache fits in max_bytes"""
+        with self._lock:
+            try:
+                db = self.db()
+                total = db.execute('SELECT COALESCE(SUM(size), 0) FROM media').fetchone()[0]
+                if total <= self.max_bytes:
+                    return
+                victims = []
+                for key, path, size in db.execute('SELECT key, path, size FROM media ORDER BY last_access'):
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((key, path))
+                    total -= size
+                db.executemany('DELETE FROM media WHERE key = ?', [(key,) for key, _ in victims])
+            except sqlite3.Error as e:
+                logger.warning(f"Media cache eviction failed: {repr(e)}")
+                return
+        for key, path in victims:
+            # Links already handed out in TEMP_DIR keep their data
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            logger.info(f"Evicted {path} from the media cache")
+
+    def free(self, needed):
+        """
+        Evict least recently used files until needed bytes of disk are freed,
+        returns the bytes freed. Files still linked from TEMP_DIR are skipped,
+        removing them would not give any space back.
+        """
+        freed = 0
+        victims = []
+        with self._lock:
+            try:
+                db = self.db()
+                for key, path, size in db.execute('SELECT key, path, size FROM media ORDER BY last_access'):
+                    if freed >= needed:
+                        break
+                    try:
+                        if os.stat(path).st_nlink > 1:
+                            continue
+                    except FileNotFoundError:
+                        pass
+                    victims.append((key, path))
+                    freed += size
+                db.executemany('DELETE FROM media WHERE key = ?', [(key,) for key, _ in victims])
+            except sqlite3.Error as e:
+                logger.warning(f"Media cache eviction failed: {repr(e)}")
+                return 0
+        for key, path in victims:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            logger.info(f"Evicted {path} from the media cache to free disk space")
+        return freed
+
+    @staticmethod
+    def handout_name(key, filename):
+        """
+        filename with the start of key in it. Files made from the same streams
+        with other recipes often share a name (e.g. 720p and 1080p renditions),
+        this keeps them from replacing each other where they are handed out.
+        """
+        stem, ext = os.path.splitext(filename)
+        return f'{stem}-{key[:8]}{ext}'
+
+    def link(self, key, path, directory):
+        """Make the file for key at path available in directory under its handout_name, returns the new path"""
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(directory):
+            return path
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, self.handout_name(key, os.path.basename(path)))
+        temp = f'{target}.{os.getpid()}.{threading.get_ident()}.link'
+        try:
+            os.link(path, temp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Cache and temp dir are on different filesystems
+            shutil.copyfile(path, temp)
+        os.replace(temp, target)
+        if os.path.lexists(temp):
+            # rename() is a no-op when target already is a link to the same file
+            os.remove(temp)
+        return target
+
+    def stats(self):
+        with self._lock:
+            try:
+                count, total = self.db().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media').fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read media cache state: {repr(e)}")
+                count, total = None, None
+        return {"enabled": self.enabled, "entries": count, "bytes": total, "max_bytes": self.max_bytes}
+
+
+class ProbeCache(SqliteStore):
+    """
+    Codecs ffprobe found in streams, keyed by itag. An itag always stands for
+    the same format, so a stream only has to be probed once per server.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS probes (
+            itag INTEGER PRIMARY KEY,
+            codecs TEXT NOT NULL,
+            created REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, name='metadata.sqlite3'):
+        super().__init__(name)
+        self._memory = {}
+
+    def get(self, itag):
+        """The codecs recorded for itag as a dict, or None"""
+        if itag in self._memory:
+            return self._memory[itag]
+        with self._lock:
+            try:
+                row = self.db().execute('SELECT codecs FROM probes WHERE itag = ?', (itag,)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Probe cache read failed for itag {itag}: {repr(e)}")
+                return None
+        if row:
+            self._memory[itag] = json.loads(row[0])
+        return self._memory.get(itag)
+
+    def set(self, itag, codecs):
+        self._memory[itag] = codecs
+        with self._lock:
+            try:
+                self.db().execute(
+                    'INSERT OR REPLACE INTO probes (itag, codecs, created) VALUES (?, ?, ?)',
+                    (itag, json.dumps(codecs), time.time())
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Probe cache write failed for itag {itag}: {repr(e)}")
+
+
+metadata_cache = MetadataCache()
+negative_cache = NegativeCache()
+media_cache = MediaCache()
+probe_cache = ProbeCache()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager
+from cache import SqliteStore, media_cache
+from ratelimit import Overloaded
+from settings import TEMP_DIR, DISK_MIN_FREE, DISK_MAX_WAIT, DISK_RESERVATION_TTL
+
+logger = logging.getLogger(__name__)
+
+# How often a download waiting for disk space checks again
+_POLL_INTERVAL = 2
+
+
+class DiskFull(Overloaded):
+    """Not enough disk space is free, or coming free, for a download right now"""
+
+
+def allocated(path):
+    """Bytes of disk the files under path take up, sparse preallocated files count what was written"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def footprint(video_stream, audio_stream=None, subtitled=False, transcoded=False):
+    """
+    Peak disk use of building a file from the streams. Each ffmpeg step
+    (mux, subtitles, transcode) writes its output next to its input and then
+    deletes the input, so at most two copies exist at any time.
+    """
+    size = sum(stream.filesize_approx or 0 for stream in (video_stream, audio_stream) if stream)
+    return size * 2 if audio_stream or subtitled or transcoded else size
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DiskBudget(SqliteStore):
+    """
+    Disk space in TEMP_DIR reserved by the downloads of every hypercorn worker.
+
+    A build reserves its projected footprint before it starts writing and
+    releases it when done. What a reservation still needs is its size minus
+    what has already been written under its directory, so free space is not
+    counted twice. Reservations of processes that died are dropped.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS reservations (
+            id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            owner TEXT NOT NULL,
+            created REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, name='disk.sqlite3', directory=TEMP_DIR, min_free=DISK_MIN_FREE, ttl=DISK_RESERVATION_TTL):
+        super().__init__(name)
+        self.directory = directory
+        self.min_free = min_free
+        self.ttl = ttl
+        self.counters = {'granted': 0, 'waited': 0, 'rejected': 0, 'evicted_bytes': 0}
+
+    def usage(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return shutil.disk_usage(self.directory)
+
+    def capacity(self):
+        """Most bytes a single download could ever be given"""
+        return self.usage().total - self.min_free
+
+    def try_reserve(self, path, size):
+        """Reserve size bytes for files written under path. Returns (reservation id, 0) or (None, bytes short)"""
+        needed = max(0, size - allocated(path))
+        with self._lock:
+            db = self.db()
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                self._expire(db)
+                available = self.usage().free - self.min_free - self._outstanding(db)
+                if needed > available:
+                    db.execute('COMMIT')
+                    return None, needed - available
+                reservation = uuid.uuid4().hex
+                db.execute(
+                    'INSERT INTO reservations (id, path, bytes, owner, created) VALUES (?, ?, ?, ?, ?)',
+                    (reservation, path, size, f'{socket.gethostname()}:{os.getpid()}', time.time())
+                )
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                raise
+        return reservation, 0
+
+    def release(self, reservation):
+        with self._lock:
+            try:
+                self.db().execute('DELETE FROM reservations WHERE id = ?', (reservation,))
+            except sqlite3.Error as e:
+                logger.warning(f"Could not release disk reservation {reservation}: {repr(e)}")
+
+    async def reserve(self, path, size, max_wait=DISK_MAX_WAIT):
+        """
+        Reserve size bytes for path, evicting cold media cache files and then
+        waiting for other downloads to finish when the disk is tight. Raises
+        DiskFull after max_wait seconds.
+        """
+        deadline = time.monotonic() + max_wait
+        waited = False
+        while True:
+            reservation, short = await asyncio.to_thread(self.try_reserve, path, size)
+            if reservation:
+                self.counters['granted'] += 1
+                return reservation
+            freed = await asyncio.to_thread(media_cache.free, short)
+            self.counters['evicted_bytes'] += freed
+            if freed:
+                continue
+            if time.monotonic() + _POLL_INTERVAL > deadline:
+                self.counters['rejected'] += 1
+                raise DiskFull("Not enough disk space on the server right now, please try again later.", max_wait)
+            if not waited:
+                waited = True
+                self.counters['waited'] += 1
+                logger.info(f"Waiting for {short / 1024 ** 2:.0f}MB of disk space to free up for {path}")
+            await asyncio.sleep(_POLL_INTERVAL)
+
+    @asynccontextmanager
+    async def reservation(self, path, size):
+        reservation = await self.reserve(path, size)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.release, reservation)
+
+    def _outstanding(self, db):
+        """Bytes reservations still have to write"""
+        rows = db.execute('SELECT path, bytes FROM reservations').fetchall()
+        return sum(max(0, size - allocated(path)) for path, size in rows)
+
+    def _expire(self, db):
+        host = socket.gethostname()
+        stale = []
+        for reservation, owner, created in db.execute('SELECT id, owner, created FROM reservations'):
+            owner_host, _, pid = owner.rpartition(':')
+            if created < time.time() - self.ttl or (owner_host == host and not _alive(int(pid))):
+                stale.append((reservation,))
+        db.executemany('DELETE FROM reservations WHERE id = ?', stale)
+
+    def stats(self):
+        with self._lock:
+            try:
+                db = self.db()
+                count, reserved = db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM reservations').fetchone()
+                outstanding = self._outstanding(db)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read disk reservations: {repr(e)}")
+                count = reserved = outstanding = None
+        return {
+            "free": self.usage().free,
+            "min_free": self.min_free,
+            "reservations": count,
+            "reserved": reserved,
+            "outstanding": outstanding,
+            **self.counters
+        }
+
+
+disk_budget = DiskBudget()
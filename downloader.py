@@ -0,0 +1,406 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+import egress
+import progress
+from settings import DOWNLOAD_CONNECTIONS, DOWNLOAD_SEGMENT_SIZE, DOWNLOAD_RANGE_RETRIES, PARTIAL_DOWNLOAD_TTL
+
+try:
+    import fcntl
+except ImportError:  # Windows, partials aren't protected against concurrent writers
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Size of each read from a range response, also how often progress and stop are checked
+_READ_SIZE = 64 * 1024
+# Socket timeout for a single range request
+_TIMEOUT = 30
+# Headers pytubefix sends with its own stream requests
+_HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+# Minimum time between two checkpoint writes while ranges are in flight
+_CHECKPOINT_INTERVAL = 2
+# How often a download waits on another process writing the same partial
+_LOCK_POLL_INTERVAL = 0.5
+
+
+class DownloadInterrupted(Exception):
+    """The download was stopped from outside before it finished"""
+
+
+def connections_for(route=None):
+    """Number of parallel range requests to use through route (default: the current egress)"""
+    route = route if route is not None else egress.current()
+    if route is None:
+        return DOWNLOAD_CONNECTIONS['direct']
+    return DOWNLOAD_CONNECTIONS['tor' if route.is_tor else 'proxy']
+
+
+def _segments(size, segment_size):
+    return [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+
+def _open_range(url, start, end):
+    # The range query parameter is what googlevideo (and pytubefix) use instead of a Range header
+    return urlopen(Request(f'{url}&range={start}-{end}', headers=_HEADERS, method='GET'), timeout=_TIMEOUT)
+
+
+def streamable(stream):
+    """True if stream can be fetched by byte ranges (known size, not SABR or OTF)"""
+    try:
+        size = stream.filesize
+    except Exception:
+        return False
+    return bool(size) and not getattr(stream, 'is_sabr', False) and not getattr(stream, 'is_otf', False)
+
+
+
+async def all_streamable(*streams):
+    """streamable for every stream given (None skipped), off the event loop since Stream.filesize may ask googlevideo"""
+    return await asyncio.to_thread(lambda: all(streamable(stream) for stream in streams if stream))
+
+def iter_stream(stream, start=0, end=None, stop=None, segment_size=DOWNLOAD_SEGMENT_SIZE, retries=DOWNLOAD_RANGE_RETRIES):
+    """
+    Yield the bytes start to end (inclusive) of stream as they arrive, without touching disk.
+
+    Bytes are requested one segment at a time, the size googlevideo serves
+    without throttling, and a broken segment is retried from the last byte
+    that came through.
+    """
+    end = stream.filesize - 1 if end is None else end
+    offset = start
+    while offset <= end:
+        segment_end = min(offset + segment_size, end + 1) - 1
+        for attempt in range(retries + 1):
+            try:
+                with _open_range(stream.url, offset, segment_end) as response:
+                    while offset <= segment_end:
+                        if stop is not None and stop.is_set():
+                            raise DownloadInterrupted(f"Streaming of {stream.default_filename} was interrupted")
+                        chunk = response.read(min(_READ_SIZE, segment_end + 1 - offset))
+                        if not chunk:
+                            break
+                        offset += len(chunk)
+                        yield chunk
+                if offset <= segment_end:
+                    raise IOError(f"Range {offset}-{segment_end} ended early")
+                break
+            except DownloadInterrupted:
+                raise
+            except Exception as e:
+                if attempt == retries:
+                    logger.error(f"Streaming {stream.default_filename} failed at byte {offset}: {repr(e)}")
+                    raise
+                logger.warning(f"Streaming range failed at byte {offset} (attempt {attempt + 1}): {repr(e)}, retrying")
+                time.sleep(min(2 ** attempt, 8))
+
+
+def _video_id(stream):
+    youtube = getattr(stream._monostate, 'youtube', None)
+    if youtube is not None and getattr(youtube, 'video_id', None):
+        return youtube.video_id
+    # googlevideo urls carry their own opaque id for the video
+    return parse_qs(urlparse(stream.url).query).get('id', [None])[0]
+
+
+class Checkpoint:
+    """
+    Sidecar of a .part file recording how far each segment got.
+
+    An offset is only written here after the bytes before it were flushed to
+    disk, so a resumed download can trust everything the checkpoint covers.
+    """
+
+    def __init__(self, path, video_id, itag, size, segment_size):
+        self.path = path
+        self.video_id = video_id
+        self.itag = itag
+        self.size = size
+        self.segment_size = segment_size
+        self.offsets = {}  # segment start -> first byte not on disk yet
+        self.saved = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, video_id, itag, size, segment_size):
+        """Checkpoint at path, or None when missing, unreadable or for a different stream"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        checkpoint = cls(path, video_id, itag, size, segment_size)
+        if (data.get('video_id'), data.get('itag'), data.get('content_length'), data.get('segment_size')) != \
+                (video_id, itag, size, segment_size):
+            logger.info(f"Checkpoint {path} belongs to another stream, starting over")
+            return None
+        checkpoint.offsets = {int(start): int(offset) for start, offset in data.get('offsets', [])}
+        return checkpoint
+
+    def offset(self, start):
+        with self._lock:
+            return self.offsets.get(start, start)
+
+    def advance(self, start, offset):
+        with self._lock:
+            self.offsets[start] = offset
+
+    def remaining(self, segments):
+        """Segments not fully on disk, as (start, resume offset, end)"""
+        return [(start, self.offset(start), end) for start, end in segments if self.offset(start) <= end]
+
+    def save(self, fd, force=False):
+        """Flush the data file, then record the offsets. Throttled unless force is set"""
+        now = time.monotonic()
+        if not force and now - self.saved < _CHECKPOINT_INTERVAL:
+            return
+        self.saved = now
+        with self._lock:
+            offsets = sorted(self.offsets.items())
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+        data = {
+            'video_id': self.video_id,
+            'itag': self.itag,
+            'content_length': self.size,
+            'segment_size': self.segment_size,
+            'offsets': offsets
+        }
+        temp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, self.path)
+
+
+class RangedDownload:
+    """
+    Download a pytubefix Stream over several connections at once.
+
+    The file is split into byte ranges fetched in parallel and written in
+    place with os.pwrite into a preallocated .part file. A failed range is
+    retried on its own from where it stopped, so one bad connection doesn't
+    restart the whole transfer. Progress is checkpointed next to the .part
+    file, and a later download of the same video and itag (in any worker, even
+    after a restart and with a freshly signed url) picks up from there.
+    Every connection goes out through the egress bound when the download
+    started: googlevideo urls are signed for the ip that resolved them, so
+    the ranges of one stream can't be spread over different exits.
+    """
+
+    def __init__(self, stream, path, connections=None, segment_size=DOWNLOAD_SEGMENT_SIZE,
+                 retries=DOWNLOAD_RANGE_RETRIES, on_progress=None, stop=None):
+        self.stream = stream
+        self.url = stream.url
+        self.size = stream.filesize
+        self.path = path
+        self.connections = connections or connections_for()
+        self.segment_size = segment_size
+        self.retries = retries
+        self.on_progress = on_progress
+        self.stop = stop or threading.Event()
+        self.downloaded = 0
+        self.checkpoint = None
+        self._progress_lock = threading.Lock()
+        self._logged_percent = 0
+
+    def run(self):
+        """Download the whole stream into path, returns path"""
+        started = time.monotonic()
+        part = f'{self.path}.part'
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._lock(fd)
+            if self.stream.exists_at_path(self.path):
+                # Another worker finished it while we waited for the lock
+                return self.path
+            segments = self._prepare(fd, part)
+            workers = min(self.connections, len(segments)) or 1
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='range') as pool:
+                # Each range thread needs its own copy of the context to see the request's egress
+                futures = [
+                    pool.submit(contextvars.copy_context().run, self._fetch_segment, fd, start, offset, end)
+                    for start, offset, end in segments
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    self.stop.set()
+                    raise
+                finally:
+                    # Keep whatever made it to disk for the next attempt
+                    pool.shutdown(wait=True)
+                    self.checkpoint.save(fd, force=True)
+            os.replace(part, self.path)
+            os.remove(self.checkpoint.path)
+        finally:
+            os.close(fd)
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Downloaded {self.size} bytes over {workers} connection(s) in {elapsed:.1f}s "
+            f"({self.size / max(elapsed, 0.001) / 1_048_576:.2f} MiB/s): {self.path}"
+        )
+        return self.path
+
+    def _lock(self, fd):
+        """Wait until no other process is writing this partial"""
+        if fcntl is None:
+            return
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if self.stop.is_set():
+                    raise DownloadInterrupted(f"Download of {self.path} was interrupted")
+                time.sleep(_LOCK_POLL_INTERVAL)
+
+    def _prepare(self, fd, part):
+        """Load or start the checkpoint, returns the segments left to fetch"""
+        segments = _segments(self.size, self.segment_size)
+        sidecar = f'{part}.json'
+        video_id, itag = _video_id(self.stream), self.stream.itag
+        if os.fstat(fd).st_size == self.size:
+            self.checkpoint = Checkpoint.load(sidecar, video_id, itag, self.size, self.segment_size)
+        if self.checkpoint is None:
+            self.checkpoint = Checkpoint(sidecar, video_id, itag, self.size, self.segment_size)
+            self._preallocate(fd)
+            self.checkpoint.save(fd, force=True)
+        remaining = self.checkpoint.remaining(segments)
+        self.downloaded = self.size - sum(end + 1 - offset for _, offset, end in remaining)
+        if self.downloaded:
+            logger.info(f"Resuming {self.path} at {self.downloaded} of {self.size} bytes")
+        return remaining
+
+    def _preallocate(self, fd):
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+                return
+            except OSError:
+                pass  # Not supported by the filesystem, a sparse file works as well
+        os.ftruncate(fd, self.size)
+
+    def _fetch_segment(self, fd, start, offset, end):
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch_range(fd, start, self.checkpoint.offset(start), end)
+                return
+            except DownloadInterrupted:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Range {start}-{end} failed after {attempt + 1} attempts: {repr(e)}")
+                    raise
+                logger.warning(f"Range {start}-{end} failed (attempt {attempt + 1}): {repr(e)}, retrying")
+                time.sleep(min(2 ** attempt, 8))
+
+    def _fetch_range(self, fd, start, offset, end):
+        with _open_range(self.url, offset, end) as response:
+            while offset <= end:
+                if self.stop.is_set():
+                    raise DownloadInterrupted(f"Download of {self.path} was interrupted")
+                chunk = response.read(min(_READ_SIZE, end + 1 - offset))
+                if not chunk:
+                    break
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                self.checkpoint.advance(start, offset)
+                self.checkpoint.save(fd)
+                self._advance(len(chunk))
+        if offset <= end:
+            raise IOError(f"Range {start}-{end} ended early at byte {offset}")
+
+    def _advance(self, amount):
+        with self._progress_lock:
+            self.downloaded += amount
+            downloaded = self.downloaded
+            percent = downloaded * 100 // self.size // 10 * 10
+            log = percent > self._logged_percent
+            if log:
+                self._logged_percent = percent
+        if log:
+            logger.debug(f"{os.path.basename(self.path)}: {percent}% of {self.size} bytes")
+        if self.on_progress:
+            self.on_progress(downloaded, self.size)
+        else:
+            progress.stream_progress(self.stream, downloaded, self.size)
+
+
+def download(stream, output_path=None, on_progress=None, stop=None, connections=None):
+    """
+    Download stream like Stream.download, over several connections when it is worth it.
+
+    Streams of unknown size, SABR streams and anything smaller than one
+    segment fall back to the stream's own single connection download.
+    """
+    try:
+        size = stream.filesize
+    except Exception:
+        size = 0
+    path = stream.get_file_path(output_path=output_path, file_system='ext4')
+    if size and stream.exists_at_path(path):
+        logger.debug(f"{path} already exists, skipping")
+        return path
+
+    if getattr(stream, 'is_sabr', False) or size <= DOWNLOAD_SEGMENT_SIZE:
+        interrupt_checker = stop.is_set if stop is not None else None
+        path = stream.download(output_path=output_path, interrupt_checker=interrupt_checker)
+        if path is None:
+            raise DownloadInterrupted(f"Download of {stream.default_filename} was interrupted")
+        return path
+
+    return RangedDownload(stream, path, connections=connections, on_progress=on_progress, stop=stop).run()
+
+
+def reclaim_partials(directory, max_age=PARTIAL_DOWNLOAD_TTL):
+    """
+    Delete partial downloads and their checkpoints untouched for max_age seconds,
+    along with build directories left empty. Returns how many partials went.
+    """
+    now = time.time()
+    reclaimed = 0
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for filename in files:
+            if filename.endswith('.part') and _reclaim_partial(os.path.join(root, filename), now, max_age):
+                reclaimed += 1
+        if root != directory and not os.listdir(root) and now - os.path.getmtime(root) >= max_age:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass  # Picked up by a new build in the meantime
+    return reclaimed
+
+
+def _reclaim_partial(part, now, max_age):
+    sidecar = f'{part}.json'
+    try:
+        modified = max(os.path.getmtime(p) for p in (part, sidecar) if os.path.exists(p))
+        if now - modified < max_age:
+            return False
+        fd = os.open(part, os.O_RDONLY)
+        try:
+            if fcntl is not None:
+                # Still being written by some worker
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(part)
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            logger.info(f"Reclaimed stale partial download {part}")
+            return True
+        finally:
+            os.close(fd)
+    except BlockingIOError:
+        return False
+    except OSError as e:
+        logger.error(f"Failed to reclaim {part}: {repr(e)}")
+        return False
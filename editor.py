@@ -1,138 +1,410 @@
 import os
+import asyncio
+import collections
+import csv
 import logging
-import shutil
-import subprocess
+import re
+import resource
+import signal
 from languagecodes import iso_639_alpha3
-from settings import CODECS
+from planner import codec_args, PRESETS
+from settings import CODECS, ENCODE_NICE, FFMPEG_TIMEOUT, FFMPEG_CPU_LIMIT, FFMPEG_STDERR_LINES
+import progress
 
 logger = logging.getLogger(__name__)
 
-def combine_video_and_audio(video_path, audio_path, output_path):
+# Start and end times of an SRT cue
+_SRT_TIMING = re.compile(r'(\d+):(\d\d):(\d\d)[,.](\d{3})\s*-->\s*(\d+):(\d\d):(\d\d)[,.](\d{3})')
+
+
+class FfmpegError(Exception):
+    """An ffmpeg run failed, was killed for going over its limits or could not start"""
+
+    def __init__(self, message, returncode=None, stderr=''):
+        super().__init__(f"{message}: {stderr}" if stderr else message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def _limit_cpu(pid, cpu_limit):
+    # Set from outside once it runs, a preexec_fn isn't safe in a process with threads
+    try:
+        # The kernel sends SIGXCPU at the soft limit and SIGKILL at the hard one
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+    except ProcessLookupError:
+        pass  # Done already
+
+
+def _children_cpu():
+    """CPU seconds used by the child processes reaped so far"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None  # N/A before the first frame
+
+
+def progress_event(state):
+    """Event of one -progress report (its key=value pairs in state)"""
+    out_time = state.get('out_time_us', state.get('out_time_ms', ''))
+    return {
+        'frame': int(state['frame']) if state.get('frame', '').isdigit() else None,
+        'fps': _number(state.get('fps')),
+        'out_time': int(out_time) / 1_000_000 if out_time.isdigit() else None,
+        'speed': _number(state.get('speed', '').rstrip('x')),
+        'total_size': int(state['total_size']) if state.get('total_size', '').isdigit() else None,
+        'done': state.get('progress') == 'end',
+    }
+
+
+def _report_to_job(event):
+    progress.encode_progress(event['out_time'], event['speed'])
+
+
+async def collect_stderr(stream, tail):
+    """Read stream until it ends, keeping its last lines (as many as tail, a deque, holds)"""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        tail.append(line.decode(errors='replace').rstrip())
+
+
+async def kill_process_group(process):
+    """Kill process and everything it started, then reap it"""
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def run_ffmpeg(command, nice=0, report=None, timeout=FFMPEG_TIMEOUT, cpu_limit=FFMPEG_CPU_LIMIT):
     """
-    Add audio to a video file using ffmpeg.
+    Run an ffmpeg command, raising FfmpegError if it fails.
 
-    :param video_path: Path to the input video file.
-    :param audio_path: Path to the audio file (e.g., .mp3).
-    :param output_path: Path where the output video with audio will be saved.
-    :return: Path to the combined output file
+    Its -progress output is parsed into events (see progress_event) handed
+    to report, by default turned into the current job's encode progress.
+    nice lowers its CPU priority. It is killed, along with every process it
+    started, once it runs longer than timeout seconds or uses more than
+    cpu_limit seconds of CPU (0 for no limit), and when the awaiting task
+    is cancelled, e.g. because the client went away. Only the last lines of
+    its stderr are kept, for the error.
+    """
+    report = report or _report_to_job
+    command = [command[0], '-progress', 'pipe:1', '-nostats'] + command[1:]
+    if nice:
+        command = ['nice', '-n', str(nice)] + command
+    cpu_before = _children_cpu()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # A group of its own, so nothing it spawns outlives a kill
+            start_new_session=True
+        )
+    except OSError as e:
+        raise FfmpegError(f"Could not start {command[0]}: {e}") from e
+    if cpu_limit:
+        _limit_cpu(process.pid, cpu_limit)
+
+    tail = collections.deque(maxlen=FFMPEG_STDERR_LINES)
+    stderr = asyncio.ensure_future(collect_stderr(process.stderr, tail))
+    try:
+        async with asyncio.timeout(timeout or None):
+            state = {}
+            while line := await process.stdout.readline():
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                state[key] = value
+                # Every report ends with a progress=continue|end line
+                if key == 'progress':
+                    report(progress_event(state))
+                    state = {}
+            returncode = await process.wait()
+            await stderr
+    except TimeoutError:
+        await kill_process_group(process)
+        raise FfmpegError(f"ffmpeg ran longer than {timeout}s and was killed", process.returncode, '\n'.join(tail)) from None
+    except BaseException:
+        # Cancelled: nobody wants the output any more
+        await kill_process_group(process)
+        raise
+    finally:
+        stderr.cancel()
+
+    # A SIGKILL may also come from the OOM killer, it only is the hard CPU limit if that much CPU went by
+    over_cpu = cpu_limit and _children_cpu() - cpu_before >= cpu_limit
+    if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and over_cpu):
+        raise FfmpegError(f"ffmpeg used more than {cpu_limit}s of CPU and was killed", returncode, '\n'.join(tail))
+    if returncode == -signal.SIGKILL:
+        raise FfmpegError("ffmpeg was killed, most likely for running out of memory", returncode, '\n'.join(tail))
+    if returncode:
+        raise FfmpegError(f"ffmpeg exited with {returncode}", returncode, '\n'.join(tail))
+
+
+async def cut_clip(inputs, output_path, start, end, exact=False, plan=None):
+    """
+    Cut start to end (in seconds) out of inputs using ffmpeg.
+
+    :param inputs: Urls or paths of the source, a video and an audio input or a single one.
+    :param output_path: Path where the clip will be saved.
+    :param start: Start of the clip in seconds.
+    :param end: End of the clip in seconds.
+    :param exact: Re-encode the video so the clip starts exactly at start instead of at the keyframe before it.
+    :param plan: Codecs to use, from planner.plan
+    :return: Path to the clip
     """
-    # Ensure output directory exists
-    output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-        logger.info(f"Created directory: {output_dir}")
-    
     if os.path.exists(output_path):
         logger.info("Deleting existing output file " + output_path)
         os.remove(output_path)
-    
-    # Convert to absolute paths
-    video_path = os.path.abspath(video_path)
-    audio_path = os.path.abspath(audio_path)
-    output_path = os.path.abspath(output_path)
-    
-    # FFmpeg command to combine video and audio
-    ffmpeg_command = [
-        'ffmpeg',
-        '-i', video_path,
-        '-i', audio_path,
-        '-c:v', 'copy',
-        '-c:a', CODECS[1],
-        '-preset', 'fast',
-        '-tune', 'film',
-        output_path
-    ]
-    
-    logger.info(f"Combining audio from {audio_path} with video {video_path}")
-    # Run the FFmpeg command
-    subprocess.run(ffmpeg_command, check=True)
-    
-    # Verify output file was created
+
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-nostdin']
+    for source in inputs:
+        # Seeking on the input only reads the byte ranges around the clip
+        ffmpeg_command += ['-ss', f'{start:.3f}', '-t', f'{end - start:.3f}', '-i', source]
+    if plan is None:
+        plan = {'video': 'libx264' if exact else 'copy', 'audio': CODECS[1] if len(inputs) == 2 else 'copy', 'subtitle': None}
+    if len(inputs) == 2:
+        ffmpeg_command += ['-map', '0:v:0', '-map', '1:a:0']
+    ffmpeg_command += codec_args(plan)
+    ffmpeg_command += ['-avoid_negative_ts', 'make_zero', output_path]
+
+    logger.info(f"Cutting {start}s-{end}s out of {len(inputs)} input(s) into {output_path} as {plan}")
+    await run_ffmpeg(ffmpeg_command, nice=ENCODE_NICE if plan['video'] not in (None, 'copy') else 0)
+
     if os.path.isfile(output_path):
-        logger.info(f"Video and audio combined successfully. Output file: {output_path}")
-        
-        # Delete the original video and audio files
-        if os.path.exists(video_path):
-            os.remove(video_path)
-            logger.info(f"Deleted original video file: {video_path}")
-        
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-            logger.info(f"Deleted audio file: {audio_path}")
-        
         return output_path
-    else:
-        logger.error(f"Output file {output_path} was not created")
-        raise Exception(f"Failed to create combined video at {output_path}")
+    logger.error(f"Output file {output_path} was not created")
+    raise Exception(f"Failed to create clip at {output_path}")
 
-    
 
-def add_subtitles(video_path, subtitle_path, output_path, burn=True, lang_code="en"):
+async def render_video(video_path, output_path, audio_path=None, subtitle_path=None, burn=True, lang_code="en", plan=None):
     """
-    Add subtitles to a video file using ffmpeg.
+    Mux audio and add subtitles to a video file in a single ffmpeg run.
+
+    plan (see planner.plan) says which streams are copied and which are
+    transcoded. Without one, video is only re-encoded when subtitles are
+    burned in, separate audio is converted to CODECS[1] and subtitles go in
+    as a mov_text track.
 
     :param video_path: Path to the input video file.
-    :param subtitle_path: Path to the subtitle file (e.g., .srt).
-    :param output_path: Path where the output video with subtitles will be saved.
+    :param output_path: Path where the final video will be saved.
+    :param audio_path: Path to a separate audio file, None when the video has its own audio.
+    :param subtitle_path: Path to the subtitle file (.srt), None for no subtitles.
     :param burn: Whether to burn subtitles into video or add as separate track
     :param lang_code: Language code for subtitle track
+    :param plan: Codecs to use, from planner.plan
     :return: Path to the output file
     """
-    # Ensure output directory exists
     output_dir = os.path.dirname(output_path)
     if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
-        logger.info(f"Created directory: {output_dir}")
-    
+
     if os.path.exists(output_path):
         logger.info("Deleting existing output file " + output_path)
         os.remove(output_path)
-    
-    # Convert to absolute paths
+
     video_path = os.path.abspath(video_path)
-    subtitle_path = os.path.abspath(subtitle_path)
     output_path = os.path.abspath(output_path)
-    
-    # FFmpeg command to combine video and subtitle
-    ffmpeg_command = [
-        'ffmpeg',
-        '-i', video_path,
-        '-vf', f"subtitles='{subtitle_path}':force_style='Alignment=2'",
-        '-crf', '18',
-        '-preset', 'fast',
-        '-tune', 'film',
-        output_path
-    ]
-    
-    if not burn:
+    inputs = [video_path]
+    if audio_path:
+        audio_path = os.path.abspath(audio_path)
+        inputs.append(audio_path)
+    soft_subtitles = subtitle_path and not burn
+    if subtitle_path:
+        subtitle_path = os.path.abspath(subtitle_path)
+        if soft_subtitles:
+            inputs.append(subtitle_path)
+
+    ffmpeg_command = ['ffmpeg']
+    for source in inputs:
+        ffmpeg_command += ['-i', source]
+    if plan is None:
+        plan = {
+            'video': 'libx264' if subtitle_path and burn else 'copy',
+            'audio': CODECS[1] if audio_path else 'copy',
+            'subtitle': 'mov_text' if soft_subtitles else None
+        }
+    ffmpeg_command += ['-map', '0:v:0', '-map', '1:a:0' if audio_path else '0:a?']
+    if soft_subtitles:
+        ffmpeg_command += ['-map', f'{len(inputs) - 1}:s:0']
+    if subtitle_path and burn:
+        ffmpeg_command += ['-vf', f"subtitles='{subtitle_path}':force_style='Alignment=2'"]
+    ffmpeg_command += codec_args(plan)
+    if soft_subtitles:
         lang_code = iso_639_alpha3(lang_code.replace("a.", ""))
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', video_path,
-            '-i', subtitle_path,
-            '-c', 'copy',
-            '-c:s', 'mov_text',
-            '-metadata:s:s:0', f'language={lang_code}',
-            output_path
-        ]
-
-    logger.info(f"Adding subtitles from {subtitle_path} to {video_path}... with presets burn={burn} and lang: {lang_code}")
-    
-    # Run the FFmpeg command
-    subprocess.run(ffmpeg_command, check=True)
-    
-    # Verify output file was created
+        ffmpeg_command += ['-metadata:s:s:0', f'language={lang_code}']
+    ffmpeg_command.append(output_path)
+
+    logger.info(f"Rendering {video_path} with audio={audio_path} subtitles={subtitle_path} burn={burn} as {plan} in one pass")
+    await run_ffmpeg(ffmpeg_command, nice=ENCODE_NICE if plan['video'] not in (None, 'copy') else 0)
+
     if os.path.isfile(output_path):
-        logger.info(f"Video and subtitle combined successfully. Output file: {output_path}")
-        
-        # Delete the original video file
-        if os.path.exists(video_path):
-            os.remove(video_path)
-            logger.info(f"Deleted original video file: {video_path}")
-        
+        logger.info(f"Video rendered successfully. Output file: {output_path}")
+        for source in (video_path, audio_path):
+            if source and os.path.exists(source):
+                os.remove(source)
+                logger.info(f"Deleted input file: {source}")
         return output_path
     else:
         logger.error(f"Output file {output_path} was not created")
-        raise Exception(f"Failed to create subtitled video at {output_path}")
+        raise Exception(f"Failed to render video at {output_path}")
+
+
+def _srt_time(seconds):
+    millis = round(seconds * 1000)
+    return f"{millis // 3_600_000:02d}:{millis // 60_000 % 60:02d}:{millis // 1000 % 60:02d},{millis % 1000:03d}"
+
+
+def shift_subtitles(subtitle_path, output_path, start, end=None):
+    """
+    Write the cues of the .srt at subtitle_path that show between start and
+    end (in seconds) to output_path, timed from start. Returns how many.
+    """
+    with open(subtitle_path, encoding='utf-8-sig') as file:
+        blocks = re.split(r'\n\s*\n', file.read().replace('\r\n', '\n').strip())
+    cues = []
+    for block in blocks:
+        lines = block.split('\n')
+        for index, line in enumerate(lines):
+            timing = _SRT_TIMING.search(line)
+            if timing:
+                break
+        else:
+            continue
+        h1, m1, s1, ms1, h2, m2, s2, ms2 = (int(value) for value in timing.groups())
+        shown = h1 * 3600 + m1 * 60 + s1 + ms1 / 1000
+        hidden = h2 * 3600 + m2 * 60 + s2 + ms2 / 1000
+        if hidden <= start or (end is not None and shown >= end):
+            continue
+        text = '\n'.join(lines[index + 1:])
+        cues.append(f"{len(cues) + 1}\n{_srt_time(max(0, shown - start))} --> {_srt_time(hidden - start)}\n{text}")
+    with open(output_path, 'w', encoding='utf-8') as file:
+        file.write('\n\n'.join(cues) + '\n')
+    return len(cues)
+
+
+async def split_at_keyframes(video_path, output_dir, duration, count):
+    """
+    Split video_path into about count pieces of equal length without re-encoding.
+
+    Each cut lands on the first keyframe at or after its even split point,
+    so every piece decodes on its own and none overlap. Returns a list of
+    (path, start, end) with start and end in seconds of the input, which is
+    deleted once split.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    extension = os.path.splitext(video_path)[1]
+    listing = os.path.join(output_dir, 'segments.csv')
+    cuts = ','.join(f'{duration * index / count:.3f}' for index in range(1, count))
+    ffmpeg_command = [
+        'ffmpeg', '-hide_banner', '-nostdin', '-i', video_path,
+        '-map', '0', '-c', 'copy',
+        '-f', 'segment', '-segment_times', cuts, '-reset_timestamps', '1',
+        '-segment_list', listing, '-segment_list_type', 'csv',
+        os.path.join(output_dir, f'segment_%03d{extension}')
+    ]
+    logger.info(f"Splitting {video_path} into {count} pieces at keyframes")
+    await run_ffmpeg(ffmpeg_command, report=lambda event: None)
+
+    with open(listing, newline='') as file:
+        segments = [(os.path.join(output_dir, os.path.basename(name)), float(start), float(end))
+                    for name, start, end in csv.reader(file)]
+    os.remove(listing)
+    os.remove(video_path)
+    return segments
+
+
+async def burn_segment(video_path, subtitle_path, output_path, plan, report=None):
+    """
+    Burn the subtitles at subtitle_path into one piece from split_at_keyframes,
+    with the video encoder of plan. Its audio, if any, is copied. A piece
+    without subtitles (subtitle_path None) is only re-encoded, so all pieces
+    can be joined.
+    """
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-nostdin', '-i', video_path, '-map', '0:v:0', '-map', '0:a?']
+    if subtitle_path:
+        ffmpeg_command += ['-vf', f"subtitles='{subtitle_path}':force_style='Alignment=2'"]
+    ffmpeg_command += codec_args({'video': plan['video'], 'audio': 'copy', 'subtitle': None})
+    ffmpeg_command.append(output_path)
+    await run_ffmpeg(ffmpeg_command, nice=ENCODE_NICE, report=report)
 
-    
+    if not os.path.isfile(output_path):
+        raise Exception(f"Failed to burn subtitles into {video_path}")
+    os.remove(video_path)
+    return output_path
+
+
+async def concat_segments(segment_paths, output_path, audio_path=None, plan=None):
+    """
+    Join pieces made by burn_segment, in order, with the concat demuxer and
+    no re-encoding, muxing in audio_path when given. Audio is converted as
+    plan says; the pieces and audio_path are deleted once joined.
+    """
+    listing = f'{output_path}.txt'
+    with open(listing, 'w') as file:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            file.write(f"file '{escaped}'\n")
+
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-nostdin', '-f', 'concat', '-safe', '0', '-i', listing]
+    if audio_path:
+        ffmpeg_command += ['-i', audio_path]
+    ffmpeg_command += ['-map', '0:v:0', '-map', '1:a:0' if audio_path else '0:a?']
+    ffmpeg_command += codec_args({'video': 'copy', 'audio': (plan or {}).get('audio') or 'copy', 'subtitle': None})
+    ffmpeg_command.append(output_path)
+
+    logger.info(f"Joining {len(segment_paths)} pieces with audio={audio_path} into {output_path}")
+    try:
+        await run_ffmpeg(ffmpeg_command, report=lambda event: None)
+    finally:
+        os.remove(listing)
+
+    if not os.path.isfile(output_path):
+        raise Exception(f"Failed to join pieces into {output_path}")
+    for source in [*segment_paths, audio_path]:
+        if source and os.path.exists(source):
+            os.remove(source)
+    return output_path
+
+
+async def transcode(inputs, output_path, preset):
+    """
+    Make output_path from inputs with the ffmpeg options of a planner.PRESETS entry.
+
+    :param inputs: Paths of a video and an audio file, or of a single file.
+    :param output_path: Path where the result will be saved.
+    :param preset: Name of the preset.
+    :return: Path to the output file
+    """
+    if os.path.exists(output_path):
+        logger.info("Deleting existing output file " + output_path)
+        os.remove(output_path)
+
+    settings = PRESETS[preset]
+    ffmpeg_command = ['ffmpeg', '-hide_banner', '-nostdin']
+    for source in inputs:
+        ffmpeg_command += ['-i', source]
+    if settings['source'] == 'audio':
+        ffmpeg_command += ['-map', f'{len(inputs) - 1}:a:0']
+    else:
+        ffmpeg_command += ['-map', '0:v:0', '-map', '1:a:0' if len(inputs) == 2 else '0:a?']
+    ffmpeg_command += settings['args'] + [output_path]
+
+    logger.info(f"Transcoding {inputs} with preset {preset} into {output_path}")
+    await run_ffmpeg(ffmpeg_command, nice=ENCODE_NICE)
+
+    if not os.path.isfile(output_path):
+        logger.error(f"Output file {output_path} was not created")
+        raise Exception(f"Failed to transcode into {output_path}")
+    for source in inputs:
+        if os.path.exists(source):
+            os.remove(source)
+    return output_path
@@ -0,0 +1,209 @@
+import base64
+import contextvars
+import functools
+import http.client
+import itertools
+import logging
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+import socks
+
+logger = logging.getLogger(__name__)
+
+# The egress of the current request. asyncio copies the context into every task
+# and asyncio.to_thread call, so concurrent requests never see each other's route.
+_current = contextvars.ContextVar('egress', default=None)
+
+_SOCKS_TYPES = {
+    'socks4': socks.SOCKS4,
+    'socks4a': socks.SOCKS4,
+    'socks5': socks.SOCKS5,
+    'socks5h': socks.SOCKS5,
+}
+
+
+class Egress:
+    """
+    A route to the internet: an HTTP(S) or SOCKS proxy, or a Tor isolation identity.
+
+    Tor isolates streams by SOCKS credentials (IsolateSOCKSAuth is on by default),
+    so every Tor identity gets its own circuit and rotate() moves it to a fresh one.
+    """
+
+    is_pinned = False
+
+    def __init__(self, key, server, username='', password='', kind='proxy'):
+        self.key = key
+        self.server = server
+        self.kind = kind
+        self._username = username or ''
+        self._password = password or ''
+        self.generation = 0
+        parsed = urlparse(server if '://' in server else f'http://{server}')
+        self.scheme = parsed.scheme.lower()
+        self.host = parsed.hostname
+        self.port = parsed.port or (1080 if self.is_socks else 8080)
+
+    @classmethod
+    def from_proxy(cls, proxy):
+        """Build an Egress from an entry of utils.get_proxies()"""
+        kind = proxy.get('type', 'regular')
+        key = proxy.get('key') or f"{kind}:{proxy['server']}"
+        return cls(key, proxy['server'], proxy.get('username'), proxy.get('password'), kind=kind)
+
+    @property
+    def is_socks(self):
+        return self.scheme in _SOCKS_TYPES
+
+    @property
+    def is_tor(self):
+        return self.kind == 'tor'
+
+    @property
+    def username(self):
+        if self.is_tor:
+            # The generation is part of the credentials so rotating means a new circuit
+            return f'{self._username}-{self.generation}'
+        return self._username
+
+    @property
+    def password(self):
+        return self._password
+
+    def pinned(self, generation=None):
+        """Copy of this egress that keeps using the circuit of generation (default: the current one)"""
+        copy = Egress(self.key, self.server, self._username, self._password, kind=self.kind)
+        copy.generation = self.generation if generation is None else generation
+        copy.is_pinned = True
+        return copy
+
+    def rotate(self):
+        """Move a Tor identity to a fresh circuit"""
+        if self.is_tor and not self.is_pinned:
+            self.generation += 1
+            logger.info(f"Rotated Tor identity {self.key} to generation {self.generation}")
+
+    def proxy_url(self, scheme=None):
+        auth = ''
+        if self.username:
+            auth = f'{self.username}:{self.password}@'
+        return f'{scheme or self.scheme}://{auth}{self.host}:{self.port}'
+
+    def requests_proxies(self):
+        """Proxy mapping for the requests library"""
+        # socks5h resolves hostnames through the proxy, which Tor requires
+        scheme = 'socks5h' if self.scheme == 'socks5' else None
+        url = self.proxy_url(scheme)
+        return {'http': url, 'https': url}
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Open a socket to address through this SOCKS egress"""
+        return socks.create_connection(
+            address,
+            timeout=timeout,
+            source_address=source_address,
+            proxy_type=_SOCKS_TYPES[self.scheme],
+            proxy_addr=self.host,
+            proxy_port=self.port,
+            proxy_rdns=self.scheme != 'socks4',
+            proxy_username=self.username or None,
+            proxy_password=self.password or None
+        )
+
+    def __repr__(self):
+        return f'<Egress {self.key}>'
+
+
+def tor_identities(host, ports, per_port, prefix='yt'):
+    """Tor isolation identities spread over every SocksPort"""
+    # Credentials are the same in every worker, so an identity (and generation)
+    # recorded in the shared metadata cache maps to the same circuit everywhere
+    identities = []
+    for port, index in itertools.product(ports, range(per_port)):
+        identities.append({
+            'key': f'tor:{port}:{index}',
+            'server': f'socks5h://{host}:{port}',
+            'username': f'{prefix}-{port}-{index}',
+            'password': prefix,
+            'type': 'tor'
+        })
+    return identities
+
+
+def current():
+    """Egress bound to the current request, None for a direct connection"""
+    return _current.get()
+
+
+def bind(egress):
+    """Route everything the current task (and threads it starts) does through egress"""
+    _current.set(egress)
+
+
+@contextmanager
+def use(egress):
+    token = _current.set(egress)
+    try:
+        yield egress
+    finally:
+        _current.reset(token)
+
+
+class _SocksHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, egress=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.egress = egress
+
+    def connect(self):
+        self.sock = self.egress.create_connection((self.host, self.port), self.timeout, self.source_address)
+
+
+class _SocksHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, egress=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.egress = egress
+
+    def connect(self):
+        sock = self.egress.create_connection((self.host, self.port), self.timeout, self.source_address)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class EgressHandler(urllib.request.AbstractHTTPHandler):
+    """
+    urllib handler that routes each request through the egress bound to its context.
+
+    SOCKS egresses open their own connections, HTTP proxies are applied to the
+    request and handled by the stock handlers, and without an egress the
+    request goes out directly.
+    """
+
+    handler_order = 100  # before the default HTTP(S)Handler and ProxyHandler
+
+    def http_request(self, req):
+        egress = current()
+        if egress is not None and not egress.is_socks and not req.has_proxy():
+            req.set_proxy(f'{egress.host}:{egress.port}', egress.scheme)
+            if egress.username:
+                credentials = f'{unquote(egress.username)}:{unquote(egress.password)}'
+                req.add_header('Proxy-Authorization', 'Basic ' + base64.b64encode(credentials.encode()).decode())
+        return req
+
+    https_request = http_request
+
+    def http_open(self, req):
+        egress = current()
+        if egress is None or not egress.is_socks:
+            return None
+        return self.do_open(functools.partial(_SocksHTTPConnection, egress=egress), req)
+
+    def https_open(self, req):
+        egress = current()
+        if egress is None or not egress.is_socks:
+            return None
+        return self.do_open(functools.partial(_SocksHTTPSConnection, egress=egress), req)
+
+
+def install():
+    """Install the egress aware opener for urllib, which pytubefix uses for every request"""
+    urllib.request.install_opener(urllib.request.build_opener(EgressHandler()))
@@ -0,0 +1,430 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import admission
+import progress
+from cache import SqliteStore
+from downloader import all_streamable
+from pipeline import produce_video, produce_audio, produce_clip, produce_preset
+from planner import PRESETS, parse_containers, parse_preset
+from ratelimit import Overloaded
+from utils import get_youtube, download_content, get_captions, delete_file_after_delay, parse_clip, clip_bounds, preset_video_stream, TerminalVideoError
+from settings import JOB_WORKERS, JOB_TTL, JOB_MAX_ATTEMPTS, EXPIRATION_DELAY
+
+logger = logging.getLogger(__name__)
+
+# How often idle workers look for queued jobs created by other processes
+_POLL_INTERVAL = 1
+# How often a running job proves its worker is still alive
+_HEARTBEAT_INTERVAL = 10
+# A running job without a heartbeat for this long lost its worker and is queued again
+_STALE_AFTER = 60
+
+
+class JobError(Exception):
+    """A job failed in a way the client can act on, e.g. no matching stream"""
+
+
+class JobStore(SqliteStore):
+    """
+    Download jobs shared by every hypercorn worker.
+
+    Jobs go queued -> running -> done | failed, and to cancelled when the
+    client gives up on them. Any worker may claim a queued job; a job whose
+    worker stops heartbeating is queued again, which picks up partial
+    downloads where they were left, until it was started max_attempts times.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            params TEXT NOT NULL,
+            state TEXT NOT NULL,
+            stage TEXT,
+            bytes_done INTEGER NOT NULL DEFAULT 0,
+            bytes_total INTEGER NOT NULL DEFAULT 0,
+            rate REAL,
+            encoded REAL,
+            duration REAL,
+            encode_speed REAL,
+            result TEXT,
+            error TEXT,
+            worker TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            heartbeat REAL
+        )""",
+        'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_after)',
+    )
+
+    _fields = ('id', 'params', 'state', 'stage', 'bytes_done', 'bytes_total', 'rate', 'encoded', 'duration',
+               'encode_speed', 'result', 'error', 'worker', 'attempts', 'run_after', 'created', 'updated', 'heartbeat')
+
+    def __init__(self, name='jobs.sqlite3', ttl=JOB_TTL, max_attempts=JOB_MAX_ATTEMPTS):
+        super().__init__(name)
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    def create(self, params):
+        """Queue a job for params, returns its id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            db = self.db()
+            db.execute(
+                'INSERT INTO jobs (id, params, state, stage, run_after, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, json.dumps(params), 'queued', 'queued', now, now, now)
+            )
+            db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed', 'cancelled') AND updated < ?", (now - self.ttl,))
+        return job_id
+
+    def get(self, job_id):
+        """Job as a dict, None if there is no such job"""
+        with self._lock:
+            row = self.db().execute(f'SELECT {", ".join(self._fields)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._decode(row) if row else None
+
+    def claim(self, worker):
+        """Move the oldest runnable job to running for worker and return it, or None"""
+        now = time.time()
+        with self._lock:
+            db = self.db()
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                # A job that keeps taking its worker down is given up on
+                db.execute(
+                    "UPDATE jobs SET state = 'failed', stage = 'failed', error = ?, worker = NULL, updated = ? "
+                    "WHERE state = 'running' AND heartbeat < ? AND attempts >= ?",
+                    (f"Gave up after {self.max_attempts} attempts, the server kept stopping while running it",
+                     now, now - _STALE_AFTER, self.max_attempts)
+                )
+                db.execute(
+                    "UPDATE jobs SET state = 'queued', worker = NULL, updated = ? "
+                    "WHERE state = 'running' AND heartbeat < ?",
+                    (now, now - _STALE_AFTER)
+                )
+                row = db.execute(
+                    f'SELECT {", ".join(self._fields)} FROM jobs '
+                    "WHERE state = 'queued' AND run_after <= ? ORDER BY created LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    db.execute(
+                        "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, "
+                        'heartbeat = ?, updated = ? WHERE id = ?',
+                        (worker, now, now, row[0])
+                    )
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                raise
+        if not row:
+            return None
+        job = self._decode(row)
+        job.update(state='running', worker=worker, attempts=job['attempts'] + 1)
+        return job
+
+    def update(self, job_id, **fields):
+        self._update(job_id, fields)
+
+    def finish(self, job_id, **fields):
+        """update for the outcome of a run, unless the job was cancelled meanwhile"""
+        self._update(job_id, fields, "AND state = 'running'")
+
+    def requeue(self, job_id, delay):
+        self.finish(job_id, state='queued', stage='queued', worker=None, run_after=time.time() + delay)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; its worker stops it by its next heartbeat. False if it already ended"""
+        with self._lock:
+            cursor = self.db().execute(
+                "UPDATE jobs SET state = 'cancelled', stage = 'cancelled', updated = ? "
+                "WHERE id = ? AND state IN ('queued', 'running')",
+                (time.time(), job_id)
+            )
+        return cursor.rowcount > 0
+
+    def _update(self, job_id, fields, condition=''):
+        fields['updated'] = fields['heartbeat'] = time.time()
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        assignments = ', '.join(f'{field} = ?' for field in fields)
+        with self._lock:
+            try:
+                self.db().execute(f'UPDATE jobs SET {assignments} WHERE id = ? {condition}', (*fields.values(), job_id))
+            except sqlite3.Error as e:
+                logger.warning(f"Could not update job {job_id}: {repr(e)}")
+
+    def counts(self):
+        with self._lock:
+            rows = self.db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return dict(rows)
+
+    def _decode(self, row):
+        job = dict(zip(self._fields, row))
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+async def run_job(params):
+    """The download pipeline of the /download endpoints for a job's params, returns the job result"""
+    url = params['url']
+    subtitle = params.get('subtitle') or params.get('caption')
+    if isinstance(subtitle, dict):
+        burn, lang, translate = subtitle.get('burn'), subtitle.get('lang'), subtitle.get('translate')
+    else:
+        burn, lang, translate = True, subtitle, False
+    bitrate = params.get('bitrate') or ""
+    try:
+        clip = parse_clip(params)
+        containers = parse_containers(params['container']) if params.get('container') else None
+        preset = parse_preset(params.get('preset') or params.get('format'), 'audio' if params.get('type') == 'audio' else 'video')
+    except ValueError as e:
+        raise JobError(str(e))
+
+    if preset and (clip or lang):
+        raise JobError("Presets can't be combined with clips or subtitles yet")
+
+    progress.stage('resolving')
+    yt = await get_youtube(url)
+    if clip:
+        try:
+            clip = clip_bounds(clip, yt.length)
+        except ValueError as e:
+            raise JobError(str(e))
+    if params.get('type') == 'audio':
+        audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio", bitrate=bitrate)
+        if error_message:
+            raise JobError(error_message)
+        if clip:
+            path = await _clip(yt, None, audio_stream, clip, params)
+        elif preset:
+            path = await produce_preset(yt, preset, None, audio_stream)
+        else:
+            path = await produce_audio(yt, audio_stream)
+        info = {"bitrate": getattr(audio_stream, 'abr', 'unknown')}
+    else:
+        options = {"hdr": params.get('hdr')}
+        if params.get('resolution'):
+            options.update(resolution=params['resolution'], frame_rate=int(params.get('frame_rate', 30)))
+        if preset:
+            video_stream, error_message = await asyncio.to_thread(preset_video_stream, yt, PRESETS[preset]['height'])
+        else:
+            video_stream, error_message = await asyncio.to_thread(download_content, yt, **options)
+        if error_message:
+            raise JobError(error_message)
+        audio_stream = None
+        if not video_stream.is_progressive or bitrate:
+            audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio", bitrate=bitrate)
+            if error_message:
+                audio_stream = None
+        caption = None
+        if lang and clip:
+            raise JobError("Subtitles can't be added to clips yet, leave out start/end or the subtitle")
+        if lang:
+            caption, error_message = await asyncio.to_thread(get_captions, yt, lang, translate=translate)
+            if not caption:
+                logger.warning(f"Caption download failed: {error_message}")
+        if clip:
+            path = await _clip(yt, video_stream, audio_stream, clip, params, containers)
+        elif preset:
+            path = await produce_preset(yt, preset, video_stream, audio_stream)
+        else:
+            path = await produce_video(yt, video_stream, audio_stream, caption, burn=burn, lang=lang, translate=translate, containers=containers)
+        info = {
+            "resolution": getattr(video_stream, 'resolution', 'unknown'),
+            "frame_rate": getattr(video_stream, 'fps', 30),
+            "hdr": getattr(video_stream, 'is_hdr', False)
+        }
+
+    threading.Thread(target=delete_file_after_delay, args=(path, EXPIRATION_DELAY)).start()
+    return {"filename": os.path.basename(path), "title": yt.title, "duration": yt.length, **info}
+
+
+async def _clip(yt, video_stream, audio_stream, clip, params, containers=None):
+    if not await all_streamable(video_stream, audio_stream):
+        raise JobError("This video can't be cut into clips, download it whole instead")
+    return await produce_clip(yt, video_stream, audio_stream, *clip, exact=bool(params.get('exact')), containers=containers)
+
+
+class _JobWriter:
+    """
+    Writes of one running job to the store, made from a thread in order.
+
+    Progress may be reported from download threads as well as from the loop;
+    only the latest snapshot is kept while a write is in flight. The outcome
+    is written once the last progress write landed, so it is never overwritten.
+    """
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self._loop = asyncio.get_running_loop()
+        self._latest = None
+        self._changed = asyncio.Event()
+        self._closed = False
+        self._task = self._loop.create_task(self._write_progress())
+
+    def progress(self, snapshot):
+        """Progress.on_change, callable from any thread"""
+        self._latest = snapshot
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def finish(self, **fields):
+        await self.close()
+        await asyncio.to_thread(self.store.finish, self.job_id, **fields)
+
+    async def requeue(self, delay):
+        await self.close()
+        await asyncio.to_thread(self.store.requeue, self.job_id, delay)
+
+    async def close(self):
+        """Stop writing progress, once the write in flight landed"""
+        self._closed = True
+        self._changed.set()
+        await self._task
+
+    async def _write_progress(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            snapshot, self._latest = self._latest, None
+            if self._closed:
+                return
+            if snapshot is None:
+                continue
+            try:
+                await asyncio.to_thread(self.store.update, self.job_id, **snapshot)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not save progress of job {self.job_id}: {repr(e)}")
+
+
+class JobRunner:
+    """Pool of asyncio workers in this process running jobs from the shared JobStore"""
+
+    def __init__(self, store, workers=JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._tasks = []
+        self._wake = None
+        self._running = {}  # job id -> task running it here
+        self.running = 0
+
+    def start(self):
+        if self._tasks or self.workers <= 0:
+            return
+        # Workers may be forked after import
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.get_running_loop().create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, params):
+        """Queue a job and wake a local worker for it, returns the job id"""
+        job_id = await asyncio.to_thread(self.store.create, params)
+        if self._wake is not None:
+            self._wake.set()
+        return job_id
+
+    async def cancel(self, job_id):
+        """
+        Cancel a job, stopping its ffmpeg and downloads right away when it runs
+        in this process. False if it already ended.
+        """
+        cancelled = await asyncio.to_thread(self.store.cancel, job_id)
+        if cancelled and job_id in self._running:
+            self._running[job_id].cancel()
+        return cancelled
+
+    def stats(self):
+        return {"workers": self.workers, "running": self.running, "jobs": self.store.counts()}
+
+    async def _work(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim, self.name)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not claim a job: {repr(e)}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), _POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+                continue
+            self.running += 1
+            try:
+                await self._run(job)
+            finally:
+                self.running -= 1
+
+    async def _run(self, job):
+        job_id = job['id']
+        logger.info(f"Running job {job_id} (attempt {job['attempts']}): {job['params'].get('url')}")
+        writer = _JobWriter(self.store, job_id)
+        tracker = progress.Progress(on_change=writer.progress)
+        # Jobs are polled for, requests with a client waiting on them go first
+        with progress.use(tracker), admission.priority(admission.BACKGROUND):
+            task = asyncio.ensure_future(run_job(job['params']))
+        self._running[job_id] = task
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id, task))
+        try:
+            result = await task
+        except Overloaded as e:
+            if job['attempts'] >= self.store.max_attempts:
+                logger.info(f"Job {job_id} failed after {job['attempts']} attempts: {e.message}")
+                await writer.finish(state='failed', stage='failed', error=e.message)
+            else:
+                logger.info(f"Job {job_id} postponed for {e.retry_after}s: {e.message}")
+                await writer.requeue(e.retry_after)
+        except TerminalVideoError as e:
+            await writer.finish(state='failed', stage='failed', error=e.message)
+        except JobError as e:
+            await writer.finish(state='failed', stage='failed', error=str(e))
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # Shutting down, leave it for another worker
+                await writer.requeue(0)
+                raise
+            logger.info(f"Job {job_id} cancelled")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {repr(e)}", exc_info=True)
+            await writer.finish(state='failed', stage='failed', error=f"Server error : {repr(e)}")
+        else:
+            logger.info(f"Job {job_id} done: {result['filename']}")
+            await writer.finish(**dict(tracker.snapshot(), state='done', stage='done', result=result))
+        finally:
+            heartbeat.cancel()
+            await writer.close()
+            del self._running[job_id]
+
+    async def _heartbeat(self, job_id, task):
+        while True:
+            await asyncio.sleep(_HEARTBEAT_INTERVAL)
+            await asyncio.to_thread(self.store.update, job_id)
+            # Cancelled through another worker
+            job = await asyncio.to_thread(self.store.get, job_id)
+            if job and job['state'] == 'cancelled':
+                task.cancel()
+                return
+
+
+job_store = JobStore()
+job_runner = JobRunner(job_store)
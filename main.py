@@ -1,14 +1,26 @@
-from quart import Quart, request, jsonify, url_for, send_file
+from quart import Quart, Response, request, websocket, jsonify, url_for, send_file, stream_with_context
 from pytubefix import YouTube
 from pytubefix.cli import on_progress
 from youtubesearchpython.__future__ import VideosSearch, ResultMode, Suggestions
 from pytubefix.exceptions import AgeRestrictedError, LiveStreamError, MaxRetriesExceeded, MembersOnly, VideoPrivate, VideoRegionBlocked, VideoUnavailable, RegexMatchError
-from apscheduler.schedulers.background import BackgroundScheduler
-from editor import combine_video_and_audio, add_subtitles
-from utils import is_valid_youtube_url, is_valid_language, get_proxies, get_info, download_content, get_captions, delete_file_after_delay, write_creds_to_file, fetch_po_token, create_youtube_with_retry, is_tor_enabled, disable_tor_proxy
+from egress import Egress, tor_identities
+from tor_control import tor_controller
+from ratelimit import rate_limiter, Overloaded
+from admission import lookup_pool, INTERACTIVE, stats as admission_stats
+from downloader import reclaim_partials
+from pipeline import produce_video, produce_audio, produce_clip, produce_preset, media_flight, mux_stream, passthrough, cached_stream, video_recipe, attachment_headers
+from downloader import all_streamable
+from cache import media_cache
+from diskbudget import disk_budget
+from jobs import job_store, job_runner
+from batch import expand, run_batch
+from planner import PRESETS, parse_containers, parse_preset, accepted_containers
+from utils import is_valid_youtube_url, is_valid_language, get_proxies, get_info, download_content, get_captions, delete_file_after_delay, write_creds_to_file, fetch_po_token, get_cached_info, get_youtube, youtube_flight, TerminalVideoError, proxy_pool, acquire_budget, parse_clip, clip_bounds, preset_video_stream
 from settings import *
 import re
+import glob
 import os
+import json
 import time
 import threading
 import logging
@@ -48,6 +60,27 @@ resolution_regrex = r'\d{3,}p'
 lang_code_regrex = r'^((a\.)?[a-z]{2})(-[A-Z]{2})?$'
 search_amount_reqrex = r'\b\d+\b'
 
+# Daily sweep of TEMP_DIR in this worker
+temp_cleanup = None
+
+
+@app.before_serving
+async def start_background_services():
+    global temp_cleanup
+    if tor_controller:
+        tor_controller.start()
+    job_runner.start()
+    # Every hypercorn worker sweeps, what another one removed first is skipped
+    temp_cleanup = asyncio.get_running_loop().create_task(clear_temp_directory_daily())
+
+@app.after_serving
+async def stop_background_services():
+    if temp_cleanup:
+        temp_cleanup.cancel()
+    await job_runner.stop()
+    if tor_controller:
+        await tor_controller.stop()
+
 
 @app.route("/ping")
 async def handle_ping():
@@ -78,13 +111,12 @@ async def tor_status():
     
     status["tor_configured"] = True
     status["proxy_address"] = f"{TOR_PROXY_HOST}:{TOR_PROXY_PORT}"
+    status["controller"] = tor_controller and tor_controller.stats()
     
     try:
-        # Test Tor connection
-        proxies = {
-            'http': f'socks5://{TOR_PROXY_HOST}:{TOR_PROXY_PORT}',
-            'https': f'socks5://{TOR_PROXY_HOST}:{TOR_PROXY_PORT}'
-        }
+        # Test Tor connection on its own isolated circuit, never touching request traffic
+        probe = Egress.from_proxy(tor_identities(TOR_PROXY_HOST, [TOR_PROXY_PORT], 1, prefix='status')[0])
+        proxies = probe.requests_proxies()
         
         # Check if we're using Tor
         response = req.get('https://check.torproject.org/api/ip', 
@@ -108,6 +140,27 @@ async def tor_status():
     
     return jsonify(status), 200
 
+@app.route("/metrics")
+async def metrics():
+    """Counters of this worker"""
+    return jsonify({
+        "pid": os.getpid(),
+        "singleflight": {
+            youtube_flight.name: youtube_flight.stats(),
+            media_flight.name: media_flight.stats()
+        },
+        "media_cache": media_cache.stats(),
+        "jobs": job_runner.stats(),
+        "admission": admission_stats(),
+        "disk": disk_budget.stats(),
+        "rate_limits": rate_limiter.stats()
+    }), 200
+
+@app.route("/proxy_stats")
+async def proxy_stats():
+    """Health and selection statistics of every configured proxy in this worker"""
+    return jsonify({"pid": os.getpid(), "proxies": proxy_pool.stats()}), 200
+
 search_objs = {}
 
 @app.route('/search', methods=['GET'])
@@ -129,11 +182,15 @@ async def search():
     
     
     try:
+        await acquire_budget('direct')
         s = VideosSearch(q, limit=amount)
         search_id = uuid.uuid4()
-        response = await s.next()
+        async with lookup_pool.slot(INTERACTIVE):
+            response = await s.next()
         search_objs[str(search_id)] = s
-        suggestions = await Suggestions.get(q)
+        await acquire_budget('direct')
+        async with lookup_pool.slot(INTERACTIVE):
+            suggestions = await Suggestions.get(q)
         results = response['result']
         if response and results and len(results) > 0:
           res = {
@@ -146,6 +203,8 @@ async def search():
           return jsonify(res), 200
         else:
           return jsonify({"error":"No results found.", "suggestions": suggestions['result']}), 400
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"Error searching query: {repr(e)}")
         return jsonify({"error": f"An error occored please report this to the devloper.: {repr(e)}"}), 500
@@ -155,7 +214,9 @@ async def next_page(search_id):
   try:
     uuid.UUID(search_id,version=4)
     s = search_objs[search_id]
-    response = await s.next()
+    await acquire_budget('direct')
+    async with lookup_pool.slot(INTERACTIVE):
+      response = await s.next()
     if response:
       result = response['result']
       return jsonify({
@@ -172,6 +233,8 @@ async def next_page(search_id):
   except KeyError as e:
     logger.error(f"No search found for passed search id Error: {repr(e)}")
     return jsonify({"error": "No seaech found for search id"}), 400
+  except Overloaded as e:
+    return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
   except Exception as e:
     logger.error(f"an error occore fetching search results : {repr(e)}")
     return jsonify({"error": f"An error occored if you are seing this message pleas report to the dev Error: {repr(e)}"})
@@ -191,7 +254,11 @@ async def video_info():
       return jsonify({"error": "Invalid YouTube URL."}), 400
     
     try:
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      video_info = await asyncio.to_thread(get_cached_info, url)
+      if video_info:
+        return jsonify(video_info), 200
+      
+      yt = await get_youtube(url)
       video_info, error = await asyncio.to_thread(get_info, yt)
       
       if video_info:
@@ -199,10 +266,97 @@ async def video_info():
       else:
         return jsonify({"error": error}), 500
     
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored fetching video info:{repr(e)}")
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
 
+def requested_containers(data):
+    """Output containers a client takes, best first, from its 'container' option or Accept header. Raises ValueError"""
+    if data.get('container'):
+        return parse_containers(data['container'])
+    return accepted_containers(request.accept_mimetypes) or None
+
+
+async def clip_file(yt, video_stream, audio_stream, clip, exact=False, containers=None):
+    """The clip (start, end) of yt a client asked for as (path, None), or (None, why it can't be made)"""
+    try:
+        start, end = clip_bounds(clip, yt.length)
+    except ValueError as e:
+        return None, str(e)
+    if not await all_streamable(video_stream, audio_stream):
+        return None, "This video can't be cut into clips, download it whole instead"
+    return await produce_clip(yt, video_stream, audio_stream, start, end, exact=bool(exact), containers=containers), None
+
+
+async def preset_response(yt, preset, data, bitrate=""):
+    """Response with yt transcoded with preset, answered the way the download endpoints answer"""
+    video_stream = audio_stream = None
+    if PRESETS[preset]['source'] == 'video':
+        video_stream, error_message = await asyncio.to_thread(preset_video_stream, yt, PRESETS[preset]['height'])
+        if error_message:
+            return jsonify({"error": error_message}), 500
+    if not video_stream or not video_stream.is_progressive:
+        audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio", bitrate=bitrate)
+        if error_message:
+            if not video_stream:
+                return jsonify({"error": error_message}), 500
+            logger.warning(f"Transcoding {yt.video_id} without sound: {error_message}")
+            audio_stream = None
+
+    path = await produce_preset(yt, preset, video_stream, audio_stream)
+    threading.Thread(target=delete_file_after_delay, args=(path, EXPIRATION_DELAY)).start()
+    if not data.get("link"):
+        return await send_file(path, as_attachment=True), 200
+    info = {"preset": preset, "filename": os.path.basename(path), "title": yt.title, "duration": yt.length}
+    download_link = url_for('get_file', filename=os.path.basename(path), _external=True)
+    return jsonify({"download_link": download_link, "video_info" if video_stream else "audio_info": info}), 200
+
+
+async def muxed_response(video_stream, audio_stream=None):
+    """Response sending the muxed video to the client while ffmpeg is still making it"""
+    body = await mux_stream(video_stream, audio_stream)
+    filename = f"{os.path.splitext(video_stream.default_filename)[0]}.mp4"
+    response = Response(body, mimetype="video/mp4", headers=attachment_headers(filename))
+    # Lasts as long as the upstream transfer, not the usual response timeout
+    response.timeout = None
+    return response
+
+
+async def passthrough_response(yt, stream, recipe):
+    """
+    Response relaying stream to the client as it comes in from upstream,
+    or from the media cache when it is there. A single range in the client's
+    Range header is forwarded upstream and answered with 206.
+    """
+    cached = await cached_stream(yt, stream, recipe)
+    if cached:
+        logger.info(f"Serving {stream.default_filename} from the media cache")
+        return await send_file(cached, as_attachment=True, attachment_filename=stream.default_filename, conditional=True)
+
+    # Without a contentLength in the manifest this asks googlevideo
+    size = await asyncio.to_thread(getattr, stream, 'filesize')
+    start, end, status = 0, size - 1, 200
+    headers = attachment_headers(stream.default_filename)
+    headers["Accept-Ranges"] = "bytes"
+    if request.range and len(request.range.ranges) == 1:
+        span = request.range.range_for_length(size)
+        if span is None:
+            return jsonify({"error": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{size}"}
+        start, end, status = span[0], span[1] - 1, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    body = await passthrough(yt, stream, recipe, start, end)
+    response = Response(body, status=status, mimetype=stream.mime_type, headers=headers)
+    # Lasts as long as the upstream transfer, not the usual response timeout
+    response.timeout = None
+    return response
+
+
 @app.route('/download', methods=['POST'])
 async def download_highest_avaliable_resolution():
     data = await request.get_json()
@@ -229,117 +383,123 @@ async def download_highest_avaliable_resolution():
     if lang:
       if not is_valid_language(lang):
         return jsonify({"error": "Invalid lang code"}), 400
+
+    try:
+      clip = parse_clip(data)
+      containers = requested_containers(data)
+      preset = parse_preset(data.get('preset') or data.get('format'), 'video')
+    except ValueError as e:
+      return jsonify({"error": str(e)}), 400
+    if clip and subtitle:
+      return jsonify({"error": "Subtitles can't be added to clips yet, leave out start/end or the subtitle"}), 400
+    if preset and (clip or subtitle or data.get("stream")):
+      return jsonify({"error": "Presets can't be combined with clips, subtitles or streaming yet"}), 400
     
     try:
       logger.info(f"Initializing YouTube object for URL: {url}")
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      yt = await get_youtube(url)
       logger.info(f"YouTube object created successfully. Video title: {yt.title}")
       
-      try:
-          video_file = None
-          audio_file = None
-          logger.info("Calling download_content for video stream...")
-          video_stream, error_message = await asyncio.to_thread(download_content,yt, hdr=hdr)
-          
-          if error_message:
-              logger.error(f"Video stream download failed: {error_message}")
-              return jsonify({"error": error_message}), 500
+      if preset:
+          logger.info(f"Transcoding with preset {preset}")
+          return await preset_response(yt, preset, data)
+      
+      video_file = None
+      logger.info("Calling download_content for video stream...")
+      video_stream, error_message = await asyncio.to_thread(download_content,yt, hdr=hdr)
+      
+      if error_message:
+          logger.error(f"Video stream download failed: {error_message}")
+          return jsonify({"error": error_message}), 500
+      
+      audio_stream = None
+      if not error_message:
+          # Check if video stream has audio by checking audio_codec
+          if not video_stream.is_progressive:
+              logger.info("Video stream is not progressive, need to download audio separately")
+              logger.info("Calling download_content for audio stream...")
+              audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio")
+              if error_message:
+                  logger.error(f"Audio stream download failed: {error_message}")
+                  audio_stream = None
+          else:
+              logger.info("Video stream is progressive (includes audio)")
           
-          get_audio = False
-          if not error_message:
-              logger.info(f"Downloading video file to {TEMP_DIR}...")
-              video_file = await asyncio.to_thread(video_stream.download, output_path=TEMP_DIR)
-              logger.info(f"Video file downloaded: {video_file}")
-              
-              # Check if video stream has audio by checking audio_codec
-              if not video_stream.is_progressive:
-                  logger.info("Video stream is not progressive, need to download audio separately")
-                  get_audio = True
-              else:
-                  logger.info("Video stream is progressive (includes audio)")
-                  
-              if get_audio:
-                  logger.info("Calling download_content for audio stream...")
-                  audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio")
-                  if not error_message:
-                      logger.info(f"Downloading audio file to {TEMP_DIR}...")
-                      audio_file = await asyncio.to_thread(audio_stream.download, output_path=TEMP_DIR)
-                      logger.info(f"Audio file downloaded: {audio_file}")
-                  else:
-                      logger.error(f"Audio stream download failed: {error_message}")
+          if clip:
+              logger.info(f"Cutting clip {clip} out of the video")
+              video_file, error_message = await clip_file(yt, video_stream, audio_stream, clip, data.get("exact"), containers)
+              if error_message:
+                  return jsonify({"error": error_message}), 400
+          else:
+              if not audio_stream and not subtitle and not data.get("link") and await all_streamable(video_stream):
+                  logger.info("Relaying progressive video straight to the client")
+                  return await passthrough_response(yt, video_stream, video_recipe())
               
-              if audio_file:
-                  # Create a temporary output path for the combined file
-                  combined_output = os.path.join(TEMP_DIR, f"combined_{os.path.basename(video_file)}")
-                  logger.info(f"Combining video and audio: {video_file} + {audio_file} -> {combined_output}")
-                  video_file = await asyncio.to_thread(combine_video_and_audio, video_file, audio_file, combined_output)
-                  logger.info(f"Combined file created: {video_file}")
+              if data.get("stream") and not subtitle and await all_streamable(video_stream, audio_stream):
+                  logger.info("Streaming video straight to the client")
+                  return await muxed_response(video_stream, audio_stream)
               
+              caption = None
               if subtitle:
                   logger.info(f"Getting captions: lang={lang}, translate={translate}")
                   caption, error_message = await asyncio.to_thread(get_captions, yt, lang, translate=translate)
-                  if caption:
-                      caption_file = caption.srt()
-                      logger.info(f"Caption file created: {caption_file}")
-                      # Create a temporary output path for the subtitled file
-                      subtitled_output = os.path.join(TEMP_DIR, f"subtitled_{os.path.basename(video_file)}")
-                      logger.info(f"Adding subtitles: {video_file} + {caption_file} -> {subtitled_output}")
-                      video_file = await asyncio.to_thread(add_subtitles, video_file, caption_file, subtitled_output, burn, lang)
-                      logger.info(f"Subtitled file created: {video_file}")
-                      threading.Thread(target=delete_file_after_delay, args=(caption_file, EXPIRATION_DELAY)).start()
-                  else:
+                  if not caption:
                       logger.warning(f"Caption download failed: {error_message}")
-                     
-          """ 
-          video_file, error_message = await asyncio.to_thread(download_content,yt)
-          if not error_message:
-              audio_file, error_message = await asyncio.to_thread(download_content, yt, content_type="audio")
-              if audio_file:
-                  await asyncio.to_thread(combine_video_and_audio, video_file,audio_file,os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"))
-                  #combine_video_and_audio( video_file,audio_file,os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"))
-                  if subtitle:
-                    caption, error_message = await asyncio.to_thread(get_captions, yt, lang)
-                    if caption:
-                      await asyncio.to_thread(add_subtitles, video_file, caption["path"], os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"), burn, lang)
-                      threading.Thread(target=delete_file_after_delay, args=(caption["path"], EXPIRATION_DELAY)).start()
-                      del caption["path"]
-                      
-                  threading.Thread(target=delete_file_after_delay, args=(audio_file, EXPIRATION_DELAY)).start()
-          """
-          
-          if video_file:
-              logger.info(f"Download successful! Final file: {video_file}")
-              threading.Thread(target=delete_file_after_delay, args=(video_file, EXPIRATION_DELAY)).start()
-              if data.get("link"):
-                download_link =  url_for('get_file', filename=os.path.basename(video_file), _external=True)
-                logger.info(f"Returning download link: {download_link}")
-                return jsonify(
-                  {
-                    "download_link": download_link,
-                    "video_info": {
-                      "quality": {
-                        "resolution": getattr(video_stream, 'resolution', 'unknown'),
-                        "frame_rate": getattr(video_stream, 'fps', 30),
-                        "bit_rate": getattr(video_stream, 'bitrate', 0) or (getattr(audio_stream, 'bitrate', 0) if audio_file else 0),
-                        "hdr": getattr(video_stream, 'is_hdr', False)},
-                        "filename": getattr(video_stream, 'default_filename', 'video.mp4'),
-                        "title": yt.title,
-                        "duration": yt.length
-                    }
-                  }
-                  ), 200
-              else:
-                logger.info(f"Sending file: {video_file}")
-                return await send_file(video_file, as_attachment=True), 200
-          else:
-              logger.error(f"Download failed: {error_message}")
-              return jsonify({"error": error_message}), 500
+              
+              logger.info(f"Producing video file in {TEMP_DIR}...")
+              video_file = await produce_video(yt, video_stream, audio_stream, caption, burn=burn, lang=lang, translate=translate, containers=containers)
+          logger.info(f"Video file ready: {video_file}")
+                 
+      """ 
+      video_file, error_message = await asyncio.to_thread(download_content,yt)
+      if not error_message:
+          audio_file, error_message = await asyncio.to_thread(download_content, yt, content_type="audio")
+          if audio_file:
+              await asyncio.to_thread(combine_video_and_audio, video_file,audio_file,os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"))
+              #combine_video_and_audio( video_file,audio_file,os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"))
+              if subtitle:
+                caption, error_message = await asyncio.to_thread(get_captions, yt, lang)
+                if caption:
+                  await asyncio.to_thread(add_subtitles, video_file, caption["path"], os.path.join(TEMP_DIR,f"temp_{os.path.basename(video_file)}"), burn, lang)
+                  threading.Thread(target=delete_file_after_delay, args=(caption["path"], EXPIRATION_DELAY)).start()
+                  del caption["path"]
+                  
+              threading.Thread(target=delete_file_after_delay, args=(audio_file, EXPIRATION_DELAY)).start()
+      """
       
-      finally:
-          # Clean up Tor proxy after download completes
-          if is_tor_enabled():
-              disable_tor_proxy()
+      if video_file:
+          logger.info(f"Download successful! Final file: {video_file}")
+          threading.Thread(target=delete_file_after_delay, args=(video_file, EXPIRATION_DELAY)).start()
+          if data.get("link"):
+            download_link =  url_for('get_file', filename=os.path.basename(video_file), _external=True)
+            logger.info(f"Returning download link: {download_link}")
+            return jsonify(
+              {
+                "download_link": download_link,
+                "video_info": {
+                  "quality": {
+                    "resolution": getattr(video_stream, 'resolution', 'unknown'),
+                    "frame_rate": getattr(video_stream, 'fps', 30),
+                    "bit_rate": getattr(video_stream, 'bitrate', 0) or (getattr(audio_stream, 'bitrate', 0) if audio_stream else 0),
+                    "hdr": getattr(video_stream, 'is_hdr', False)},
+                    "filename": getattr(video_stream, 'default_filename', 'video.mp4'),
+                    "title": yt.title,
+                    "duration": yt.length
+                }
+              }
+              ), 200
+          else:
+            logger.info(f"Sending file: {video_file}")
+            return await send_file(video_file, as_attachment=True), 200
+      else:
+          logger.error(f"Download failed: {error_message}")
+          return jsonify({"error": error_message}), 500
+  
     
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored downloading content: {repr(e)}", exc_info=True)
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
@@ -377,35 +537,42 @@ async def download_by_resolution(resolution):
     if lang:
         if not is_valid_language(lang):
             return jsonify({"error": "Invalid lang code"}), 400
+    try:
+        clip = parse_clip(data)
+        containers = requested_containers(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if clip and subtitle:
+        return jsonify({"error": "Subtitles can't be added to clips yet, leave out start/end or the subtitle"}), 400
     
     try:
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      yt = await get_youtube(url)
       
       video_stream, error_message = await asyncio.to_thread(download_content,yt, hdr=hdr, resolution=resolution, frame_rate=frame_rate)
-      get_audio = False
+      video_file = None
+      audio_stream = None
       if not error_message:
-          video_file = await asyncio.to_thread(video_stream.download, output_path=TEMP_DIR)
-          audio_file = None
           if not video_stream.is_progressive or bitrate:
-              get_audio = True
-          if get_audio:
               audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio", bitrate=bitrate)
-              if not error_message:
-                  audio_file = await asyncio.to_thread(audio_stream.download, output_path=TEMP_DIR)
-          
-          if audio_file:
-              # Create a temporary output path for the combined file
-              combined_output = os.path.join(TEMP_DIR, f"combined_{os.path.basename(video_file)}")
-              video_file = await asyncio.to_thread(combine_video_and_audio, video_file, audio_file, combined_output)
+              if error_message:
+                  audio_stream = None
           
-          if subtitle:
-              caption, error_message = await asyncio.to_thread(get_captions, yt, lang, translate=translate)
-              if caption:
-                  caption_file = caption.srt()
-                  # Create a temporary output path for the subtitled file
-                  subtitled_output = os.path.join(TEMP_DIR, f"subtitled_{os.path.basename(video_file)}")
-                  video_file = await asyncio.to_thread(add_subtitles, video_file, caption_file, subtitled_output, burn, lang)
-                  threading.Thread(target=delete_file_after_delay, args=(caption_file, EXPIRATION_DELAY)).start()
+          if clip:
+              video_file, error_message = await clip_file(yt, video_stream, audio_stream, clip, data.get("exact"), containers)
+              if error_message:
+                  return jsonify({"error": error_message}), 400
+          else:
+              if not audio_stream and not subtitle and not data.get("link") and await all_streamable(video_stream):
+                  return await passthrough_response(yt, video_stream, video_recipe())
+              
+              if data.get("stream") and not subtitle and await all_streamable(video_stream, audio_stream):
+                  return await muxed_response(video_stream, audio_stream)
+              
+              caption = None
+              if subtitle:
+                  caption, error_message = await asyncio.to_thread(get_captions, yt, lang, translate=translate)
+              
+              video_file = await produce_video(yt, video_stream, audio_stream, caption, burn=burn, lang=lang, translate=translate, containers=containers)
       
       """
       yt = YouTube(url,  use_oauth=AUTH, allow_oauth_cache=True, token_file = AUTH and AUTH_FILE_PATH, on_progress_callback = on_progress)
@@ -436,7 +603,7 @@ async def download_by_resolution(resolution):
                   "quality": {
                     "resolution": getattr(video_stream, 'resolution', 'unknown'),
                     "frame_rate": getattr(video_stream, 'fps', 30),
-                    "bit_rate": getattr(video_stream, 'bitrate', 0) or (getattr(audio_stream, 'bitrate', 0) if audio_file else 0),
+                    "bit_rate": getattr(video_stream, 'bitrate', 0) or (getattr(audio_stream, 'bitrate', 0) if audio_stream else 0),
                     "hdr": getattr(video_stream, 'is_hdr', False)},
                     "filename": getattr(video_stream, 'default_filename', 'video.mp4'),
                     "title": yt.title,
@@ -448,6 +615,10 @@ async def download_by_resolution(resolution):
             return await send_file(video_file, as_attachment=True), 200
       else:
           return jsonify({"error": error_message}), 500
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored downloading content:{repr(e)}")
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
@@ -463,11 +634,26 @@ async def download_highest_quality_audio():
     if not is_valid_youtube_url(url):
       return jsonify({"error": "Invalid YouTube URL."}), 400
     try:
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      clip = parse_clip(data)
+      preset = parse_preset(data.get('preset') or data.get('format'), 'audio')
+    except ValueError as e:
+      return jsonify({"error": str(e)}), 400
+    if preset and clip:
+      return jsonify({"error": "Presets can't be combined with clips yet"}), 400
+    try:
+      yt = await get_youtube(url)
+      if preset:
+          return await preset_response(yt, preset, data)
       audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio")
-      audio_file = None 
-      if audio_stream:
-          audio_file = await asyncio.to_thread(audio_stream.download, output_path=TEMP_DIR)
+      audio_file = None
+      if audio_stream and clip:
+          audio_file, error_message = await clip_file(yt, None, audio_stream, clip)
+          if error_message:
+              return jsonify({"error": error_message}), 400
+      elif audio_stream and not data.get("link") and await all_streamable(audio_stream):
+          return await passthrough_response(yt, audio_stream, {})
+      elif audio_stream:
+          audio_file = await produce_audio(yt, audio_stream)
       if audio_file:
           threading.Thread(target=delete_file_after_delay, args=(audio_file, EXPIRATION_DELAY)).start()
           if data.get("link"):
@@ -477,6 +663,10 @@ async def download_highest_quality_audio():
               return await send_file(audio_file, as_attachment=True), 200
       else:
           return jsonify({"error": error_message}), 500
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored downloading content:{repr(e)}")
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
@@ -495,14 +685,29 @@ async def download_audio_by_bitrate(bitrate):
  
     if not re.match(f"{bitrate_regrex}",bitrate):
        return jsonify({"error": "Invalid request URL, input a valid bitrate for example 48kpbs fuck you"}), 400
+    try:
+      clip = parse_clip(data)
+      preset = parse_preset(data.get('preset') or data.get('format'), 'audio')
+    except ValueError as e:
+      return jsonify({"error": str(e)}), 400
+    if preset and clip:
+      return jsonify({"error": "Presets can't be combined with clips yet"}), 400
  
     try:
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      yt = await get_youtube(url)
+      if preset:
+          return await preset_response(yt, preset, data, bitrate)
       audio_stream, error_message = await asyncio.to_thread(download_content, yt, content_type="audio", bitrate=bitrate)
       
       audio_file = None
-      if audio_stream:
-          audio_file = await asyncio.to_thread(audio_stream.download, output_path=TEMP_DIR)
+      if audio_stream and clip:
+          audio_file, error_message = await clip_file(yt, None, audio_stream, clip)
+          if error_message:
+              return jsonify({"error": error_message}), 400
+      elif audio_stream and not data.get("link") and await all_streamable(audio_stream):
+          return await passthrough_response(yt, audio_stream, {})
+      elif audio_stream:
+          audio_file = await produce_audio(yt, audio_stream)
       
       if audio_file:
           threading.Thread(target=delete_file_after_delay, args=(audio_file, EXPIRATION_DELAY)).start()
@@ -522,10 +727,249 @@ async def download_audio_by_bitrate(bitrate):
               return await send_file(audio_file, as_attachment=True), 200
       else:
           return jsonify({"error": error_message}), 500
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored downloading content:{repr(e)}")
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
  
+def job_options_error(data):
+    """What is wrong with the download options of a job, None if they are fine"""
+    resolution = data.get('resolution')
+    bitrate = data.get('bitrate')
+    subtitle = data.get('subtitle') or data.get('caption')
+    lang = subtitle.get('lang') if isinstance(subtitle, dict) else subtitle
+    if data.get('type', 'video') not in ('video', 'audio'):
+        return "Invalid job type, use 'video' or 'audio'"
+    if resolution and not re.match(resolution_regrex, resolution):
+        return "Invalid resolution, input a valid resolution for example 360p"
+    if bitrate and not re.match(bitrate_regrex, bitrate):
+        return "Invalid bitrate, input a valid bitrate for example 48kbps"
+    if lang and not is_valid_language(lang):
+        return "Invalid lang code"
+    frame_rate = data.get('frame_rate')
+    if frame_rate is not None and not (str(frame_rate).isdigit() and 1 <= int(frame_rate) <= 120):
+        return "Invalid frame_rate, input a whole number of frames per second for example 30"
+    try:
+        parse_clip(data)
+        parse_containers(data.get('container'))
+        parse_preset(data.get('preset') or data.get('format'), 'audio' if data.get('type') == 'audio' else 'video')
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+@app.route('/jobs', methods=['POST'])
+async def create_job():
+    data = await request.get_json()
+    if not data:
+        return jsonify({"error": "Missing request body."}), 400
+    url = data.get('url')
+
+    if not url:
+        return jsonify({"error": "Missing 'url' parameter in the request body."}), 400
+    if not is_valid_youtube_url(url):
+        return jsonify({"error": "Invalid YouTube URL."}), 400
+    error = job_options_error(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    job_id = await job_runner.submit(data)
+    logger.info(f"Queued job {job_id} for {url}")
+    return jsonify({"id": job_id, "state": "queued", "status_url": url_for('get_job', job_id=job_id, _external=True)}), 202
+
+
+def job_payload(job):
+    """What clients get to see of a job"""
+    payload = {
+        "id": job['id'],
+        "state": job['state'],
+        "stage": job['stage'],
+        "bytes_done": job['bytes_done'],
+        "bytes_total": job['bytes_total'],
+        "rate": job['rate'],
+        "attempts": job['attempts'],
+        "created": job['created'],
+        "updated": job['updated']
+    }
+    if job['rate'] and job['bytes_total'] > job['bytes_done']:
+        payload["eta"] = round((job['bytes_total'] - job['bytes_done']) / job['rate'], 1)
+    if job['encoded'] is not None:
+        payload["encode"] = {"encoded": job['encoded'], "duration": job['duration'], "speed": job['encode_speed']}
+        if job['duration']:
+            payload["encode"]["percent"] = round(min(100.0, 100 * job['encoded'] / job['duration']), 1)
+    if job['error']:
+        payload["error"] = job['error']
+    if job['result']:
+        result = dict(job['result'])
+        payload["download_link"] = url_for('get_file', filename=result.pop('filename'), _external=True)
+        payload["info"] = result
+    return payload
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if not job:
+        return jsonify({"error": "No job found for job id"}), 404
+    return jsonify(job_payload(job)), 200
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+async def cancel_job(job_id):
+    if not await job_runner.cancel(job_id):
+        job = await asyncio.to_thread(job_store.get, job_id)
+        if not job:
+            return jsonify({"error": "No job found for job id"}), 404
+        return jsonify({"error": f"Job already {job['state']}"}), 409
+    logger.info(f"Cancelled job {job_id}")
+    job = await asyncio.to_thread(job_store.get, job_id)
+    return jsonify(job_payload(job)), 200
+
+
+async def job_updates(job_id, keepalive=15):
+    """
+    Yield the payload of job_id whenever it changed, until the job is finished
+    or gone. Yields None after keepalive seconds without a change.
+    """
+    last = None
+    sent = time.monotonic()
+    while True:
+        job = await asyncio.to_thread(job_store.get, job_id)
+        if job is None:
+            return
+        payload = job_payload(job)
+        # updated moves with every heartbeat, only real changes are worth sending
+        changed = {key: value for key, value in payload.items() if key != 'updated'}
+        if changed != last:
+            last = changed
+            sent = time.monotonic()
+            yield payload
+        elif time.monotonic() - sent >= keepalive:
+            sent = time.monotonic()
+            yield None
+        if job['state'] in ('done', 'failed', 'cancelled'):
+            return
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+@app.route('/progress/<job_id>', methods=['GET'])
+async def job_progress(job_id):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if not job:
+        return jsonify({"error": "No job found for job id"}), 404
+
+    # Payloads carry download links, which need the request context
+    @stream_with_context
+    async def events():
+        async for payload in job_updates(job_id):
+            if payload is None:
+                # Comment line, keeps idle connections from being cut
+                yield b": keepalive\n\n"
+            else:
+                yield f"event: progress\ndata: {json.dumps(payload)}\n\n".encode()
+        yield b"event: end\ndata: {}\n\n"
+
+    response = Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Stop reverse proxies (Render's included) from buffering the stream
+        "X-Accel-Buffering": "no"
+    })
+    response.timeout = None
+    return response
+
+
+@app.websocket('/progress/<job_id>/ws')
+async def job_progress_ws(job_id):
+    async for payload in job_updates(job_id):
+        if payload is not None:
+            await websocket.send(json.dumps(payload))
+    await websocket.close(1000)
+
+
+def batch_item_payload(event):
+    """What clients get to see of a finished or running batch item"""
+    payload = {key: value for key, value in event.items() if key != 'result'}
+    if event.get('result'):
+        result = dict(event['result'])
+        payload["download_link"] = url_for('get_file', filename=result.pop('filename'), _external=True)
+        payload["info"] = result
+    return payload
+
+
+@app.route('/batch', methods=['POST'])
+async def batch_download():
+    """
+    Download many videos at once. Takes 'urls' (or a single 'url'): video,
+    playlist or channel urls, or objects with a 'url' and their own options.
+    Every other field is a download option applied to all items, as in /jobs.
+    Streams NDJSON: the expanded batch, each item's status as it changes,
+    and a final manifest of download links.
+    """
+    data = await request.get_json()
+    if not data:
+        return jsonify({"error": "Missing request body."}), 400
+    sources = data.get('urls') or ([data['url']] if data.get('url') else [])
+    if not isinstance(sources, list) or not sources:
+        return jsonify({"error": "Missing 'urls' parameter in the request body."}), 400
+    options = {key: value for key, value in data.items() if key not in ('url', 'urls', 'limit')}
+    error = job_options_error(options)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        limit = min(int(data.get('limit') or BATCH_MAX_ITEMS), BATCH_MAX_ITEMS)
+    except ValueError:
+        return jsonify({"error": f"The limit parameter must be an integer up to {BATCH_MAX_ITEMS}"}), 400
+
+    items = []
+    seen = set()  # Ids of the videos already in the batch
+    try:
+        for source in sources:
+            item_options = dict(options, **source) if isinstance(source, dict) else dict(options, url=source)
+            if not isinstance(item_options.get('url'), str):
+                return jsonify({"error": "Every item needs a 'url'."}), 400
+            error = job_options_error(item_options)
+            if error:
+                return jsonify({"error": f"{item_options['url']}: {error}"}), 400
+            for url in await expand([item_options['url']], limit - len(items), seen):
+                items.append(dict(item_options, url=url))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        logger.error(f"Could not expand batch: {repr(e)}", exc_info=True)
+        return jsonify({"error": f"Server error : {repr(e)}"}), 500
+    if not items:
+        return jsonify({"error": "No videos found for the given urls."}), 400
+    logger.info(f"Running batch of {len(items)} videos")
+
+    # Download links need the request context
+    @stream_with_context
+    async def lines():
+        yield (json.dumps({"event": "batch", "total": len(items), "urls": [item['url'] for item in items]}) + "\n").encode()
+        manifest = [None] * len(items)
+        async for event in run_batch(items):
+            payload = batch_item_payload(event)
+            if event['status'] != 'running':
+                manifest[event['index']] = payload
+            yield (json.dumps({"event": "item", **payload}) + "\n").encode()
+        done = sum(1 for item in manifest if item['status'] == 'done')
+        yield (json.dumps({
+            "event": "manifest",
+            "total": len(items),
+            "done": done,
+            "failed": len(items) - done,
+            "items": manifest
+        }) + "\n").encode()
+
+    response = Response(lines(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+    response.timeout = None
+    return response
+
+
 @app.route('/captions/<lang>',methods=["GET"])
 async def get_subtitles(lang):
     lang = lang.lower()
@@ -552,7 +996,7 @@ async def get_subtitles(lang):
         return jsonify({"error": "File format not specfied"}), 400
     
     try:
-      yt = await asyncio.to_thread(create_youtube_with_retry, url)
+      yt = await get_youtube(url)
       caption, error_message = await asyncio.to_thread(get_captions,yt,lang)
       if caption:
           if out_format in ('srt', 'txt'):
@@ -573,6 +1017,10 @@ async def get_subtitles(lang):
               return jsonify({"data":raw}), 200
       else:
         return jsonify({"error":error_message}), 500
+    except TerminalVideoError as e:
+        return jsonify(e.to_dict()), e.status
+    except Overloaded as e:
+        return jsonify(e.to_dict()), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"An error occored downloading content:{repr(e)}")
         return jsonify({"error": f"Server error : {repr(e)}"}), 500
@@ -590,18 +1038,42 @@ async def get_file(filename):
 
 def clear_temp_directory():
   logging.info("Clearing temp files")
+  reclaim_partials(TEMP_DIR)
   now = time.time()
-  for filename in os.listdir(TEMP_DIR): 
-    file_path = os.path.join(TEMP_DIR, filename) 
+  # Files handed out, plus what crashed builds and relays left in their own directories
+  directories = [TEMP_DIR] + glob.glob(os.path.join(TEMP_DIR, 'build', '*')) + glob.glob(os.path.join(TEMP_DIR, 'relay', '*'))
+  for directory in directories:
     try:
-      file_age = now - os.path.getmtime(file_path)
-      if os.path.isfile(file_path) and file_age > 86400:
-        os.remove(file_path)
-        logger.info(f"sucessfull deleted {file_path}")
-    except Exception as e: 
-      logger.error(f'Failed to delete {file_path}. Reason: {repr(e)}')
+      # A build touches its directory when it starts, a fresh one may be about to be used
+      stale = now - os.path.getmtime(directory) > 86400
+      filenames = os.listdir(directory)
+    except FileNotFoundError:
+      continue  # Finished while we were at it
+    for filename in filenames:
+      file_path = os.path.join(directory, filename)
+      try:
+        file_age = now - os.path.getmtime(file_path)
+        # Partial downloads are left to reclaim_partials, which knows when they are still being written
+        if os.path.isfile(file_path) and not filename.endswith(('.part', '.part.json')) and file_age > 86400:
+          os.remove(file_path)
+          logger.info(f"sucessfull deleted {file_path}")
+      except FileNotFoundError:
+        pass  # Another worker got to it first
+      except Exception as e:
+        logger.error(f'Failed to delete {file_path}. Reason: {repr(e)}')
+    if directory != TEMP_DIR and stale:
+      try:
+        os.rmdir(directory)
+      except OSError:
+        pass  # Still in use
   logger.info("Temp files cleared")
 
+
+async def clear_temp_directory_daily():
+  while True:
+    await asyncio.to_thread(clear_temp_directory)
+    await asyncio.sleep(86400)
+
 @app.after_request
 async def add_dev_details(response):
     if response.content_type == 'application/json':
@@ -627,8 +1099,4 @@ if __name__ == '__main__':
     else:
         logger.info("Tor is disabled. Set USE_TOR=True to enable.")
     
-    if not DEBUG:
-      scheduler = BackgroundScheduler()
-      scheduler.add_job(clear_temp_directory, "interval", days=1)
-      scheduler.start()
     app.run(debug=DEBUG)
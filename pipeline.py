@@ -0,0 +1,499 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from urllib.parse import quote
+import progress
+from admission import fetch_pool, mux_pool, encode_pool
+from cache import media_cache
+from diskbudget import disk_budget, footprint
+from downloader import iter_stream
+from relay import stream_relay
+from editor import (render_video, cut_clip, transcode, split_at_keyframes, shift_subtitles, burn_segment, concat_segments,
+                    collect_stderr, kill_process_group)
+from planner import CONTAINERS, PRESETS, plan, codec_args, stream_codecs
+from singleflight import SingleFlight
+from utils import acquire_budget, download_stream, download_streams, delete_file_after_delay
+from settings import (TEMP_DIR, EXPIRATION_DELAY, SINGLEFLIGHT_CROSS_WORKER, MEDIA_CACHE_PASSTHROUGH,
+                      PARALLEL_BURN_SEGMENTS, PARALLEL_BURN_MIN_SEGMENT, FFMPEG_STDERR_LINES)
+
+logger = logging.getLogger(__name__)
+
+# Identical artifacts being built in this worker (or, with the file lock, any worker)
+media_flight = SingleFlight('media', cross_worker=SINGLEFLIGHT_CROSS_WORKER)
+# Bytes read from ffmpeg per chunk sent to the client
+_STREAM_CHUNK = 64 * 1024
+
+
+def build_dir(key):
+    """Working directory for building the artifact with key, stable so partial downloads can resume"""
+    return os.path.join(TEMP_DIR, 'build', key[:16])
+
+
+async def cached_media(video_id, itags, recipe, build, size):
+    """
+    Path in TEMP_DIR of the file made from video_id's streams itags with recipe.
+
+    Served from the media cache when it was made before. Otherwise `await
+    build(workdir)` makes it within a disk reservation of size bytes, and
+    concurrent requests for the same artifact wait for that build instead
+    of starting their own.
+    """
+    key = media_cache.key(video_id, itags, recipe)
+
+    async def produce():
+        cached = await asyncio.to_thread(media_cache.get, key)
+        if cached:
+            return cached
+        workdir = build_dir(key)
+        os.makedirs(workdir, exist_ok=True)
+        # Keeps the temp sweep from taking a directory left by an earlier attempt from under us
+        os.utime(workdir)
+        async with disk_budget.reservation(workdir, size):
+            built = await build(workdir)
+            path = await asyncio.to_thread(media_cache.put, key, built)
+            if path == built:
+                # Not cached (disabled or too large), hand the file itself out
+                handout = os.path.join(TEMP_DIR, media_cache.handout_name(key, os.path.basename(built)))
+                path = await asyncio.to_thread(shutil.move, built, handout)
+        shutil.rmtree(workdir, ignore_errors=True)
+        return path
+
+    # get touches the entry, a write that may wait on other workers
+    cached = await asyncio.to_thread(media_cache.get, key)
+    if cached:
+        logger.info(f"Serving {os.path.basename(cached)} from the media cache")
+    else:
+        cached = await media_flight.do(key, produce)
+    return await asyncio.to_thread(media_cache.link, key, cached, TEMP_DIR)
+
+
+def video_recipe(audio_stream=None, caption=None, burn=True, lang=None, translate=False):
+    """Processing recipe of a video file, part of its media cache key"""
+    recipe = {'mux': audio_stream is not None}
+    if caption:
+        recipe.update(subtitle=lang, burn=bool(burn), translate=bool(translate))
+    return recipe
+
+
+def output_plan(video_stream, audio_stream, containers, subtitles=False, reencode=False, paths=(None, None)):
+    """
+    planner.plan for making a file out of video_stream and/or audio_stream.
+    Codecs come from the probe cache, from probing the downloaded files at
+    paths or from the manifest. Without a separate audio stream the audio
+    inside the video is kept.
+    """
+    video_path, audio_path = paths
+    video = stream_codecs(video_stream, video_path) if video_stream else {'video': None, 'audio': None}
+    audio = stream_codecs(audio_stream, audio_path)['audio'] if audio_stream else video['audio']
+    return plan(video['video'], audio, containers or ['mp4'], subtitles=subtitles, reencode=reencode)
+
+
+async def produce_video(yt, video_stream, audio_stream=None, caption=None, burn=True, lang=None, translate=False, containers=None):
+    """
+    Video file for yt: video_stream, muxed with audio_stream and with caption
+    added when given, in whichever of containers (best first) takes the
+    streams with the least transcoding.
+    """
+    recipe = video_recipe(audio_stream, caption, burn, lang, translate)
+    rendered = audio_stream is not None or caption is not None
+    if rendered:
+        recipe['container'] = output_plan(video_stream, audio_stream, containers, bool(caption), bool(caption and burn))['container']
+    progress.media_duration(yt.length)
+
+    async def build(workdir):
+        progress.stage('downloading')
+        if audio_stream:
+            # Both transfers run at once, so this takes as long as the larger one
+            video_file, audio_file = await download_streams(video_stream, audio_stream, output_path=workdir)
+        else:
+            video_file, audio_file = await download_stream(video_stream, workdir), None
+        if not audio_file and not caption:
+            return video_file
+
+        # The first download of an itag is probed, so the plan rests on what is really in the files
+        render = await asyncio.to_thread(
+            output_plan, video_stream, audio_stream, [recipe['container']], bool(caption), bool(caption and burn),
+            (video_file, audio_file)
+        )
+        caption_file = caption.srt() if caption else None
+        name = os.path.splitext(os.path.basename(video_file))[0]
+        output = os.path.join(workdir, f"{'subtitled' if caption else 'combined'}_{name}.{render['ext']}")
+        logger.info(f"Rendering {video_file} + {audio_file} + {caption_file} -> {output}")
+        progress.stage('subtitles' if caption else 'muxing')
+        pieces = burn_pieces(yt.length) if caption_file and burn and render['video'] != 'copy' else 1
+        if pieces > 1:
+            video_file = await burn_in_parallel(video_file, output, audio_file, caption_file, render, yt.length, pieces)
+        else:
+            # Copying streams is pure I/O, a transcode (burning in subtitles included) works on every frame
+            async with (mux_pool if render['video'] == 'copy' else encode_pool).slot():
+                video_file = await render_video(video_file, output, audio_file, caption_file, burn, lang, render)
+        if caption_file:
+            threading.Thread(target=delete_file_after_delay, args=(caption_file, EXPIRATION_DELAY)).start()
+        return video_file
+
+    itags = [video_stream.itag, audio_stream.itag if audio_stream else None]
+    size = footprint(video_stream, audio_stream, subtitled=bool(caption))
+    return await cached_media(yt.video_id, itags, recipe, build, size)
+
+
+def burn_pieces(duration):
+    """Pieces to burn subtitles into a video of duration seconds in, 1 for a single ffmpeg run"""
+    if not duration:
+        return 1
+    return max(1, min(PARALLEL_BURN_SEGMENTS, int(duration // PARALLEL_BURN_MIN_SEGMENT)))
+
+
+async def burn_in_parallel(video_file, output, audio_file, caption_file, render, duration, pieces):
+    """
+    Like render_video burning in caption_file, but with one ffmpeg per piece.
+
+    The video is split at keyframes, each piece gets the subtitles shifted to
+    its own start and the burned pieces are joined without re-encoding. One
+    worker waits for an encode slot like any encode does, further ones only
+    start on slots free right now, so a long video never queues ahead of
+    other work and never burns more pieces at once than the pool allows.
+    """
+    workdir = os.path.join(os.path.dirname(output), 'pieces')
+    async with mux_pool.slot():
+        segments = await split_at_keyframes(video_file, workdir, duration, pieces)
+
+    pending = list(enumerate(segments))
+    burned = [None] * len(segments)
+    written = [0.0] * len(segments)
+    speeds = [0.0] * len(segments)
+
+    def report(index):
+        def update(event):
+            written[index], speeds[index] = event['out_time'] or written[index], event['speed'] or 0.0
+            progress.encode_progress(sum(written), sum(speeds))
+        return update
+
+    async def worker(acquired):
+        try:
+            while pending:
+                index, (path, start, end) = pending.pop(0)
+                subtitles = os.path.join(workdir, f'segment_{index:03d}.srt')
+                cues = await asyncio.to_thread(shift_subtitles, caption_file, subtitles, start, end)
+                burned[index] = await burn_segment(
+                    path, subtitles if cues else None, os.path.join(workdir, f'burned_{index:03d}.mkv'), render, report(index)
+                )
+        except BaseException:
+            pending.clear()
+            raise
+        finally:
+            encode_pool.release(acquired)
+
+    slots = [await encode_pool.acquire()]
+    while len(slots) < len(segments):
+        acquired = encode_pool.try_acquire()
+        if acquired is None:
+            break
+        slots.append(acquired)
+    logger.info(f"Burning subtitles into {len(segments)} pieces of {video_file}, {len(slots)} at a time")
+    results = await asyncio.gather(*(worker(acquired) for acquired in slots), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    async with mux_pool.slot():
+        output = await concat_segments(burned, output, audio_file, render)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return output
+
+
+async def produce_audio(yt, audio_stream):
+    """Audio file for yt from audio_stream"""
+    async def build(workdir):
+        progress.stage('downloading')
+        return await download_stream(audio_stream, workdir)
+
+    return await cached_media(yt.video_id, [audio_stream.itag], {}, build, footprint(audio_stream))
+
+
+async def produce_clip(yt, video_stream, audio_stream, start, end, exact=False, containers=None):
+    """
+    File with start to end (in seconds) of yt, from video_stream and/or
+    audio_stream. ffmpeg seeks in the streams through the stream relay, so
+    only the byte ranges around the clip are downloaded. Video is copied
+    (the clip then starts on the keyframe at or before start) unless exact.
+    The container is picked from containers like for produce_video, by
+    default the one of the streams.
+    """
+    streams = [stream for stream in (video_stream, audio_stream) if stream]
+    recipe = {'mux': len(streams) == 2, 'clip': [start, end], 'exact': bool(exact and video_stream)}
+    if not containers:
+        containers = [streams[0].subtype] if streams[0].subtype in CONTAINERS else ['mp4']
+    render = output_plan(video_stream, audio_stream, containers, reencode=recipe['exact'])
+    recipe['container'] = render['container']
+    progress.media_duration(end - start)
+
+    async def build(workdir):
+        for _ in streams:
+            await acquire_budget()
+        name = os.path.splitext(streams[0].default_filename)[0]
+        output = os.path.join(workdir, f"clip_{start:g}-{end:g}_{name}.{render['ext']}")
+        progress.stage('clipping')
+        with contextlib.ExitStack() as relays:
+            inputs = [relays.enter_context(stream_relay.serve(stream)) for stream in streams]
+            # ffmpeg reads from upstream through the relay for as long as it cuts
+            async with fetch_pool.slot(), (mux_pool if render['video'] in (None, 'copy') else encode_pool).slot():
+                return await cut_clip(inputs, output, start, end, recipe['exact'], render)
+
+    itags = [stream.itag for stream in streams]
+    # Only the clip itself is written; bitrates are roughly constant, so it takes its share of the streams
+    share = min(1, (end - start) / yt.length) if yt.length else 1
+    size = int(sum(stream.filesize_approx or 0 for stream in streams) * share)
+    return await cached_media(yt.video_id, itags, recipe, build, size)
+
+
+async def produce_preset(yt, preset, video_stream=None, audio_stream=None):
+    """
+    File for yt made with preset (a planner.PRESETS name) from video_stream
+    and/or audio_stream. Kept in the media cache under the preset, so each
+    preset of a video is transcoded once however often it is asked for.
+    """
+    streams = [stream for stream in (video_stream, audio_stream) if stream]
+    progress.media_duration(yt.length)
+
+    async def build(workdir):
+        progress.stage('downloading')
+        if len(streams) == 2:
+            inputs = await download_streams(video_stream, audio_stream, output_path=workdir)
+        else:
+            inputs = [await download_stream(streams[0], workdir)]
+        name = os.path.splitext(os.path.basename(inputs[0]))[0]
+        output = os.path.join(workdir, f"{name}_{preset}.{PRESETS[preset]['ext']}")
+        progress.stage('transcoding')
+        # Audio encodes at many times real time, video works on every frame
+        async with (encode_pool if PRESETS[preset]['source'] == 'video' else mux_pool).slot():
+            return await transcode(inputs, output, preset)
+
+    itags = [stream.itag for stream in streams]
+    size = footprint(streams[0], streams[1] if len(streams) == 2 else None, transcoded=True)
+    return await cached_media(yt.video_id, itags, {'preset': preset}, build, size)
+
+
+async def cached_stream(yt, stream, recipe):
+    """Path of stream's file made with recipe if the media cache has it, else None"""
+    return await asyncio.to_thread(media_cache.get, media_cache.key(yt.video_id, [stream.itag], recipe))
+
+
+async def passthrough(yt, stream, recipe, start=0, end=None):
+    """
+    Relay bytes start to end of stream from upstream as they arrive.
+
+    Returns an async iterator of chunks, read from upstream only as fast as
+    they are consumed. Nothing is written to disk unless MEDIA_CACHE_PASSTHROUGH
+    is on and the whole file is asked for, in which case it is also kept in
+    the media cache under recipe. A fetch slot is taken before the response
+    starts and held until the relay ends, like for a download.
+    """
+    await acquire_budget()
+    # Without a contentLength in the manifest this asks googlevideo, later reads are cached
+    size = await asyncio.to_thread(getattr, stream, 'filesize')
+    end = size - 1 if end is None else end
+    key = media_cache.key(yt.video_id, [stream.itag], recipe)
+    keep = MEDIA_CACHE_PASSTHROUGH and media_cache.enabled and start == 0 and end == size - 1
+    release = _release_once(fetch_pool, await fetch_pool.acquire())
+    relay = _passthrough(stream, start, end, key if keep else None, release)
+    # An async generator that never started doesn't run its finally
+    weakref.finalize(relay, release)
+    return relay
+
+
+def _next_chunk(chunks, file):
+    chunk = next(chunks, None)
+    if chunk and file:
+        file.write(chunk)
+    return chunk
+
+
+async def _passthrough(stream, start, end, key, release):
+    stop = threading.Event()
+    chunks = iter_stream(stream, start, end, stop=stop)
+    file = path = reservation = None
+    sent = 0
+    try:
+        if key:
+            file, path, reservation = await asyncio.to_thread(_open_copy, stream, key)
+        while True:
+            # One hop to a thread per chunk; to_thread carries the request's egress along
+            chunk = await asyncio.to_thread(_next_chunk, chunks, file)
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+        logger.info(f"Relayed {sent} bytes of {stream.default_filename}")
+    finally:
+        # Ends the upstream transfer if the client went away first
+        stop.set()
+        release()
+        if file:
+            file.close()
+            try:
+                # A build of the same file may have been cached meanwhile
+                if sent == stream.filesize and not await asyncio.to_thread(media_cache.get, key):
+                    await asyncio.to_thread(media_cache.put, key, path)
+            except OSError as e:
+                logger.warning(f"Could not keep the relayed copy of {stream.default_filename}: {repr(e)}")
+            finally:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                await asyncio.to_thread(disk_budget.release, reservation)
+
+
+def _open_copy(stream, key):
+    """
+    File to keep a copy of a relayed stream in, in a directory of its own
+    so it never meets a build or another relay of the same file. Returns
+    (file, path, disk reservation), or Nones when the disk has no room for
+    it right now; the relay then goes on without keeping a copy.
+    """
+    relay_dir = os.path.join(TEMP_DIR, 'relay')
+    os.makedirs(relay_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f'{key[:16]}-', dir=relay_dir)
+    reservation, _ = disk_budget.try_reserve(workdir, stream.filesize)
+    if not reservation:
+        logger.info(f"No disk space to keep a copy of {stream.default_filename}, only relaying it")
+        os.rmdir(workdir)
+        return None, None, None
+    path = os.path.join(workdir, stream.default_filename)
+    return open(path, 'wb'), path, reservation
+
+
+def attachment_headers(filename):
+    """Content-Disposition for sending filename as a download, safe for non ascii titles"""
+    fallback = filename.encode('ascii', 'ignore').decode().replace('"', '') or 'download'
+    return {"Content-Disposition": f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"}
+
+
+def _feed(stream, fd, stop):
+    """Copy stream from upstream into the pipe fd until done, ffmpeg exits or stop is set"""
+    try:
+        for chunk in iter_stream(stream, stop=stop):
+            view = memoryview(chunk)
+            while view:
+                # Blocks while ffmpeg is behind, which in turn stops reading upstream
+                written = os.write(fd, view)
+                view = view[written:]
+    except BrokenPipeError:
+        pass  # ffmpeg went away, its exit status tells why
+    finally:
+        os.close(fd)
+
+
+async def mux_stream(video_stream, audio_stream=None):
+    """
+    Mux streams with ffmpeg straight from upstream into fragmented MP4.
+
+    Each stream is fed to ffmpeg through its own pipe by a thread reading it
+    from googlevideo, and nothing touches the disk. Returns an async iterator
+    of output chunks to hand to a streaming response; it only reads from
+    ffmpeg as fast as the client takes the bytes.
+
+    The mux slot is taken up front, so a full queue still turns the client
+    away with 503 before the response starts; ffmpeg only starts once the
+    response pulls from the iterator. The slot goes back when the relay is
+    done, or when the iterator is dropped without ever being started.
+    """
+    streams = [stream for stream in (video_stream, audio_stream) if stream]
+    for _ in streams:
+        await acquire_budget()
+    release = _release_once(mux_pool, await mux_pool.acquire())
+    relay = _relay(streams, audio_stream, release)
+    # An async generator that never started doesn't run its finally
+    weakref.finalize(relay, release)
+    return relay
+
+
+def _release_once(pool, acquired):
+    """Function giving acquired back to pool the first time it is called"""
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            pool.release(acquired)
+    return release
+
+
+async def _start_mux(streams, audio_stream):
+    pipes = [os.pipe() for _ in streams]
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for read_fd, _ in pipes:
+        command += ['-i', f'pipe:{read_fd}']
+    if audio_stream:
+        command += ['-map', '0:v:0', '-map', '1:a:0']
+    # Fragmented MP4 is all a browser can play while it downloads, copy whatever it takes as it is
+    command += codec_args(output_plan(streams[0], audio_stream, ['mp4']))
+    command += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1']
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=[read_fd for read_fd, _ in pipes],
+            start_new_session=True
+        )
+    except BaseException:
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+        raise
+    for read_fd, _ in pipes:
+        os.close(read_fd)
+
+    stop = threading.Event()
+    # to_thread copies the context, so the feeders go out through the request's egress
+    feeders = [asyncio.ensure_future(asyncio.to_thread(_feed, stream, write_fd, stop))
+               for stream, (_, write_fd) in zip(streams, pipes)]
+    logger.info(f"Streaming {len(streams)} stream(s) through ffmpeg (pid {process.pid})")
+    return process, feeders, stop
+
+
+async def _relay(streams, audio_stream, release):
+    # The mux slot is held until the relay is done with ffmpeg
+    try:
+        process, feeders, stop = await _start_mux(streams, audio_stream)
+    except BaseException:
+        release()
+        raise
+    tail = collections.deque(maxlen=FFMPEG_STDERR_LINES)
+    stderr = asyncio.ensure_future(collect_stderr(process.stderr, tail))
+    sent = 0
+    try:
+        while True:
+            chunk = await process.stdout.read(_STREAM_CHUNK)
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+        returncode = await process.wait()
+        if returncode:
+            await stderr
+            errors = '\n'.join(tail)
+            logger.error(f"ffmpeg exited with {returncode} after {sent} bytes: {errors}")
+        else:
+            logger.info(f"Streamed {sent} bytes")
+    finally:
+        # Client gone or ffmpeg done: stop the feeders and make sure ffmpeg is gone too
+        stop.set()
+        await kill_process_group(process)
+        for feeder in feeders:
+            # They end on their own once stop is seen or the pipe breaks
+            feeder.add_done_callback(_log_feeder_exit)
+        stderr.cancel()
+        release()
+
+
+def _log_feeder_exit(feeder):
+    if not feeder.cancelled() and feeder.exception() is not None:
+        logger.debug(f"Stream feeder ended with {repr(feeder.exception())}")
@@ -0,0 +1,185 @@
+import json
+import logging
+import subprocess
+from cache import probe_cache
+from settings import CODECS
+
+logger = logging.getLogger(__name__)
+
+# What each output container takes without transcoding (None: anything),
+# the subtitle codec it stores soft subtitles as, the encoders used when a
+# stream has to be converted for it and its file extensions with and without video
+CONTAINERS = {
+    'mp4': {
+        'video': {'h264', 'hevc', 'av1', 'vp9'},
+        'audio': {'aac', 'mp3', 'alac'},
+        'subtitle': 'mov_text',
+        'encoders': ('libx264', CODECS[1]),
+        'extensions': ('mp4', 'm4a'),
+    },
+    'webm': {
+        'video': {'vp8', 'vp9', 'av1'},
+        'audio': {'opus', 'vorbis'},
+        'subtitle': 'webvtt',
+        'encoders': ('libvpx-vp9', 'libopus'),
+        'extensions': ('webm', 'webm'),
+    },
+    'mkv': {
+        'video': None,
+        'audio': None,
+        'subtitle': 'srt',
+        'encoders': ('libx264', CODECS[1]),
+        'extensions': ('mkv', 'mka'),
+    },
+}
+# Quality settings of each video encoder
+ENCODER_ARGS = {
+    'libx264': ['-crf', '18', '-preset', 'fast', '-tune', 'film'],
+    'libvpx-vp9': ['-crf', '32', '-b:v', '0', '-row-mt', '1', '-deadline', 'good', '-cpu-used', '4'],
+}
+# Outputs clients can ask for by name instead of the streams YouTube has: the
+# source they are made from (audio only, or video downscaled to height), their
+# file extension and the ffmpeg output options making them
+PRESETS = {
+    'mp3-192': {'source': 'audio', 'ext': 'mp3', 'args': ['-c:a', 'libmp3lame', '-b:a', '192k']},
+    'mp3-128': {'source': 'audio', 'ext': 'mp3', 'args': ['-c:a', 'libmp3lame', '-b:a', '128k']},
+    'opus-96': {'source': 'audio', 'ext': 'opus', 'args': ['-c:a', 'libopus', '-b:a', '96k']},
+    'm4a-128': {'source': 'audio', 'ext': 'm4a', 'args': ['-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart']},
+    'mp4-480p-h264': {'source': 'video', 'height': 480, 'ext': 'mp4', 'args': [
+        '-vf', 'scale=-2:min(480\\,ih)', '-c:v', 'libx264', '-crf', '23', '-preset', 'fast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart'
+    ]},
+    'mp4-720p-h264': {'source': 'video', 'height': 720, 'ext': 'mp4', 'args': [
+        '-vf', 'scale=-2:min(720\\,ih)', '-c:v', 'libx264', '-crf', '23', '-preset', 'fast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart'
+    ]},
+}
+_MIMETYPES = {'video/mp4': 'mp4', 'video/webm': 'webm', 'video/x-matroska': 'mkv'}
+# Prefixes of the codec strings in YouTube's manifest and the ffprobe names they stand for
+_MANIFEST_CODECS = (
+    ('avc1', 'h264'), ('hev1', 'hevc'), ('hvc1', 'hevc'), ('av01', 'av1'), ('vp09', 'vp9'), ('vp9', 'vp9'),
+    ('vp8', 'vp8'), ('mp4a', 'aac'), ('opus', 'opus'), ('vorbis', 'vorbis'),
+)
+# A video transcode costs far more than an audio one
+_VIDEO_COST = 10
+
+
+def parse_containers(value):
+    """Output containers a client accepts, in order of preference, from a name or a list of names. Raises ValueError"""
+    if not value:
+        return ['mp4']
+    names = value.split(',') if isinstance(value, str) else list(value)
+    containers = []
+    for name in names:
+        name = _MIMETYPES.get(str(name).strip().lower(), str(name).strip().lower())
+        name = 'mkv' if name == 'matroska' else name
+        if name not in CONTAINERS:
+            raise ValueError(f"Unsupported container {name}, use one of {', '.join(CONTAINERS)}")
+        if name not in containers:
+            containers.append(name)
+    return containers
+
+
+def parse_preset(value, source=None):
+    """Name of the preset value asks for, None for none. Raises ValueError, also for presets not made from source"""
+    if not value:
+        return None
+    name = str(value).strip().lower()
+    if name not in PRESETS:
+        raise ValueError(f"Unknown preset {value}, use one of {', '.join(PRESETS)}")
+    if source and PRESETS[name]['source'] != source:
+        options = ', '.join(key for key, preset in PRESETS.items() if preset['source'] == source)
+        raise ValueError(f"Preset {name} is not a {source} preset, use one of {options}")
+    return name
+
+
+def accepted_containers(accept_mimetypes):
+    """Containers named in an Accept header, best first; empty when it names no video type"""
+    ranked = sorted(
+        ((quality, _MIMETYPES[mimetype]) for mimetype, quality in accept_mimetypes if mimetype in _MIMETYPES),
+        key=lambda item: -item[0]
+    )
+    return [container for quality, container in ranked if quality > 0]
+
+
+def _from_manifest(codec):
+    for prefix, name in _MANIFEST_CODECS:
+        if codec and codec.lower().startswith(prefix):
+            return name
+    return codec
+
+
+def probe(path):
+    """Codec names ffprobe finds in the first video and audio stream of path"""
+    output = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    codecs = {'video': None, 'audio': None}
+    for stream in json.loads(output).get('streams', []):
+        if stream.get('codec_type') in codecs and codecs[stream['codec_type']] is None:
+            codecs[stream['codec_type']] = stream.get('codec_name')
+    return codecs
+
+
+def stream_codecs(stream, path=None):
+    """
+    Codecs of stream. Probed from its downloaded file at path the first time
+    its itag is seen, otherwise read from the probe cache; without either the
+    codecs announced in the manifest are used.
+    """
+    codecs = probe_cache.get(stream.itag)
+    if codecs is not None:
+        return codecs
+    if path:
+        try:
+            codecs = probe(path)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            logger.warning(f"Could not probe {path}: {repr(e)}")
+        else:
+            probe_cache.set(stream.itag, codecs)
+            return codecs
+    return {
+        'video': _from_manifest(getattr(stream, 'video_codec', None)) if stream.includes_video_track else None,
+        'audio': _from_manifest(getattr(stream, 'audio_codec', None)) if stream.includes_audio_track else None,
+    }
+
+
+def plan(video, audio, containers, subtitles=False, reencode=False):
+    """
+    How to make the output from a video and an audio codec (either may be None).
+
+    Picks, from the containers the client accepts, the one needing the least
+    transcoding, earlier ones on a tie. Returns a dict with the container,
+    its file extension and the codec (or 'copy') for video, audio and
+    subtitles. reencode forces a video transcode, e.g. to burn in subtitles
+    (which then need no codec).
+    """
+    best = None
+    for container in containers:
+        spec = CONTAINERS[container]
+        copy_video = video is None or not reencode and (spec['video'] is None or video in spec['video'])
+        copy_audio = audio is None or spec['audio'] is None or audio in spec['audio']
+        cost = (0 if copy_video else _VIDEO_COST) + (0 if copy_audio else 1)
+        if best is None or cost < best[0]:
+            video_encoder, audio_encoder = spec['encoders']
+            best = (cost, {
+                'container': container,
+                'ext': spec['extensions'][0 if video else 1],
+                'video': None if video is None else 'copy' if copy_video else video_encoder,
+                'audio': None if audio is None else 'copy' if copy_audio else audio_encoder,
+                'subtitle': spec['subtitle'] if subtitles and not reencode else None,
+            })
+    return best[1]
+
+
+def codec_args(plan):
+    """ffmpeg output options for the codecs of plan"""
+    args = []
+    if plan['video']:
+        args += ['-c:v', plan['video']] + ENCODER_ARGS.get(plan['video'], [])
+    if plan['audio']:
+        args += ['-c:a', plan['audio']]
+    if plan['subtitle']:
+        args += ['-c:s', plan['subtitle']]
+    return args
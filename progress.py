@@ -0,0 +1,135 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Progress tracker of the current job. asyncio copies the context into tasks
+# and asyncio.to_thread calls, so download threads report to the right job.
+_current = contextvars.ContextVar('progress', default=None)
+# Transfer rates are averaged over this many seconds
+_RATE_WINDOW = 5
+
+
+class Progress:
+    """
+    Stage and byte counts of one download pipeline.
+
+    Every stream being transferred reports its own bytes done; the totals are
+    summed over all of them. on_change gets a snapshot at most once per
+    interval, and right away whenever the stage changes.
+    """
+
+    def __init__(self, on_change=None, interval=1.0):
+        self.on_change = on_change
+        self.interval = interval
+        self.stage = 'queued'
+        self.duration = None  # seconds of media, to turn encode progress into a fraction
+        self.encoded = None  # seconds of media ffmpeg has written so far
+        self.encode_speed = None
+        self._streams = {}  # stream key -> (bytes done, bytes total)
+        self._samples = deque()  # (time, bytes done) over the last _RATE_WINDOW seconds
+        self._lock = threading.Lock()
+        self._notified = 0.0
+
+    def set_stage(self, stage):
+        with self._lock:
+            self.stage = stage
+            self.encoded = self.encode_speed = None
+        self._notify(force=True)
+
+    def update(self, key, done, total):
+        now = time.monotonic()
+        with self._lock:
+            self._streams[key] = (done, total)
+            self._samples.append((now, sum(done for done, _ in self._streams.values())))
+            while now - self._samples[0][0] > _RATE_WINDOW:
+                self._samples.popleft()
+        self._notify()
+
+    def encode(self, encoded, speed):
+        with self._lock:
+            self.encoded = encoded
+            self.encode_speed = speed
+        self._notify()
+
+    def snapshot(self):
+        with self._lock:
+            bytes_done = sum(done for done, _ in self._streams.values())
+            bytes_total = sum(total for _, total in self._streams.values())
+            rate = None
+            if len(self._samples) > 1 and self._samples[-1][0] > self._samples[0][0]:
+                (first_time, first_done), (last_time, last_done) = self._samples[0], self._samples[-1]
+                rate = (last_done - first_done) / (last_time - first_time)
+            return {
+                "stage": self.stage,
+                "bytes_done": bytes_done,
+                "bytes_total": bytes_total,
+                "rate": rate and round(rate),
+                "encoded": self.encoded and round(self.encoded, 2),
+                "duration": self.duration,
+                "encode_speed": self.encode_speed
+            }
+
+    def _notify(self, force=False):
+        if self.on_change is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._notified < self.interval:
+                return
+            self._notified = now
+        try:
+            self.on_change(self.snapshot())
+        except Exception as e:
+            logger.warning(f"Progress listener failed: {repr(e)}")
+
+
+def current():
+    """Progress tracker of the current job, None outside of jobs"""
+    return _current.get()
+
+
+@contextmanager
+def use(progress):
+    token = _current.set(progress)
+    try:
+        yield progress
+    finally:
+        _current.reset(token)
+
+
+def stage(name):
+    """Record that the current job moved on to stage name"""
+    progress = current()
+    if progress is not None:
+        progress.set_stage(name)
+
+
+def stream_progress(stream, done, total):
+    """Record done of total bytes of stream transferred for the current job"""
+    progress = current()
+    if progress is not None:
+        progress.update(stream.itag, done, total)
+
+
+def media_duration(seconds):
+    """Record the length of the media the current job is making"""
+    progress = current()
+    if progress is not None:
+        progress.duration = seconds
+
+
+def encode_progress(encoded, speed=None):
+    """Record how many seconds of media ffmpeg has written for the current job"""
+    progress = current()
+    if progress is not None:
+        progress.encode(encoded, speed)
+
+
+def on_progress(stream, chunk, bytes_remaining):
+    """pytubefix on_progress_callback, forwards single connection downloads to the current job"""
+    stream_progress(stream, stream.filesize - bytes_remaining, stream.filesize)
@@ -0,0 +1,183 @@
+import logging
+import random
+import threading
+import time
+from settings import PROXY_COOLDOWN, PROXY_MAX_COOLDOWN
+from egress import Egress
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+_ALPHA = 0.3
+# Latency assumed for proxies that haven't answered yet, so they still get picked
+_DEFAULT_LATENCY = 2.0
+# Consecutive plain errors before a proxy is taken out of rotation
+_FAILURE_THRESHOLD = 3
+# A probe that never reported back (e.g. its request was cancelled) is retried after this
+_PROBE_TIMEOUT = 60
+
+
+class ProxyState:
+    """Health of a single proxy"""
+
+    def __init__(self, index, proxy):
+        self.index = index
+        self.proxy = proxy
+        self.egress = Egress.from_proxy(proxy)
+        self.latency = None
+        self.error_rate = 0.0
+        self.rate_limit_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limits = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.cooldowns = 0
+        self.state = 'closed'
+        self.probing = False
+        self.probe_started = 0.0
+
+    @property
+    def server(self):
+        return self.proxy['server']
+
+    @property
+    def key(self):
+        return self.egress.key
+
+    def score(self, default_latency):
+        """Higher is better: fast proxies that rarely fail or get rate limited"""
+        latency = self.latency if self.latency is not None else default_latency
+        return 1 / (max(latency, 0.05) * (1 + 4 * self.error_rate) * (1 + 8 * self.rate_limit_rate))
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "server": self.server,
+            "type": self.proxy.get('type'),
+            "state": self.state,
+            "latency": self.latency and round(self.latency, 3),
+            "error_rate": round(self.error_rate, 3),
+            "rate_limit_rate": round(self.rate_limit_rate, 3),
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limits": self.rate_limits,
+            "cooldown_remaining": max(0, round(self.cooldown_until - time.time(), 1))
+        }
+
+
+class ProxyPool:
+    """
+    Pick proxies by a score built from moving averages of latency, error rate
+    and 429 rate.
+
+    A proxy that gets rate limited, or fails several times in a row, is put on
+    a cooldown that doubles every time it happens again. Once the cooldown is
+    over a single request is let through as a probe (half open); success puts
+    the proxy back into rotation, failure starts a longer cooldown.
+    """
+
+    def __init__(self, proxies, cooldown=PROXY_COOLDOWN, max_cooldown=PROXY_MAX_COOLDOWN):
+        self.states = [ProxyState(i, proxy) for i, proxy in enumerate(proxies)]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.states)
+
+    def acquire(self):
+        """Return the ProxyState to use for the next request, or None without proxies"""
+        ranked = self.ranked()
+        if not ranked:
+            return None
+        self.take(ranked[0])
+        return ranked[0]
+
+    def ranked(self):
+        """
+        Every proxy worth trying for the next request, best first: a proxy
+        due for its probe after a cooldown, then the healthy ones in a random
+        order weighted by score. Hand the one used to take().
+        """
+        if not self.states:
+            return []
+        now = time.time()
+        with self._lock:
+            probes = [
+                state for state in self.states
+                if state.state != 'closed' and state.cooldown_until <= now
+                and (not state.probing or now - state.probe_started > _PROBE_TIMEOUT)
+            ]
+            available = [state for state in self.states if state.state == 'closed']
+            if not probes and not available:
+                # Everything is cooling down, use whatever recovers first rather than nothing
+                state = min(self.states, key=lambda s: s.cooldown_until)
+                logger.warning(f"All proxies are cooling down, falling back to {state.server}")
+                return [state]
+
+            latencies = [state.latency for state in available if state.latency is not None]
+            default_latency = sum(latencies) / len(latencies) if latencies else _DEFAULT_LATENCY
+            # Weighted shuffle: each proxy draws random() ** (1 / weight), highest draw first
+            draws = {state.index: random.random() ** (1 / state.score(default_latency)) for state in available}
+            return probes[:1] + sorted(available, key=lambda state: draws[state.index], reverse=True)
+
+    def take(self, state):
+        """Record that the next request goes through state, starting its probe when it is cooling down"""
+        with self._lock:
+            if state.state != 'closed' and state.cooldown_until <= time.time():
+                # Recovered proxies are probed with one request before rejoining the rotation
+                state.state = 'half_open'
+                state.probing = True
+                state.probe_started = time.time()
+                logger.info(f"Probing proxy {state.server} after cooldown")
+
+    def report(self, state, latency=None, ok=True, rate_limited=False):
+        """Record the outcome of a request made through state"""
+        if state is None:
+            return
+        with self._lock:
+            state.requests += 1
+            state.error_rate += _ALPHA * ((0.0 if ok else 1.0) - state.error_rate)
+            state.rate_limit_rate += _ALPHA * ((1.0 if rate_limited else 0.0) - state.rate_limit_rate)
+            if ok:
+                if latency is not None:
+                    state.latency = latency if state.latency is None else state.latency + _ALPHA * (latency - state.latency)
+                state.consecutive_failures = 0
+                if state.state != 'closed':
+                    logger.info(f"Proxy {state.server} recovered")
+                state.state = 'closed'
+                state.cooldowns = 0
+                state.probing = False
+                return
+
+            state.failures += 1
+            state.consecutive_failures += 1
+            if rate_limited:
+                state.rate_limits += 1
+            if rate_limited or state.state == 'half_open' or state.consecutive_failures >= _FAILURE_THRESHOLD:
+                self._open(state)
+
+    def find_egress(self, key, generation=None):
+        """Egress of the proxy with key pinned to generation, None if it isn't configured in this process"""
+        for state in self.states:
+            if state.key == key:
+                return state.egress.pinned(generation)
+        return None
+
+    def exhausted(self):
+        """True when every proxy is cooling down"""
+        with self._lock:
+            return bool(self.states) and all(state.state != 'closed' for state in self.states)
+
+    def stats(self):
+        with self._lock:
+            return [state.to_dict() for state in self.states]
+
+    def _open(self, state):
+        cooldown = min(self.cooldown * (2 ** state.cooldowns), self.max_cooldown)
+        state.cooldowns += 1
+        state.cooldown_until = time.time() + cooldown
+        state.state = 'open'
+        state.probing = False
+        logger.warning(f"Proxy {state.server} cooling down for {cooldown}s")
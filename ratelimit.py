@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import math
+import sqlite3
+import time
+from cache import SqliteStore
+from settings import RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request should be retried later instead of being served now"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+
+    def to_dict(self):
+        return {"error": self.message, "retry_after": self.retry_after}
+
+
+class RateLimited(Overloaded):
+    """No egress identity has upstream budget left"""
+
+
+class TokenBucketLimiter(SqliteStore):
+    """
+    Token buckets per upstream egress identity (direct, each proxy, each Tor identity).
+
+    Bucket state lives in sqlite so every hypercorn worker draws from the same
+    budget. Each upstream call costs a token; buckets refill at `rate` tokens
+    per second up to `burst`.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, name='ratelimit.sqlite3', rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST):
+        super().__init__(name)
+        self.rate = rate
+        self.burst = burst
+        self.counters = {'granted': 0, 'delayed': 0, 'rejected': 0}
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def try_acquire(self, key, cost=1):
+        """Take cost tokens from key's bucket. Returns 0 on success, else the seconds until enough have refilled"""
+        if not self.enabled:
+            return 0
+        now = time.time()
+        with self._lock:
+            db = self.db()
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+                wait = 0 if tokens >= cost else (cost - tokens) / self.rate
+                if not wait:
+                    tokens -= cost
+                db.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+                db.execute('COMMIT')
+            except sqlite3.Error as e:
+                # Never fail a request because the limiter itself is unavailable
+                logger.warning(f"Rate limiter unavailable for {key}: {repr(e)}")
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                return 0
+        return wait
+
+    async def acquire(self, key, cost=1, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Wait up to max_wait seconds for budget on key, returns False if there won't be any in time"""
+        deadline = time.monotonic() + max_wait
+        delayed = False
+        while True:
+            # BEGIN IMMEDIATE waits on the other workers' writes
+            wait = await asyncio.to_thread(self.try_acquire, key, cost)
+            if not wait:
+                self.counters['granted'] += 1
+                self.counters['delayed'] += delayed
+                return True
+            if time.monotonic() + wait > deadline:
+                self.counters['rejected'] += 1
+                return False
+            delayed = True
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        now = time.time()
+        with self._lock:
+            try:
+                rows = self.db().execute('SELECT key, tokens, updated FROM buckets').fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read rate limiter state: {repr(e)}")
+                rows = []
+        return {
+            "enabled": True,
+            "rate": self.rate,
+            "burst": self.burst,
+            "buckets": {key: round(min(self.burst, tokens + (now - updated) * self.rate), 2) for key, tokens, updated in rows},
+            **self.counters
+        }
+
+
+rate_limiter = TokenBucketLimiter()
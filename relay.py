@@ -0,0 +1,115 @@
+import logging
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import egress
+from downloader import iter_stream
+
+logger = logging.getLogger(__name__)
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        entry = self.server.relay.lookup(self.path.strip('/'))
+        if entry is None:
+            self.send_error(404)
+            return
+        stream, route = entry
+        size = stream.filesize
+        start, end, status = 0, size - 1, 200
+        match = _RANGE.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', stream.mime_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not body:
+            return
+        stop = threading.Event()
+        try:
+            # Handler threads start with an empty context, go out the way the stream was registered
+            with egress.use(route):
+                for chunk in iter_stream(stream, start, end, stop=stop):
+                    self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg seeks by dropping the connection and asking for another range
+            pass
+        finally:
+            stop.set()
+
+    def log_message(self, format, *args):
+        logger.debug(f"relay: {format % args}")
+
+
+class StreamRelay:
+    """
+    Serves streams to local processes over HTTP with Range support.
+
+    ffmpeg can seek into a stream on a url, fetching only the byte ranges
+    it needs, but it cannot go out through our proxies or Tor identities.
+    Through the relay it reads from 127.0.0.1 while the bytes come from
+    googlevideo through the egress the stream's metadata was fetched with.
+    """
+
+    def __init__(self):
+        self._server = None
+        self._pid = None
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def _ensure_server(self):
+        with self._lock:
+            # Workers may be forked after import, the server thread does not survive that
+            if self._server is None or self._pid != os.getpid():
+                self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+                self._server.daemon_threads = True
+                self._server.relay = self
+                self._pid = os.getpid()
+                threading.Thread(target=self._server.serve_forever, name='stream-relay', daemon=True).start()
+                logger.info(f"Stream relay listening on 127.0.0.1:{self._server.server_port}")
+            return self._server
+
+    def lookup(self, token):
+        return self._streams.get(token)
+
+    @contextmanager
+    def serve(self, stream):
+        """Url on localhost serving stream through the current egress while the block runs"""
+        server = self._ensure_server()
+        token = uuid.uuid4().hex
+        self._streams[token] = (stream, egress.current())
+        try:
+            yield f'http://127.0.0.1:{server.server_port}/{token}'
+        finally:
+            self._streams.pop(token, None)
+
+
+stream_relay = StreamRelay()
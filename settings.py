@@ -8,6 +8,15 @@ USE_TOR = os.environ.get("USE_TOR", "False") == "True"
 TOR_PROXY_HOST = os.environ.get("TOR_PROXY_HOST", "127.0.0.1")
 TOR_PROXY_PORT = int(os.environ.get("TOR_PROXY_PORT", "9050"))
 TOR_CONTROL_PORT = int(os.environ.get("TOR_CONTROL_PORT", "9051"))
+# TOR_SOCKS_PORTS: Tor SocksPorts to spread requests over. Defaults to TOR_PROXY_PORT.
+TOR_SOCKS_PORTS = [int(port) for port in os.environ.get("TOR_SOCKS_PORTS", str(TOR_PROXY_PORT)).split(",") if port.strip()]
+# TOR_ISOLATION_IDENTITIES: SOCKS isolation identities (each with its own circuit) per Tor SocksPort.
+TOR_ISOLATION_IDENTITIES = int(os.environ.get("TOR_ISOLATION_IDENTITIES", 4))
+# TOR_PREWARM_CIRCUITS: Clean Tor circuits kept built ahead of time so rotated identities start on a warm circuit.
+TOR_PREWARM_CIRCUITS = int(os.environ.get("TOR_PREWARM_CIRCUITS", 2))
+# TOR_CIRCUIT_LIFETIME: Time (in seconds) Tor keeps a circuit for new connections (its MaxCircuitDirtiness).
+# Stream urls only work from the exit that fetched them, so cached ones fetched through Tor expire after this.
+TOR_CIRCUIT_LIFETIME = int(os.environ.get("TOR_CIRCUIT_LIFETIME", 600))
 
 # PROXY: list of proxies
 PROXIES = os.environ.get("PROXIES","").split(",")
@@ -43,3 +52,94 @@ AUTH_DIR = 'auth'
 AUTH_FILE_NAME = 'temp.json'
 # CODECS: List of supported codecs. Defaults to "avc1,acc" if not set, split into a tuple.
 CODECS = tuple(os.environ.get("CODECS", "avc1,aac").split(","))
+
+# CACHE_DIR: Directory for on-disk caches shared between hypercorn workers.
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+# METADATA_CACHE_TTL: Time (in seconds) a cached video metadata entry stays fresh. Defaults to 1 hour,
+# well below the ~6 hour lifetime of the signed stream urls stored alongside it.
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 3600))
+# METADATA_CACHE_SIZE: Maximum number of videos kept in the metadata cache before LRU eviction.
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 5000))
+# SINGLEFLIGHT_CROSS_WORKER: Also coalesce metadata fetches for the same video across hypercorn workers.
+SINGLEFLIGHT_CROSS_WORKER = os.environ.get("SINGLEFLIGHT_CROSS_WORKER", "True") == "True"
+# NEGATIVE_CACHE_TTL: Time (in seconds) unavailable, private, members-only, region-blocked, age-restricted
+# and live videos are remembered so repeat requests fail fast. Defaults to 10 minutes.
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", 600))
+# MEDIA_CACHE_SIZE: Disk space (in bytes) for finished downloads kept to answer repeat requests. 0 disables. Defaults to 5 GB.
+MEDIA_CACHE_SIZE = int(os.environ.get("MEDIA_CACHE_SIZE", 5_368_709_120))
+# MEDIA_CACHE_PASSTHROUGH: Also keep files relayed in pass-through mode in the media cache (full downloads only).
+MEDIA_CACHE_PASSTHROUGH = os.environ.get("MEDIA_CACHE_PASSTHROUGH", "False") == "True"
+# UPSTREAM_DEADLINE: Time (in seconds) all retries of a single metadata fetch may take together.
+UPSTREAM_DEADLINE = int(os.environ.get("UPSTREAM_DEADLINE", 45))
+# PROXY_COOLDOWN: Time (in seconds) a rate limited or failing proxy is taken out of rotation. Doubles on every repeat.
+PROXY_COOLDOWN = int(os.environ.get("PROXY_COOLDOWN", 30))
+# PROXY_MAX_COOLDOWN: Upper bound (in seconds) for the proxy cooldown.
+PROXY_MAX_COOLDOWN = int(os.environ.get("PROXY_MAX_COOLDOWN", 600))
+# RATE_LIMIT_RATE: Upstream requests per second each egress identity (direct, proxy, Tor identity) may make.
+# Defaults to 0, which disables the limiter; set it when YouTube starts answering with 429s.
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 0))
+# RATE_LIMIT_BURST: Requests an idle egress identity may make back to back.
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 10))
+# RATE_LIMIT_MAX_WAIT: Time (in seconds) a request queues for upstream budget before it is turned away.
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 5))
+# DOWNLOAD_CONCURRENCY: Stream downloads a worker runs against YouTube at the same time.
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 8))
+# LOOKUP_CONCURRENCY: Metadata lookups and searches a worker runs at the same time, apart from downloads so
+# long transfers can never hold up a quick answer.
+LOOKUP_CONCURRENCY = int(os.environ.get("LOOKUP_CONCURRENCY", 8))
+# MUX_CONCURRENCY: ffmpeg runs that only copy streams (muxing, soft subtitles) a worker does at the same time.
+MUX_CONCURRENCY = int(os.environ.get("MUX_CONCURRENCY", 2))
+# ENCODE_CONCURRENCY: ffmpeg runs that re-encode video (burned in subtitles) a worker does at the same time.
+ENCODE_CONCURRENCY = int(os.environ.get("ENCODE_CONCURRENCY", 1))
+# PARALLEL_BURN_SEGMENTS: Pieces a video is split into at keyframes to burn in subtitles with one ffmpeg per piece,
+# as many at a time as the encode pool has free slots. 1 burns in with a single ffmpeg run.
+PARALLEL_BURN_SEGMENTS = int(os.environ.get("PARALLEL_BURN_SEGMENTS", ENCODE_CONCURRENCY))
+# PARALLEL_BURN_MIN_SEGMENT: Shortest piece in seconds worth its own ffmpeg run, shorter videos get fewer pieces.
+PARALLEL_BURN_MIN_SEGMENT = int(os.environ.get("PARALLEL_BURN_MIN_SEGMENT", 60))
+# ENCODE_NICE: Niceness of re-encoding ffmpeg processes, so stream copies and requests keep the CPU they need.
+ENCODE_NICE = int(os.environ.get("ENCODE_NICE", 10))
+# FFMPEG_TIMEOUT: Time (in seconds) one ffmpeg run may take before it is killed, 0 for no limit.
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", 3 * 60 * 60))
+# FFMPEG_CPU_LIMIT: CPU time (in seconds, over all its threads) one ffmpeg run may use before it is killed, 0 for no limit.
+FFMPEG_CPU_LIMIT = int(os.environ.get("FFMPEG_CPU_LIMIT", 12 * 60 * 60))
+# FFMPEG_STDERR_LINES: Last lines of ffmpeg's output kept to explain why a run failed.
+FFMPEG_STDERR_LINES = int(os.environ.get("FFMPEG_STDERR_LINES", 40))
+# ADMISSION_QUEUE_*: Callers that may queue for a fetch, mux or encode slot before new ones are turned away with a 503.
+ADMISSION_QUEUE_LIMITS = {
+    'fetch': int(os.environ.get("ADMISSION_QUEUE_FETCH", 32)),
+    'lookup': int(os.environ.get("ADMISSION_QUEUE_LOOKUP", 64)),
+    'mux': int(os.environ.get("ADMISSION_QUEUE_MUX", 8)),
+    'encode': int(os.environ.get("ADMISSION_QUEUE_ENCODE", 2)),
+}
+# ADMISSION_MAX_WAIT: Time (in seconds) a queued caller waits for a slot before it is turned away with a 503.
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 60))
+# DOWNLOAD_CONNECTIONS_*: Parallel range requests per stream download, by how the request leaves the server.
+DOWNLOAD_CONNECTIONS = {
+    'direct': int(os.environ.get("DOWNLOAD_CONNECTIONS_DIRECT", 4)),
+    'proxy': int(os.environ.get("DOWNLOAD_CONNECTIONS_PROXY", 4)),
+    'tor': int(os.environ.get("DOWNLOAD_CONNECTIONS_TOR", 6)),
+}
+# DOWNLOAD_SEGMENT_SIZE: Bytes fetched per range request. Streams smaller than this use a single connection.
+DOWNLOAD_SEGMENT_SIZE = int(os.environ.get("DOWNLOAD_SEGMENT_SIZE", 9 * 1024 * 1024))
+# DOWNLOAD_RANGE_RETRIES: Times a failed range is retried before the download fails.
+DOWNLOAD_RANGE_RETRIES = int(os.environ.get("DOWNLOAD_RANGE_RETRIES", 3))
+# PARTIAL_DOWNLOAD_TTL: Time (in seconds) an unfinished download is kept around to be resumed.
+PARTIAL_DOWNLOAD_TTL = int(os.environ.get("PARTIAL_DOWNLOAD_TTL", 6 * 3600))
+# JOB_WORKERS: Background download jobs (POST /jobs) each hypercorn worker runs at the same time.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# JOB_TTL: Time (in seconds) finished jobs can still be looked up. Defaults to the file expiration.
+JOB_TTL = int(os.environ.get("JOB_TTL", EXPIRATION_DELAY))
+# JOB_MAX_ATTEMPTS: Times a job is started, e.g. again after its worker died, before it is marked failed.
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# PROGRESS_INTERVAL: Time (in seconds) between job progress updates sent over /progress/<id> (SSE and WebSocket).
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 1))
+# DISK_MIN_FREE: Disk space (in bytes) downloads never reserve, left free for everything else. Defaults to 512 MB.
+DISK_MIN_FREE = int(os.environ.get("DISK_MIN_FREE", 536_870_912))
+# DISK_MAX_WAIT: Time (in seconds) a download waits for disk space to be released before it is turned away.
+DISK_MAX_WAIT = float(os.environ.get("DISK_MAX_WAIT", 30))
+# DISK_RESERVATION_TTL: Time (in seconds) after which a reservation of a worker that never released it is dropped.
+DISK_RESERVATION_TTL = int(os.environ.get("DISK_RESERVATION_TTL", 6 * 3600))
+# BATCH_CONCURRENCY: Videos of one /batch request downloaded at the same time.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+# BATCH_MAX_ITEMS: Most videos a /batch request may ask for, after expanding playlists and channels.
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import logging
+import os
+from settings import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows, cross worker coalescing is not available
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# How often a worker polls a lock held by another worker
+_LOCK_POLL_INTERVAL = 0.05
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into a single in-flight call.
+
+    Every caller awaiting the same key shares the result or the exception of
+    the first (leader) call. The shared call only gets cancelled once every
+    caller waiting on it has been cancelled. With cross_worker enabled the
+    leader also holds a file lock so leaders for the same key in other
+    hypercorn workers run one after another, letting the later ones pick up
+    whatever the first one cached.
+    """
+
+    def __init__(self, name, cross_worker=False):
+        self.name = name
+        self.cross_worker = cross_worker and fcntl is not None
+        self._calls = {}
+        self._waiters = {}
+        self.counters = {
+            'leaders': 0,
+            'coalesced': 0,
+            'waiting': 0,
+            'cross_worker_waits': 0,
+            'errors': 0
+        }
+
+    async def do(self, key, fn):
+        """Run `await fn()` for key unless a call for key is already in flight, then wait on that one"""
+        task = self._calls.get(key)
+        if task is None:
+            self.counters['leaders'] += 1
+            task = asyncio.ensure_future(self._run(key, fn))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.counters['coalesced'] += 1
+            logger.debug(f"[{self.name}] joining in-flight call for {key}")
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        self.counters['waiting'] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                logger.debug(f"[{self.name}] last waiter for {key} went away, cancelling")
+                task.cancel()
+            raise
+        finally:
+            self.counters['waiting'] -= 1
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def stats(self):
+        return dict(self.counters, in_flight=len(self._calls))
+
+    async def _run(self, key, fn):
+        if not self.cross_worker:
+            return await fn()
+        fd = await self._lock(key)
+        try:
+            return await fn()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def _lock(self, key):
+        lock_dir = os.path.join(CACHE_DIR, 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        digest = hashlib.sha1(str(key).encode()).hexdigest()
+        fd = os.open(os.path.join(lock_dir, f'{self.name}-{digest}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        waited = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    if not waited:
+                        waited = True
+                        self.counters['cross_worker_waits'] += 1
+                        logger.debug(f"[{self.name}] {key} is in flight in another worker, waiting")
+                    await asyncio.sleep(_LOCK_POLL_INTERVAL)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.counters['errors'] += 1
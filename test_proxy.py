@@ -3,10 +3,11 @@
 Test script to verify proxy configuration and functionality
 """
 
+import asyncio
 import os
 import sys
 from pytubefix import YouTube
-from utils import get_proxies, create_youtube_with_retry
+from utils import get_proxies, create_youtube_async
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -37,7 +38,7 @@ def test_youtube_connection(test_url="https://youtu.be/dQw4w9WgXcQ"):
     print(f"Test URL: {test_url}")
     
     try:
-        yt = create_youtube_with_retry(test_url, max_retries=3)
+        yt = asyncio.run(create_youtube_async(test_url, max_retries=3))
         print(f"✓ Successfully connected!")
         print(f"  Title: {yt.title}")
         print(f"  Author: {yt.author}")
@@ -62,7 +63,7 @@ def test_multiple_requests():
     for i, url in enumerate(test_urls, 1):
         print(f"\nRequest {i}/3: {url}")
         try:
-            yt = create_youtube_with_retry(url, max_retries=2)
+            yt = asyncio.run(create_youtube_async(url, max_retries=2))
             print(f"  ✓ {yt.title}")
             success_count += 1
         except Exception as e:
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Settings are read on import, keep the shared SQLite stores and temp files out of the working tree
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='youtube-server-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from admission import Pool, QueueFull
+
+
+def test_waiter_cancelled_before_release_resumes():
+    async def scenario():
+        pool = Pool('test', 1, 4, max_wait=5)
+        held = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        # Cancels the waiter's future right away, release then pops the dead entry
+        waiter.cancel()
+        pool.release(held)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.active == 0
+    assert pool.stats()['queue_depth'] == 0
+
+
+def test_waiter_times_out_with_queue_full():
+    async def scenario():
+        pool = Pool('test', 1, 4, max_wait=0.05)
+        held = await pool.acquire()
+        with pytest.raises(QueueFull):
+            await pool.acquire()
+        pool.release(held)
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.active == 0
+    assert pool.counters['timed_out'] == 1
+
+
+def test_full_queue_turns_callers_away():
+    async def scenario():
+        pool = Pool('test', 1, 1, max_wait=5)
+        held = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull) as rejected:
+            await pool.acquire()
+        pool.release(held)
+        pool.release(await waiter)
+        return pool, rejected.value
+
+    pool, rejected = asyncio.run(scenario())
+    assert rejected.retry_after > 0
+    assert pool.active == 0
+
+
+def test_higher_priority_goes_first():
+    async def scenario():
+        pool = Pool('test', 1, 4, max_wait=5)
+        held = await pool.acquire()
+        order = []
+
+        async def take(name, priority):
+            acquired = await pool.acquire(priority)
+            order.append(name)
+            pool.release(acquired)
+
+        tasks = [asyncio.ensure_future(take('background', 2)), asyncio.ensure_future(take('interactive', 0))]
+        await asyncio.sleep(0)
+        pool.release(held)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ['interactive', 'background']
@@ -0,0 +1,61 @@
+import os
+from cache import MediaCache, MetadataCache
+
+
+def _make(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as file:
+        file.write(content)
+    return path
+
+
+def test_same_named_renditions_keep_their_own_links(tmp_path):
+    cache = MediaCache(name='test-media.sqlite3', max_bytes=10 ** 6)
+    handout = tmp_path / 'handout'
+    links = {}
+    for itag, content in ((22, '720p'), (137, '1080p')):
+        key = cache.key('video', [itag, 140], {'mux': True})
+        source = _make(tmp_path, 'combined_Title.mp4', content)
+        links[content] = cache.link(key, cache.put(key, source), handout)
+
+    assert links['720p'] != links['1080p']
+    for content, path in links.items():
+        with open(path) as file:
+            assert file.read() == content
+
+
+def test_link_again_replaces_the_previous_link(tmp_path):
+    cache = MediaCache(name='test-media.sqlite3', max_bytes=10 ** 6)
+    key = cache.key('video', [18], {})
+    path = cache.put(key, _make(tmp_path, 'video.mp4', 'data'))
+    first = cache.link(key, path, tmp_path / 'handout')
+    second = cache.link(key, path, tmp_path / 'handout')
+    assert first == second
+    assert sorted(os.listdir(tmp_path / 'handout')) == [os.path.basename(first)]
+
+
+def test_get_forgets_files_removed_from_disk(tmp_path):
+    cache = MediaCache(name='test-media.sqlite3', max_bytes=10 ** 6)
+    key = cache.key('video', [251], {})
+    path = cache.put(key, _make(tmp_path, 'audio.webm', 'data'))
+    assert cache.get(key) == path
+    os.remove(path)
+    assert cache.get(key) is None
+
+
+def test_least_recently_used_is_evicted_first(tmp_path):
+    cache = MediaCache(name='test-media-evict.sqlite3', max_bytes=10)
+    keys = [cache.key('video', [itag], {}) for itag in (1, 2)]
+    old = cache.put(keys[0], _make(tmp_path, 'old.mp4', 'x' * 6))
+    cache.put(keys[1], _make(tmp_path, 'new.mp4', 'y' * 6))
+    assert not os.path.exists(old)
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1])
+
+
+def test_metadata_entries_come_back_as_copies():
+    cache = MetadataCache(name='test-metadata.sqlite3', ttl=60)
+    cache.set('abc', {'vid_info': {'streamingData': {'formats': [{'signatureCipher': 's=1'}]}}})
+    entry = cache.get('abc')
+    entry['vid_info']['streamingData']['formats'][0]['url'] = 'deciphered'
+    assert 'url' not in cache.get('abc')['vid_info']['streamingData']['formats'][0]
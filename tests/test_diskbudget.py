@@ -0,0 +1,33 @@
+import shutil
+from diskbudget import DiskBudget
+
+
+def _budget(tmp_path, name, room):
+    # Leave only room bytes above the minimum free space
+    free = shutil.disk_usage(tmp_path).free
+    return DiskBudget(name=name, directory=str(tmp_path), min_free=free - room)
+
+
+def test_reservations_share_the_room_left(tmp_path):
+    budget = _budget(tmp_path, 'test-disk-share.sqlite3', 10 * 1024 ** 2)
+    first, short = budget.try_reserve(str(tmp_path / 'a'), 6 * 1024 ** 2)
+    assert first and not short
+    second, short = budget.try_reserve(str(tmp_path / 'b'), 6 * 1024 ** 2)
+    assert second is None
+    assert short > 0
+    budget.release(first)
+    second, short = budget.try_reserve(str(tmp_path / 'b'), 6 * 1024 ** 2)
+    assert second and not short
+    budget.release(second)
+
+
+def test_written_bytes_are_not_counted_twice(tmp_path):
+    budget = _budget(tmp_path, 'test-disk-written.sqlite3', 8 * 1024 ** 2)
+    workdir = tmp_path / 'build'
+    workdir.mkdir()
+    reservation, _ = budget.try_reserve(str(workdir), 6 * 1024 ** 2)
+    assert reservation
+    # What the build has written already is part of the reservation, not extra
+    (workdir / 'video.part').write_bytes(b'\0' * 4 * 1024 ** 2)
+    budget.min_free -= 4 * 1024 ** 2
+    assert budget.try_reserve(str(tmp_path / 'other'), 5 * 1024 ** 2)[0]
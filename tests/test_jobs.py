@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+from jobs import JobStore, _JobWriter
+
+
+def _lose_worker(store, job_id):
+    # As if its worker died: no heartbeat for longer than a job may go without
+    with store._lock:
+        store.db().execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time() - 3600, job_id))
+
+
+def test_job_of_a_dead_worker_runs_again():
+    store = JobStore(name='test-jobs-requeue.sqlite3', max_attempts=3)
+    job_id = store.create({'url': 'https://youtu.be/dQw4w9WgXcQ'})
+    assert store.claim('first')['id'] == job_id
+    _lose_worker(store, job_id)
+    job = store.claim('second')
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+
+
+def test_job_fails_once_it_ran_out_of_attempts():
+    store = JobStore(name='test-jobs-cap.sqlite3', max_attempts=2)
+    job_id = store.create({'url': 'https://youtu.be/dQw4w9WgXcQ'})
+    for worker in ('first', 'second'):
+        assert store.claim(worker)['id'] == job_id
+        _lose_worker(store, job_id)
+    assert store.claim('third') is None
+    job = store.get(job_id)
+    assert job['state'] == 'failed'
+    assert 'attempts' in job['error']
+
+
+def test_outcome_lands_after_progress():
+    store = JobStore(name='test-jobs-writer.sqlite3')
+    job_id = store.create({'url': 'https://youtu.be/dQw4w9WgXcQ'})
+    store.claim('worker')
+
+    async def scenario():
+        writer = _JobWriter(store, job_id)
+        reporter = threading.Thread(target=lambda: [writer.progress({'stage': 'downloading', 'bytes_done': done}) for done in range(50)])
+        reporter.start()
+        reporter.join()
+        await writer.finish(state='done', stage='done', bytes_done=100)
+
+    asyncio.run(scenario())
+    job = store.get(job_id)
+    assert (job['state'], job['stage'], job['bytes_done']) == ('done', 'done', 100)
@@ -0,0 +1,43 @@
+import time
+import uuid
+from proxy_pool import ProxyPool
+from ratelimit import TokenBucketLimiter
+
+
+def test_bucket_refills_over_time():
+    limiter = TokenBucketLimiter(rate=20, burst=2)
+    key = uuid.uuid4().hex
+    assert limiter.try_acquire(key) == 0
+    assert limiter.try_acquire(key) == 0
+    wait = limiter.try_acquire(key)
+    assert 0 < wait <= 1 / 20
+    time.sleep(wait + 0.01)
+    assert limiter.try_acquire(key) == 0
+
+
+def test_bucket_never_holds_more_than_burst():
+    limiter = TokenBucketLimiter(rate=10, burst=3)
+    key = uuid.uuid4().hex
+    limiter.try_acquire(key)
+    time.sleep(0.5)  # Enough to refill more than the burst
+    assert [limiter.try_acquire(key) == 0 for _ in range(4)] == [True, True, True, False]
+
+
+def test_cost_takes_several_tokens():
+    limiter = TokenBucketLimiter(rate=1, burst=3)
+    key = uuid.uuid4().hex
+    assert limiter.try_acquire(key, cost=2) == 0
+    assert limiter.try_acquire(key, cost=2) > 0
+
+
+def test_disabled_limiter_grants_everything():
+    limiter = TokenBucketLimiter(rate=0)
+    assert all(limiter.try_acquire('anything') == 0 for _ in range(100))
+
+
+def test_ranked_offers_every_healthy_proxy_once():
+    pool = ProxyPool([{'server': f'http://proxy{i}:8080', 'type': 'regular'} for i in range(5)])
+    pool.report(pool.states[0], latency=0.1)
+    for _ in range(20):
+        ranked = pool.ranked()
+        assert sorted(state.index for state in ranked) == list(range(5))
@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight, fcntl
+
+
+def test_concurrent_calls_share_one_run():
+    async def scenario():
+        flight = SingleFlight('test-share')
+        runs = []
+
+        async def fetch():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        results = await asyncio.gather(*(flight.do('key', fetch) for _ in range(5)))
+        return results, runs, flight.stats()
+
+    results, runs, stats = asyncio.run(scenario())
+    assert results == ['result'] * 5
+    assert len(runs) == 1
+    assert stats['coalesced'] == 4
+    assert stats['in_flight'] == 0
+
+
+def test_shared_call_survives_until_the_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight('test-cancel')
+        started = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            await finish.wait()
+            return 'result'
+
+        first = asyncio.ensure_future(flight.do('key', fetch))
+        second = asyncio.ensure_future(flight.do('key', fetch))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        finish.set()
+        return await second, first.cancelled()
+
+    assert asyncio.run(scenario()) == ('result', True)
+
+
+@pytest.mark.skipif(fcntl is None, reason="cross worker coalescing needs fcntl")
+def test_cross_worker_lock_is_handed_over():
+    async def scenario():
+        # Two instances with the same name stand in for two hypercorn workers
+        workers = [SingleFlight('test-handoff', cross_worker=True) for _ in range(2)]
+        order = []
+        release = asyncio.Event()
+
+        async def build(worker):
+            order.append(f'{worker} start')
+            if worker == 'first':
+                await release.wait()
+            order.append(f'{worker} end')
+            return worker
+
+        first = asyncio.ensure_future(workers[0].do('key', lambda: build('first')))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(workers[1].do('key', lambda: build('second')))
+        await asyncio.sleep(0.2)
+        assert order == ['first start']
+        release.set()
+        return await first, await second, order, workers[1].stats()
+
+    first, second, order, stats = asyncio.run(scenario())
+    assert (first, second) == ('first', 'second')
+    assert order == ['first start', 'first end', 'second start', 'second end']
+    assert stats['cross_worker_waits'] == 1
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from settings import USE_TOR, TOR_PROXY_HOST, TOR_CONTROL_PORT, TOR_PREWARM_CIRCUITS
+
+logger = logging.getLogger(__name__)
+
+try:
+    from stem import Signal
+    from stem.control import Controller
+except ImportError:
+    Signal = Controller = None
+
+# How often the background loop tops up circuits and refreshes exit addresses
+_MAINTENANCE_INTERVAL = 10
+# Backoff between attempts to (re)connect to the control port
+_RECONNECT_DELAY = 5
+# Seconds to wait for a pre-warmed circuit to finish building
+_BUILD_TIMEOUT = 60
+
+
+class TorController:
+    """
+    Long-lived Tor control connection owned by a background task.
+
+    Keeps a few clean circuits built ahead of time (EXTENDCIRCUIT 0) so a
+    freshly rotated isolation identity attaches to a warm circuit instead of
+    waiting for one to build, and sends NEWNYM only when Tor's rate limit
+    allows it. Nothing here ever blocks a request: stem calls run in the
+    default executor from the background task, requests only set flags.
+    """
+
+    def __init__(self, host=TOR_PROXY_HOST, port=TOR_CONTROL_PORT, prewarm=TOR_PREWARM_CIRCUITS):
+        self.host = host
+        self.port = port
+        self.prewarm = prewarm
+        self._controller = None
+        self._task = None
+        self._wake = None
+        self._newnym_requested = False
+        self._prewarmed = {}  # circuit id -> build time in seconds
+        self._exits = {}  # circuit id -> exit ip
+        self.counters = {
+            'circuits_built': 0,
+            'circuit_build_failures': 0,
+            'newnym_sent': 0,
+            'newnym_requested': 0,
+            'connections': 0
+        }
+        self._build_times = []
+        self._last_newnym = None
+
+    @property
+    def connected(self):
+        return self._controller is not None and self._controller.is_alive()
+
+    def start(self):
+        """Start the background task on the running event loop"""
+        if Controller is None:
+            logger.warning("stem library not available, Tor control disabled")
+            return
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._controller:
+            await asyncio.to_thread(self._controller.close)
+            self._controller = None
+
+    def request_newnym(self):
+        """Ask for NEWNYM as soon as Tor accepts one, without waiting for it"""
+        self.counters['newnym_requested'] += 1
+        self._newnym_requested = True
+        self.wake()
+
+    def request_circuit(self):
+        """Ask for a replacement circuit to be built in the background"""
+        self.wake()
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def stats(self):
+        now = time.time()
+        return {
+            "connected": self.connected,
+            "control_port": self.port,
+            "prewarm_target": self.prewarm,
+            "prewarmed_circuits": [
+                {"id": circuit_id, "build_time": round(build_time, 3), "exit_ip": self._exits.get(circuit_id)}
+                for circuit_id, build_time in self._prewarmed.items()
+            ],
+            "exit_ips": sorted(set(ip for ip in self._exits.values() if ip)),
+            "avg_build_time": round(sum(self._build_times) / len(self._build_times), 3) if self._build_times else None,
+            "last_newnym_age": self._last_newnym and round(now - self._last_newnym, 1),
+            "newnym_pending": self._newnym_requested,
+            **self.counters
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.connected:
+                    await asyncio.to_thread(self._connect)
+                await self._maintain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Tor controller error: {repr(e)}")
+                self._controller = None
+                await asyncio.sleep(_RECONNECT_DELAY)
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), _MAINTENANCE_INTERVAL)
+            except TimeoutError:
+                pass
+
+    def _connect(self):
+        controller = Controller.from_port(address=self.host, port=self.port)
+        controller.authenticate()
+        self._controller = controller
+        self._prewarmed.clear()
+        self.counters['connections'] += 1
+        logger.info(f"Connected to Tor control port {self.host}:{self.port}")
+
+    async def _maintain(self):
+        if self._newnym_requested:
+            wait = await asyncio.to_thread(self._controller.get_newnym_wait)
+            if wait > 0:
+                logger.debug(f"NEWNYM rate limited, retrying in {wait:.1f}s")
+                asyncio.get_running_loop().call_later(wait, self.wake)
+            else:
+                await asyncio.to_thread(self._controller.signal, Signal.NEWNYM)
+                self._newnym_requested = False
+                self._last_newnym = time.time()
+                self.counters['newnym_sent'] += 1
+                # NEWNYM retires every circuit, including the warm ones
+                self._prewarmed.clear()
+                logger.info("Sent NEWNYM to Tor")
+
+        await asyncio.to_thread(self._forget_used_circuits)
+        while len(self._prewarmed) < self.prewarm:
+            started = time.monotonic()
+            try:
+                circuit_id = await asyncio.to_thread(
+                    self._controller.new_circuit, await_build=True, timeout=_BUILD_TIMEOUT
+                )
+            except Exception as e:
+                self.counters['circuit_build_failures'] += 1
+                logger.debug(f"Pre-warming a Tor circuit failed: {repr(e)}")
+                break
+            build_time = time.monotonic() - started
+            self._prewarmed[circuit_id] = build_time
+            self._build_times = (self._build_times + [build_time])[-50:]
+            self.counters['circuits_built'] += 1
+            logger.debug(f"Pre-warmed Tor circuit {circuit_id} in {build_time:.2f}s")
+
+        await asyncio.to_thread(self._refresh_exits)
+
+    def _forget_used_circuits(self):
+        """Drop pre-warmed circuits that closed or had a stream attached to them"""
+        live = {circuit.id for circuit in self._controller.get_circuits() if circuit.status == 'BUILT'}
+        used = {stream.circ_id for stream in self._controller.get_streams()}
+        for circuit_id in list(self._prewarmed):
+            if circuit_id not in live or circuit_id in used:
+                del self._prewarmed[circuit_id]
+
+    def _refresh_exits(self):
+        exits = {}
+        for circuit in self._controller.get_circuits():
+            if circuit.status != 'BUILT' or circuit.purpose != 'GENERAL' or not circuit.path:
+                continue
+            fingerprint = circuit.path[-1][0]
+            status = self._controller.get_network_status(fingerprint, None)
+            exits[circuit.id] = status.address if status else None
+        self._exits = exits
+
+
+tor_controller = TorController() if USE_TOR else None
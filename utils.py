@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 import requests
@@ -5,40 +6,76 @@ import logging
 import os
 import shutil
 import time
-import socks
-import socket
+import threading
 from langcodes import find
 from quart import url_for
-from pytubefix import YouTube
+from pytubefix import YouTube, Caption, CaptionQuery
 from pytubefix.exceptions import AgeRestrictedError, LiveStreamError, MaxRetriesExceeded, MembersOnly, VideoPrivate, VideoRegionBlocked, VideoUnavailable, RegexMatchError
 from youtube_urls_validator import validate_url
 # from youtube_transcript_api import YouTubeTranscriptApi
 # from youtube_transcript_api.formatters import JSONFormatter, SRTFormatter, TextFormatter
 from urllib.parse import urlparse, parse_qs
 from urllib.error import HTTPError
-from settings import MAX_DOWNLOAD_SIZE, TEMP_DIR, CODECS, AUTH, VISITOR_DATA, PO_TOKEN, PROXIES, DEBUG, USE_TOR, TOR_PROXY_HOST, TOR_PROXY_PORT, TOR_CONTROL_PORT
+from settings import MAX_DOWNLOAD_SIZE, TEMP_DIR, CODECS, AUTH, VISITOR_DATA, PO_TOKEN, PROXIES, DEBUG, USE_TOR, TOR_PROXY_HOST, TOR_PROXY_PORT, TOR_CONTROL_PORT, TOR_SOCKS_PORTS, TOR_ISOLATION_IDENTITIES, TOR_CIRCUIT_LIFETIME, SINGLEFLIGHT_CROSS_WORKER, UPSTREAM_DEADLINE, RATE_LIMIT_MAX_WAIT
+from cache import metadata_cache, negative_cache
+from singleflight import SingleFlight
+from proxy_pool import ProxyPool
+import egress
+from tor_control import tor_controller
+from ratelimit import rate_limiter, Overloaded, RateLimited
+from admission import fetch_pool, lookup_pool, INTERACTIVE
+from diskbudget import disk_budget, footprint
+import downloader
+import progress
 
 logger = logging.getLogger(__name__)
 
-# Global proxy rotation state
-_proxy_index = 0
-_failed_proxies = set()
+# Proxy configuration, parsed once per process
+_proxies = None
 
-# Tor-specific imports and state
-_tor_controller = None
+# Tor-specific state
 _tor_circuit_age = 0
+_tor_circuit_age_lock = threading.Lock()
 _tor_max_circuit_age = 10  # Renew Tor circuit every 10 requests
-_original_socket = None  # Store original socket for cleanup
 
-try:
-    if USE_TOR:
-        from stem import Signal
-        from stem.control import Controller
-        logger.info("Stem library loaded for Tor control")
-except ImportError:
-    if USE_TOR:
-        logger.warning("stem library not available, Tor circuit renewal disabled")
-    pass
+# Concurrent metadata fetches for the same video share one upstream call
+youtube_flight = SingleFlight('youtube', cross_worker=SINGLEFLIGHT_CROSS_WORKER)
+
+
+# Failures that no retry or fresh circuit can fix, most specific first.
+# Other VideoUnavailable subclasses (bot detection, login required, ...) stay retryable.
+TERMINAL_ERRORS = (
+    (VideoPrivate, 'video_private', 403),
+    (MembersOnly, 'members_only', 403),
+    (VideoRegionBlocked, 'region_blocked', 451),
+    (AgeRestrictedError, 'age_restricted', 403),
+    (LiveStreamError, 'live_stream', 400),
+)
+TERMINAL_ERROR_STATUS = {code: status for _, code, status in TERMINAL_ERRORS}
+TERMINAL_ERROR_STATUS['video_unavailable'] = 404
+
+
+class TerminalVideoError(Exception):
+    """Raised when a video can't be fetched no matter how often it is retried"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = TERMINAL_ERROR_STATUS.get(code, 400)
+
+    def to_dict(self):
+        return {"error": self.message, "code": self.code}
+
+
+def classify_terminal_error(e):
+    """Return the error code of a terminal pytubefix error, or None if e is worth retrying"""
+    for error_type, code, _ in TERMINAL_ERRORS:
+        if isinstance(e, error_type):
+            return code
+    if type(e) is VideoUnavailable:
+        return 'video_unavailable'
+    return None
 
 
 def get_free_mem() -> int:
@@ -58,19 +95,21 @@ def get_avaliable_bitrates(yt):
     return sorted(remove_duplicates(filter(lambda x: x is not None, [stream.abr for stream in yt.streams.filter(only_audio=True)])), key= lambda char: int(char[:-4]),reverse=True)
 
 def get_proxies():
+    """Proxy configuration from environment, parsed on first use"""
+    global _proxies
+    if _proxies is None:
+        _proxies = parse_proxies()
+    return _proxies
+
+
+def parse_proxies():
     """Parse proxy configuration from environment"""
     reason = "AUTH = False"
     
     # Check if Tor is enabled first
     if USE_TOR:
-        logger.info("Using Tor proxy")
-        tor_proxy = f"socks5://{TOR_PROXY_HOST}:{TOR_PROXY_PORT}"
-        return [{
-            'server': tor_proxy,
-            'username': '',
-            'password': '',
-            'type': 'tor'
-        }]
+        logger.info(f"Using Tor proxy with {TOR_ISOLATION_IDENTITIES} isolated identities on ports {TOR_SOCKS_PORTS}")
+        return egress.tor_identities(TOR_PROXY_HOST, TOR_SOCKS_PORTS, TOR_ISOLATION_IDENTITIES)
     
     if AUTH:
         reason = "No proxies available"
@@ -102,30 +141,6 @@ def get_proxies():
     return []
 
 
-def renew_tor_circuit():
-    """Request a new Tor circuit (new IP address)"""
-    global _tor_controller, _tor_circuit_age
-    
-    if not USE_TOR:
-        return False
-    
-    try:
-        from stem import Signal
-        from stem.control import Controller
-        
-        # Connect to Tor control port
-        with Controller.from_port(port=TOR_CONTROL_PORT) as controller:
-            controller.authenticate()
-            controller.signal(Signal.NEWNYM)
-            _tor_circuit_age = 0
-            logger.info("Tor circuit renewed - new IP address obtained")
-            time.sleep(3)  # Wait for new circuit to establish
-            return True
-    except Exception as e:
-        logger.warning(f"Failed to renew Tor circuit: {e}")
-        return False
-
-
 def should_renew_tor_circuit():
     """Check if Tor circuit should be renewed"""
     global _tor_circuit_age
@@ -133,196 +148,343 @@ def should_renew_tor_circuit():
     if not USE_TOR:
         return False
     
-    _tor_circuit_age += 1
-    if _tor_circuit_age >= _tor_max_circuit_age:
-        return True
+    with _tor_circuit_age_lock:
+        _tor_circuit_age += 1
+        if _tor_circuit_age >= _tor_max_circuit_age:
+            _tor_circuit_age = 0
+            return True
     return False
 
 
-def enable_tor_proxy():
-    """Enable SOCKS5 proxy globally for all socket connections"""
-    global _original_socket
-    
-    if _original_socket is None:
-        _original_socket = socket.socket
-    
-    # Set default proxy for all socket connections
-    socks.set_default_proxy(socks.SOCKS5, TOR_PROXY_HOST, TOR_PROXY_PORT)
-    socket.socket = socks.socksocket
-    logger.info(f"Enabled SOCKS5 proxy: {TOR_PROXY_HOST}:{TOR_PROXY_PORT}")
+def rotate_tor_identity(route):
+    """Move a Tor identity to a fresh circuit and have the controller warm up a replacement"""
+    route.rotate()
+    if tor_controller is not None:
+        tor_controller.request_circuit()
+        if proxy_pool.exhausted():
+            # Every identity is cooling down, start over with a whole new set of circuits
+            tor_controller.request_newnym()
 
 
-def disable_tor_proxy():
-    """Disable SOCKS5 proxy and restore original socket"""
-    global _original_socket
-    
-    if _original_socket is not None:
-        socket.socket = _original_socket
-        logger.info("Disabled SOCKS5 proxy")
+async def acquire_proxy():
+    """
+    Pick a proxy from the pool that has upstream request budget left.
 
+    Proxies whose token bucket is empty are passed over for one with spare
+    budget. When every proxy is empty the call waits for the first refill,
+    up to RATE_LIMIT_MAX_WAIT seconds, then raises RateLimited.
+    """
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT
+    while True:
+        shortest = None
+        for entry in proxy_pool.ranked():
+            wait = await asyncio.to_thread(rate_limiter.try_acquire, entry.key)
+            if not wait:
+                proxy_pool.take(entry)
+                return entry
+            shortest = wait if shortest is None else min(shortest, wait)
+        if time.monotonic() + shortest > deadline:
+            raise RateLimited("Every upstream route is out of request budget, please try again shortly.", shortest)
+        logger.info(f"All proxies are out of request budget, waiting {shortest:.1f}s")
+        await asyncio.sleep(shortest)
+
+
+async def acquire_budget(key=None):
+    """Take a token for one upstream request through key (default: the current request's egress)"""
+    if key is None:
+        route = egress.current()
+        key = route.key if route else 'direct'
+    if not await rate_limiter.acquire(key):
+        raise RateLimited("Too many requests to YouTube right now, please try again shortly.", RATE_LIMIT_MAX_WAIT)
+
+
+async def download_stream(stream, output_path=TEMP_DIR, stop=None):
+    """
+    Download stream to output_path from async code, within the current egress' request budget.
 
-def is_tor_enabled():
-    """Check if Tor proxy is currently enabled"""
-    proxies_list = get_proxies()
-    return bool(proxies_list) and proxies_list[0].get('type') == 'tor'
+    stop is an optional threading.Event; setting it makes the transfer thread
+    give up at the next chunk, since a cancelled await can't stop the thread itself.
+    """
+    async with fetch_pool.slot():
+        await acquire_budget()
+        return await asyncio.to_thread(downloader.download, stream, output_path, stop=stop)
 
 
-def get_next_proxy():
-    """Get the next proxy in rotation, skipping failed ones"""
-    global _proxy_index, _failed_proxies
-    
-    proxies = get_proxies()
-    if not proxies:
-        return None
-    
-    # Filter out failed proxies
-    available_proxies = [p for i, p in enumerate(proxies) if i not in _failed_proxies]
-    
-    if not available_proxies:
-        # All proxies failed, reset and try again
-        logger.warning("All proxies failed, resetting failed proxy list")
-        _failed_proxies.clear()
-        available_proxies = proxies
-    
-    # Round-robin selection
-    proxy = available_proxies[_proxy_index % len(available_proxies)]
-    _proxy_index += 1
-    
-    return proxy
+async def download_streams(*streams, output_path=TEMP_DIR):
+    """
+    Download several streams concurrently, returns their paths in the same order.
+
+    If one download fails, or the caller is cancelled, the others are stopped
+    as well and the first error is raised.
+    """
+    stop = threading.Event()
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(download_stream(stream, output_path, stop)) for stream in streams]
+    except BaseExceptionGroup as e:
+        # Report the failure that started it, not the siblings it cancelled
+        raise e.exceptions[0]
+    finally:
+        stop.set()
+    return [task.result() for task in tasks]
 
 
-def mark_proxy_failed(proxy_index):
-    """Mark a proxy as failed"""
-    global _failed_proxies
-    _failed_proxies.add(proxy_index)
-    logger.warning(f"Marked proxy {proxy_index} as failed")
+egress.install()
+proxy_pool = ProxyPool(get_proxies())
 
 
-def create_youtube_with_retry(url, max_retries=3, initial_delay=2):
+async def create_youtube_async(url, max_retries=3, initial_delay=2, deadline=UPSTREAM_DEADLINE):
     """
     Create YouTube object with automatic proxy rotation and retry logic
     Supports both regular proxies and Tor network
     
-    NOTE: If using Tor, the SOCKS proxy will remain enabled after this function
-    returns to allow subsequent downloads. Call disable_tor_proxy() when done.
+    Backoff and Tor circuit renewal wait with asyncio.sleep, only the blocking
+    pytubefix calls run in the default executor. Cancelling the calling task
+    (e.g. when the client disconnects) abandons the remaining attempts.
+    
+    The returned object carries the egress (proxy or Tor identity) that fetched
+    it as `yt.egress`; stream urls are tied to that exit, so downloads should
+    be made through it as well (see get_youtube).
     
     Args:
         url: YouTube video URL
         max_retries: Maximum number of retry attempts
         initial_delay: Initial delay in seconds (doubles with each retry)
+        deadline: Seconds all attempts together may take, None for no limit
     
     Returns:
         YouTube object or raises exception
     """
+    vid = canonical_video_id(url)
+    # Cache reads touch their entries, writes that may wait on other workers
+    failure = await asyncio.to_thread(negative_cache.get, vid)
+    if failure:
+        logger.info(f"Negative cache hit for {vid}: {failure[0]}")
+        raise TerminalVideoError(*failure)
+    
+    entry = await asyncio.to_thread(metadata_cache.get, vid)
+    if entry and entry.get('vid_info') and not streams_expired(entry):
+        logger.info(f"Metadata cache hit for {vid}")
+        return CachedYouTube(url, entry)
+    
     proxies_list = get_proxies()
     use_proxies = bool(proxies_list)
     is_tor = use_proxies and proxies_list[0].get('type') == 'tor'
     
-    # Enable Tor SOCKS proxy globally if using Tor
-    if is_tor:
-        enable_tor_proxy()
-    
+    try:
+        async with asyncio.timeout(deadline):
+            return await _create_youtube_attempts(url, vid, max_retries, initial_delay, use_proxies, is_tor)
+    except TimeoutError:
+        logger.error(f"Gave up fetching {url} after the {deadline}s deadline")
+        raise Exception(f"Timed out after {deadline} seconds fetching video metadata. Please try again later.")
+    except asyncio.CancelledError:
+        logger.info(f"Fetching {url} was cancelled")
+        raise
+
+
+async def _create_youtube_attempts(url, vid, max_retries, initial_delay, use_proxies, is_tor):
     for attempt in range(max_retries):
         try:
-            proxy_dict = None
+            proxy_entry = None
+            route = None
             
-            if use_proxies:
-                # Renew Tor circuit if needed
-                if is_tor and should_renew_tor_circuit():
-                    logger.info("Renewing Tor circuit for fresh IP...")
-                    renew_tor_circuit()
-                
-                proxy = get_next_proxy()
-                if proxy:
+            if not use_proxies:
+                await acquire_budget('direct')
+            else:
+                proxy_entry = await acquire_proxy()
+                if proxy_entry:
+                    route = proxy_entry.egress
+                    # Renew Tor circuit if needed
+                    if is_tor and should_renew_tor_circuit():
+                        logger.info("Renewing Tor circuit for fresh IP...")
+                        rotate_tor_identity(route)
                     if is_tor:
-                        # For Tor, SOCKS proxy is already enabled globally
-                        logger.info(f"Attempt {attempt + 1}: Using Tor network (SOCKS5 proxy)")
-                        proxy_dict = None  # Don't pass proxy_dict for Tor
+                        logger.info(f"Attempt {attempt + 1}: Using Tor network (identity {route.key})")
                     else:
-                        # Convert to pytubefix proxy format for regular HTTP/HTTPS proxies
-                        proxy_dict = {
-                            'http': proxy['server'],
-                            'https': proxy['server']
-                        }
-                        
-                        # Add authentication for non-Tor proxies
-                        if 'username' in proxy and proxy['username']:
-                            auth = f"{proxy['username']}:{proxy['password']}@"
-                            proxy_dict['http'] = proxy_dict['http'].replace('://', f'://{auth}')
-                            proxy_dict['https'] = proxy_dict['https'].replace('://', f'://{auth}')
-                        
-                        logger.info(f"Attempt {attempt + 1}: Using proxy {proxy['server']}")
-            
-            # Create YouTube object
-            yt = YouTube(
-                url,
-                use_oauth=AUTH,
-                allow_oauth_cache=True,
-                token_file=AUTH and os.path.join('auth', 'temp.json'),
-                proxies=proxy_dict  # Will be None for Tor (uses global SOCKS proxy)
-            )
-            
-            # Test the connection by accessing a property
-            _ = yt.title
+                        logger.info(f"Attempt {attempt + 1}: Using proxy {proxy_entry.server}")
             
+            started = time.monotonic()
+            try:
+                # Only this request (and the thread it runs in) goes through route
+                with egress.use(route):
+                    async with lookup_pool.slot(INTERACTIVE):
+                        yt = await asyncio.to_thread(_fetch_youtube, url)
+            except HTTPError as e:
+                proxy_pool.report(proxy_entry, ok=False, rate_limited=e.code == 429)
+                raise
+            except Exception as e:
+                # Terminal errors are answers from YouTube, the proxy itself worked
+                proxy_pool.report(proxy_entry, ok=bool(classify_terminal_error(e)))
+                raise
+            proxy_pool.report(proxy_entry, latency=time.monotonic() - started)
+            # Pin the circuit generation, stream urls stay tied to this exit
+            yt.egress = route and route.pinned()
             logger.info(f"Successfully created YouTube object for: {yt.title}")
-            
-            # NOTE: We DON'T disable Tor proxy here - it needs to stay enabled for downloads
+            await asyncio.to_thread(cache_youtube_metadata, vid, yt)
             return yt
             
+        except Overloaded:
+            # Our own limiter said no, waiting here would only hold the request longer
+            raise
         except HTTPError as e:
             if e.code == 429:
                 delay = initial_delay * (2 ** attempt)
                 logger.warning(f"Rate limited (429) on attempt {attempt + 1}/{max_retries}")
                 
                 if is_tor:
-                    logger.info("Rate limited on Tor, renewing circuit...")
-                    renew_tor_circuit()
-                elif use_proxies and proxy:
+                    logger.info("Rate limited on Tor, moving identity to a new circuit...")
+                    rotate_tor_identity(route)
+                elif use_proxies and proxy_entry:
                     logger.info(f"Switching to next proxy due to rate limit")
                 
                 if attempt < max_retries - 1:
                     logger.info(f"Waiting {delay} seconds before retry...")
-                    time.sleep(delay)
+                    await asyncio.sleep(delay)
                 else:
                     logger.error("Max retries reached, all attempts failed")
-                    # Disable Tor on final failure
-                    if is_tor:
-                        disable_tor_proxy()
                     if is_tor:
                         raise Exception("YouTube rate limit exceeded even with Tor. Try again later.")
                     else:
                         raise Exception("YouTube rate limit exceeded. Please try again later or configure more proxies.")
             else:
                 logger.error(f"HTTP Error {e.code}: {e}")
-                # Disable Tor on error
-                if is_tor:
-                    disable_tor_proxy()
                 raise
                 
         except Exception as e:
             logger.error(f"Attempt {attempt + 1} failed: {repr(e)}")
             
-            # Try renewing Tor circuit on failure
-            if is_tor and attempt < max_retries - 1:
+            code = classify_terminal_error(e)
+            if code:
+                # Retrying or renewing the circuit won't help, remember and fail fast
+                message = str(e)
+                await asyncio.to_thread(negative_cache.set, vid, code, message)
+                raise TerminalVideoError(code, message) from e
+            
+            # Move to a fresh Tor circuit on failure
+            if is_tor and route and attempt < max_retries - 1:
                 logger.info("Renewing Tor circuit after failure...")
-                renew_tor_circuit()
+                rotate_tor_identity(route)
             
             if attempt < max_retries - 1:
                 delay = initial_delay * (2 ** attempt)
                 logger.info(f"Waiting {delay} seconds before retry...")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
             else:
-                # Disable Tor on final failure
-                if is_tor:
-                    disable_tor_proxy()
                 raise
     
-    # Disable Tor if we somehow get here
-    if is_tor:
-        disable_tor_proxy()
     raise Exception("Failed to create YouTube object after all retries")
 
+
+def _fetch_youtube(url):
+    """Blocking part of create_youtube_async: build the YouTube object and load its metadata"""
+    # Never pass proxies to pytubefix, it would install them process wide.
+    # Routing happens through the egress bound to the calling context instead.
+    yt = YouTube(
+        url,
+        use_oauth=AUTH,
+        allow_oauth_cache=True,
+        token_file=AUTH and os.path.join('auth', 'temp.json'),
+        on_progress_callback=progress.on_progress
+    )
+    
+    # Test the connection by accessing a property
+    _ = yt.title
+    yt.check_availability()
+    return yt
+
+
+class CachedYouTube(YouTube):
+    """YouTube object rebuilt from a metadata cache entry instead of a network round trip"""
+
+    def __init__(self, url, entry):
+        super().__init__(
+            url,
+            use_oauth=AUTH,
+            allow_oauth_cache=True,
+            token_file=AUTH and os.path.join('auth', 'temp.json'),
+            on_progress_callback=progress.on_progress
+        )
+        self.vid_info = entry['vid_info']
+        self._js_url = entry.get('js_url')
+        self.cached_captions = entry.get('captions')
+        # Stream urls only work from the exit that fetched them
+        route = entry.get('egress') or {}
+        self.egress = proxy_pool.find_egress(route.get('key'), route.get('generation'))
+
+    @property
+    def caption_tracks(self):
+        if self.cached_captions is not None:
+            return [Caption(track) for track in self.cached_captions]
+        return super().caption_tracks
+
+
+def streams_expired(entry):
+    """True once the stream urls of a metadata cache entry outlived the Tor circuit that fetched them"""
+    expires_at = entry.get('streams_expire_at')
+    return expires_at is not None and time.time() >= expires_at
+
+
+def canonical_video_id(url):
+    """Return the video id used as cache key for url, or None if it can't be parsed"""
+    try:
+        return video_id(url)
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def cache_youtube_metadata(vid, yt):
+    """Store the metadata of a freshly fetched YouTube object in the shared cache"""
+    if not vid:
+        return
+    info, error = get_info(yt)
+    if error:
+        logger.debug(f"Caching {vid} without info payload: {error}")
+    metadata_cache.set(vid, {
+        'info': info,
+        'vid_info': yt.vid_info,
+        'js_url': yt._js_url,
+        'captions': None,
+        'egress': yt.egress and {'key': yt.egress.key, 'generation': yt.egress.generation},
+        # The manifest outlives the Tor circuit its stream urls are bound to, the rest doesn't depend on the exit
+        'streams_expire_at': time.time() + TOR_CIRCUIT_LIFETIME if yt.egress and yt.egress.is_tor else None
+    })
+
+
+def remember_caption_tracks(yt, tracks):
+    """Add the caption track list of yt to its metadata cache entry"""
+    if getattr(yt, 'cached_captions', None) is not None:
+        return
+    code = lambda track: track.code if track.code.startswith('a.') else f'.{track.code}'
+    metadata_cache.update(yt.video_id, captions=[
+        {'baseUrl': track.url, 'name': {'simpleText': track.name}, 'vssId': code(track)}
+        for track in tracks
+    ])
+
+
+def get_cached_info(url):
+    """Return the cached /info payload for url without touching the network"""
+    entry = metadata_cache.get(canonical_video_id(url))
+    return entry and entry.get('info')
+
+
+async def get_youtube(url, deadline=UPSTREAM_DEADLINE):
+    """
+    Get a YouTube object for url from async code.
+
+    Concurrent calls for the same video wait on a single create_youtube_async
+    call and share its result or exception. The calling task is bound to the
+    egress the metadata was fetched through.
+    """
+    vid = canonical_video_id(url)
+    if not vid:
+        yt = await create_youtube_async(url, deadline=deadline)
+    else:
+        yt = await youtube_flight.do(vid, lambda: create_youtube_async(url, deadline=deadline))
+    # Downloads made later by the calling request go out through the same exit
+    egress.bind(getattr(yt, 'egress', None))
+    return yt
+
+
 def filter_stream_by_codec(streams, codec):
     return [stream  for stream in streams if codec in stream.video_codec]
     
@@ -344,7 +506,47 @@ def is_valid_language(value):
     except:
       return False
 
-"""    
+
+def parse_timestamp(value):
+    """Seconds in value, a number of seconds or [HH:]MM:SS[.mmm]. Raises ValueError"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    else:
+        seconds = 0.0
+        for part in str(value).strip().split(':'):
+            seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(f"Negative time: {value}")
+    return seconds
+
+
+def parse_clip(data):
+    """(start, end) in seconds asked for by the start/end parameters of data, None for the whole video. Raises ValueError"""
+    start, end = data.get('start'), data.get('end')
+    if start in (None, '') and end in (None, ''):
+        return None
+    try:
+        start = parse_timestamp(start) if start not in (None, '') else 0.0
+        end = parse_timestamp(end) if end not in (None, '') else None
+    except ValueError:
+        raise ValueError("Invalid start/end, use seconds or HH:MM:SS for example 90 or 00:01:30")
+    if end is not None and end <= start:
+        raise ValueError("The end of a clip must come after its start")
+    return start, end
+
+
+def clip_bounds(clip, duration):
+    """clip fitted to a video of duration seconds. Raises ValueError when it starts past the end"""
+    start, end = clip
+    if duration:
+        if start >= duration:
+            raise ValueError(f"The clip starts after the end of the video ({duration}s)")
+        end = duration if end is None else min(end, duration)
+    if end is None:
+        raise ValueError("Missing 'end' of the clip")
+    return start, end
+
+"""
 def get_proxies():
     if AUTH:
       try:
@@ -403,7 +605,7 @@ def video_id(value):
 def get_info(yt):
     try:
         video_info = yt.dict()
-        print(video_info)
+        logger.debug(f"Video info: {video_info}")
         video_info['video_id'] = video_id(video_info.get('view_url'))
         return video_info, None
     except Exception as e:
@@ -412,13 +614,15 @@ def get_info(yt):
 
 
 def validate_download(stream):
-  if stream.filesize_approx <= MAX_DOWNLOAD_SIZE:
-      filesize = stream.filesize
-      logger.info(f"stream filesize is {filesize / 1024**3}mb storage left on server is {get_free_mem() / 1024 ** 3}mb")
-      if filesize <= get_free_mem():
-            logger.info(f"stream filesize is {filesize / 1024**3}mb storage left on server is {get_free_mem() / 1024 ** 3}mb")
+  # filesize_approx comes from the manifest, filesize could cost a request to YouTube
+  filesize = stream.filesize_approx
+  if filesize <= MAX_DOWNLOAD_SIZE:
+      # Space that is only taken for now is waited for when the download reserves it,
+      # this only turns away files that could never fit (muxing keeps two copies)
+      if footprint(stream, subtitled=True) <= disk_budget.capacity():
             return True, None
-      return False, "Not enough memory on the server try agin later"
+      logger.info(f"stream filesize is {filesize / 1024**3}gb, disk space for downloads on server is {disk_budget.capacity() / 1024 ** 3}gb")
+      return False, "Not enough disk space on the server for this file"
   return None, f"File excedds max download size of {MAX_DOWNLOAD_SIZE}"
     
 
@@ -447,7 +651,7 @@ def download_content(yt, resolution: str ="", bitrate: str ="", frame_rate: int
                     stream = yt.streams.get_highest_resolution()
                 logger.info(f"Selected stream: {stream}")
             if stream:
-                is_valid, error = True, None # validate_download(yt)
+                is_valid, error = validate_download(stream)
                 if is_valid:
                     logger.info(f"Stream validated successfully")
                     return stream, None
@@ -471,7 +675,7 @@ def download_content(yt, resolution: str ="", bitrate: str ="", frame_rate: int
             
             if stream:
                 logger.info(f"Selected audio stream: {stream}")
-                is_valid, error = True, None # validate_download(stream)
+                is_valid, error = validate_download(stream)
                 if is_valid:
                     logger.info(f"Audio stream validated successfully")
                     return stream, None
@@ -492,12 +696,40 @@ def download_content(yt, resolution: str ="", bitrate: str ="", frame_rate: int
         logger.error(f"Error downloding {content_type} content: {e}", exc_info=True)
         return None, f'An error occored: {e} if you are seeing this message please contact administrator or open a issue at github.com/DannyAkintunde/Youtube-dl-api'
 
+def preset_video_stream(yt, height):
+    """
+    Video stream to downscale to height from: the smallest one at least that
+    tall (H.264 over other codecs, it is the cheapest to decode), else the
+    tallest there is. Returns (stream, error) like download_content.
+    """
+    def stream_height(stream):
+        return int(stream.resolution.rstrip('p'))
+
+    streams = [stream for stream in yt.streams.filter(type="video") if stream.resolution]
+    if not streams:
+        return None, "No video streams found for this video"
+    tall_enough = [stream for stream in streams if stream_height(stream) >= height]
+    stream = min(
+        tall_enough or streams,
+        key=lambda stream: (
+            stream_height(stream) if tall_enough else -stream_height(stream),
+            bool(getattr(stream, 'is_hdr', False)),
+            not (stream.video_codec or '').startswith('avc1'),
+            stream.fps or 0
+        )
+    )
+    logger.info(f"Selected stream {stream} to scale to {height}p")
+    is_valid, error = validate_download(stream)
+    return (stream, None) if is_valid else (None, error)
+
 def get_captions(yt,lang, translate=False):
     try:
       #yt = YouTube(url, use_oauth=AUTH, allow_oauth_cache=True,on_progress_callback=on_progress)
       
       # transcripts = YouTubeTranscriptApi.list_transcripts(yt.video_id, proxies = proxies)
-      captions = yt.captions
+      tracks = yt.caption_tracks
+      remember_caption_tracks(yt, tracks)
+      captions = CaptionQuery(tracks)
       if not translate:
           caption = captions.get_captions_by_lang_code(lang)
           # transcript = transcripts.find_transcript([lang])